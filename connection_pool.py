@@ -0,0 +1,229 @@
+import logging
+import select
+import threading
+import time
+from collections import deque
+import psycopg2
+from psycopg2 import pool
+
+logger = logging.getLogger(__name__)
+
+class PoolTimeoutError(pool.PoolError):
+    """Raised when no connection frees up within the acquire timeout."""
+
+class BoundedConnectionPool:
+    """
+    Thread-safe psycopg2 connection pool (drop-in for ThreadedConnectionPool's
+    getconn/putconn/closeall) that:
+      - queues callers when all `maxconn` connections are busy, up to `acquire_timeout` seconds,
+        instead of failing straight away;
+      - checks a connection before handing it out if it sat idle for `validate_after` seconds,
+        so a Postgres restart costs a reconnect instead of a failed user action (connections
+        idle for less are checked without a round trip, see _is_usable);
+      - retires connections older than `max_lifetime` seconds;
+      - keeps utilization metrics (see stats()).
+    """
+    def __init__(self, minconn, maxconn, acquire_timeout=10.0, max_lifetime=1800.0, validate_after=30.0, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.acquire_timeout = acquire_timeout
+        self.max_lifetime = max_lifetime
+        self.validate_after = validate_after
+        self._connect_kwargs = connect_kwargs
+
+        self._idle = deque()    # (connection, returned_at), most recently returned on the right
+        self._born = {}         # connection -> created_at, for every open connection of the pool
+        self._in_use = set()
+        self._opening = 0       # slots reserved by threads that are connecting right now
+        self._waiting = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # Metrics
+        self.acquired = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.created = 0
+        self.recycled = 0
+        self.failed_validations = 0
+
+        for _ in range(minconn):
+            conn = self._connect()
+            self._idle.append((conn, time.monotonic()))
+
+    # ==========================================
+    # CHECKOUT / CHECKIN
+    # ==========================================
+
+    def getconn(self, timeout=None) -> psycopg2.extensions.connection:
+        timeout = self.acquire_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise pool.PoolError("connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    break
+                if len(self._born) + self._opening < self.maxconn:
+                    conn, returned_at = None, None
+                    self._opening += 1
+                    break
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self.timeouts += 1
+                    raise PoolTimeoutError(f"no database connection became free within {timeout:.1f}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+        # Connecting and validating happen outside the lock
+        try:
+            if conn is None:
+                conn = self._connect(reserved=True)
+            elif not self._is_usable(conn, returned_at):
+                with self._cond:
+                    self._opening += 1 # keep the slot while swapping the connection
+                self._discard(conn)
+                conn = self._connect(reserved=True)
+        except Exception:
+            with self._cond:
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - started
+        with self._cond:
+            self._in_use.add(conn)
+            self.acquired += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        with self._cond:
+            self._in_use.discard(conn)
+            expired = self._expired(conn)
+            retire = close or self._closed or conn.closed or expired
+            if expired:
+                self.recycled += 1
+
+        if not retire and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                retire = True
+
+        if retire:
+            self._discard(conn)
+        with self._cond:
+            if not retire:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def closeall(self):
+        """Closes the idle connections now; busy ones are closed as they are returned."""
+        with self._cond:
+            self._closed = True
+            idle = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in idle:
+            self._discard(conn)
+
+    # ==========================================
+    # CONNECTION LIFECYCLE
+    # ==========================================
+
+    def _connect(self, reserved=False) -> psycopg2.extensions.connection:
+        """Opens a connection; `reserved` means the caller already counted it in _opening."""
+        try:
+            conn = psycopg2.connect(**self._connect_kwargs)
+        except Exception:
+            if reserved:
+                with self._cond:
+                    self._opening -= 1
+            raise
+
+        with self._cond:
+            if reserved:
+                self._opening -= 1
+            self._born[conn] = time.monotonic()
+            self.created += 1
+        return conn
+
+    def _discard(self, conn):
+        with self._cond:
+            self._born.pop(conn, None)
+        if not conn.closed:
+            try:
+                conn.close()
+            except psycopg2.Error:
+                pass
+
+    def _expired(self, conn) -> bool:
+        born = self._born.get(conn)
+        return born is not None and time.monotonic() - born > self.max_lifetime
+
+    @staticmethod
+    def _looks_alive(conn) -> bool:
+        """
+        Round-trip-free check: an idle connection has nothing to read, so a readable socket
+        means the server closed it or sent its "terminating connection" notice (a restart or
+        failover), and anything but an idle transaction status means it's broken.
+        """
+        if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return False
+        try:
+            readable, _, _ = select.select([conn], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _is_usable(self, conn, returned_at) -> bool:
+        if not conn.closed and not self._expired(conn):
+            if not self._looks_alive(conn):
+                logger.warning("Dropping a dead pooled connection")
+            elif time.monotonic() - returned_at < self.validate_after:
+                return True
+            else:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute("SELECT 1")
+                    conn.rollback()
+                    return True
+                except psycopg2.Error:
+                    logger.warning("Dropping a dead pooled connection")
+
+        with self._cond:
+            if self._expired(conn) and not conn.closed:
+                self.recycled += 1
+            else:
+                self.failed_validations += 1
+        return False
+
+    # ==========================================
+    # METRICS
+    # ==========================================
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                "size": len(self._born),
+                "in_use": len(self._in_use),
+                "idle": len(self._idle),
+                "waiting": self._waiting,
+                "maxconn": self.maxconn,
+                "acquired": self.acquired,
+                "timeouts": self.timeouts,
+                "avg_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+                "max_wait": self.max_wait,
+                "created": self.created,
+                "recycled": self.recycled,
+                "failed_validations": self.failed_validations,
+            }
@@ -0,0 +1,95 @@
+import time
+import asyncio
+from telegram.constants import ChatMemberStatus
+
+ADMIN_STATUSES = {ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER}
+GONE_STATUSES = {ChatMemberStatus.LEFT, ChatMemberStatus.BANNED}
+
+class AdminCache:
+    """
+    Administrator ids per chat, so admin checks don't cost a Telegram API call each.
+
+    A chat's admins are loaded with one get_chat_administrators call the first time it's asked
+    about, then kept current by the ChatMemberUpdated updates Telegram sends on every promotion
+    and demotion. Updates can be missed (the bot wasn't an admin, or was down), so a chat is
+    loaded again once its list is `ttl` seconds old. Checks that miss while a chat is already
+    loading wait for that one call instead of making their own. Lives on the event loop, so it
+    needs no lock.
+    """
+    def __init__(self, ttl=600.0):
+        self.ttl = ttl
+
+        self._chats: dict[int, tuple[set, float]] = {} # chat_id -> (admin ids, loaded_at)
+        self._loading: dict[int, asyncio.Task] = {}    # chat_id -> get_chat_administrators in flight
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.updates = 0
+        self.joined = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        now = time.monotonic()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "updates": self.updates,
+            "joined": self.joined,
+            "cached_chats": len(self._chats),
+            "oldest_age": max((now - loaded_at for _, loaded_at in self._chats.values()), default=0.0),
+        }
+
+    async def is_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        cached = self._chats.get(chat_id)
+        if cached is not None and time.monotonic() - cached[1] < self.ttl:
+            self.hits += 1
+            return user_id in cached[0]
+
+        self.misses += 1
+        if cached is not None:
+            self.expired += 1
+
+        task = self._loading.get(chat_id)
+        if task is None:
+            task = self._loading[chat_id] = asyncio.create_task(self._load(bot, chat_id))
+        else:
+            self.joined += 1
+        # Shielded, so one caller being cancelled doesn't cancel the load for the others
+        admin_ids = await asyncio.shield(task)
+        return user_id in admin_ids
+
+    async def _load(self, bot, chat_id: int) -> set:
+        try:
+            administrators = await bot.get_chat_administrators(chat_id)
+        except Exception:
+            # Private chats have no administrators, and the bot may have lost access: assume False
+            self._chats.pop(chat_id, None)
+            return set()
+        finally:
+            del self._loading[chat_id]
+
+        admin_ids = {member.user.id for member in administrators}
+        self._chats[chat_id] = (admin_ids, time.monotonic())
+        return admin_ids
+
+    def member_updated(self, chat_member_updated, bot_id: int | None = None):
+        """Applies a ChatMemberUpdated to the chat's cached admins (chats not cached yet are left to load)."""
+        chat_id = chat_member_updated.chat.id
+        member = chat_member_updated.new_chat_member
+
+        if member.user.id == bot_id and member.status in GONE_STATUSES:
+            self._chats.pop(chat_id, None)
+            return
+
+        cached = self._chats.get(chat_id)
+        if cached is None:
+            return
+
+        self.updates += 1
+        if member.status in ADMIN_STATUSES:
+            cached[0].add(member.user.id)
+        else:
+            cached[0].discard(member.user.id)
@@ -0,0 +1,128 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+# Local modules
+from connection_pool import PoolTimeoutError
+from features.group_khetma import errors
+from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.class_khetma import Khetma
+from features.group_khetma.class_chapter import Chapter
+
+class AsyncKhetmaStorage:
+    """
+    Non-blocking wrapper around KhetmaStorage.
+    Every call is pushed to a bounded thread pool, so a slow query never stalls
+    the event loop and DB latency overlaps with Telegram I/O of other chats.
+    """
+    def __init__(self, storage: KhetmaStorage, max_workers: int | None = None):
+        self.storage = storage
+
+        # Never run more queries at once than the backend has connections,
+        # otherwise getconn() fails instead of waiting (an in-memory backend has none, one lock serializes it anyway).
+        if max_workers is None:
+            max_workers = storage.db.max_connections if storage.db is not None else 1
+
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="khetma-storage")
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        try:
+            return await loop.run_in_executor(self.executor, partial(func, *args, **kwargs))
+        except PoolTimeoutError as e:
+            # Every connection stayed busy for the whole acquire timeout
+            raise errors.DatabaseConnectionError() from e
+
+    def close(self):
+        """Waits for in-flight queries and stops the worker threads."""
+        self.executor.shutdown(wait=True)
+
+    async def create_new_khetma(self, chat_id) -> Khetma:
+        return await self._run(self.storage.create_new_khetma, chat_id)
+
+    async def create_new_khetmat(self, chat_ids: list) -> list[Khetma]:
+        return await self._run(self.storage.create_new_khetmat, chat_ids)
+
+    async def get_khetma(self, khetma_id=None, khetma_number=None, chat_id=None) -> Khetma | None:
+        return await self._run(self.storage.get_khetma, khetma_id=khetma_id, khetma_number=khetma_number, chat_id=chat_id)
+
+    async def get_khetmat_by_ids(self, khetma_ids: list) -> dict:
+        return await self._run(self.storage.get_khetmat_by_ids, khetma_ids)
+
+    async def get_active_khetmat(self, chat_id) -> list[Khetma]:
+        return await self._run(self.storage.get_active_khetmat, chat_id)
+
+    async def get_chapter(self, chapter_id=None, khetma_id=None, chapter_number=None) -> Chapter | None:
+        return await self._run(self.storage.get_chapter, chapter_id=chapter_id, khetma_id=khetma_id, chapter_number=chapter_number)
+
+    async def get_chapters_by_user(self, user_id, chat_id=None, khetma_id=None) -> list[Chapter]:
+        return await self._run(self.storage.get_chapters_by_user, user_id, chat_id=chat_id, khetma_id=khetma_id)
+
+    async def get_user_chapters_by_khetma(self, user_id, chat_id) -> dict[int, list[Chapter]]:
+        return await self._run(self.storage.get_user_chapters_by_khetma, user_id, chat_id)
+
+    async def update_khetma(self, khetma: Khetma, expected_version=None):
+        return await self._run(self.storage.update_khetma, khetma, expected_version=expected_version)
+
+    async def update_chapters(self, chapters: list[Chapter] | Chapter, expected_version=None) -> bool:
+        return await self._run(self.storage.update_chapters, chapters, expected_version=expected_version)
+
+    async def get_khetma_version(self, khetma_id) -> int | None:
+        return await self._run(self.storage.get_khetma_version, khetma_id)
+
+    async def reserve_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        return await self._run(self.storage.reserve_chapter, khetma_id, chapter_number, user_id, username)
+
+    async def reserve_chapter_returning(self, khetma_id, chapter_number, user_id, username) -> Khetma:
+        return await self._run(self.storage.reserve_chapter_returning, khetma_id, chapter_number, user_id, username)
+
+    async def withdraw_chapter(self, khetma_id, chapter_number, user_id, is_admin=False) -> bool:
+        return await self._run(self.storage.withdraw_chapter, khetma_id, chapter_number, user_id, is_admin=is_admin)
+
+    async def withdraw_chapters(self, khetma_id, chapter_numbers: list[int], user_id, is_admin=False) -> tuple[Khetma, dict]:
+        return await self._run(self.storage.withdraw_chapters, khetma_id, chapter_numbers, user_id, is_admin=is_admin)
+
+    async def withdraw_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        return await self._run(self.storage.withdraw_all_user_chapters, chat_id, user_id, khetma_id=khetma_id)
+
+    async def withdraw_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        return await self._run(self.storage.withdraw_all_user_chapters_returning, chat_id, user_id, khetma_id)
+
+    async def finish_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        return await self._run(self.storage.finish_chapter, khetma_id, chapter_number, user_id, username)
+
+    async def finish_chapters(self, khetma_id, chapter_numbers: list[int], user_id, username) -> tuple[Khetma, dict]:
+        return await self._run(self.storage.finish_chapters, khetma_id, chapter_numbers, user_id, username)
+
+    async def finish_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        return await self._run(self.storage.finish_all_user_chapters, chat_id, user_id, khetma_id=khetma_id)
+
+    async def finish_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        return await self._run(self.storage.finish_all_user_chapters_returning, chat_id, user_id, khetma_id)
+
+    async def get_chat_counters(self, chat_id) -> dict:
+        return await self._run(self.storage.get_chat_counters, chat_id)
+
+    async def calc_finished_khetmat_number(self, chat_id) -> int:
+        return await self._run(self.storage.calc_finished_khetmat_number, chat_id)
+
+    async def calc_next_khetma_number(self, chat_id: int) -> int:
+        return await self._run(self.storage.calc_next_khetma_number, chat_id)
+
+    async def get_finished_khetmat(self, chat_id, limit=10) -> list[Khetma]:
+        return await self._run(self.storage.get_finished_khetmat, chat_id, limit=limit)
+
+    async def archive_finished_khetmat(self, chat_id=None, batch_size=500) -> int:
+        return await self._run(self.storage.archive_finished_khetmat, chat_id=chat_id, batch_size=batch_size)
+
+    async def get_reading_stats(self, chat_id, user_id) -> dict:
+        return await self._run(self.storage.get_reading_stats, chat_id, user_id)
+
+    async def get_reading_leaderboard(self, chat_id, limit=10) -> list[dict]:
+        return await self._run(self.storage.get_reading_leaderboard, chat_id, limit=limit)
+
+    async def save_user(self, user_id, username, first_name):
+        return await self._run(self.storage.save_user, user_id, username, first_name)
+
+    async def get_users(self, user_ids: list) -> dict[int, dict]:
+        return await self._run(self.storage.get_users, user_ids)
@@ -38,6 +38,9 @@ class Chapter:
     def is_finished(self):
         return self.status == self.chapter_status.FINISHED
     
+    def copy(self) -> 'Chapter':
+        return Chapter(self.parent_khetma, self.number, self.owner_id, self.owner_username, self.status)
+
     @classmethod
     def from_db_row(cls, row) -> 'Chapter':
         """Factory: Converts a DB row (RealDictRow) into a Chapter object."""
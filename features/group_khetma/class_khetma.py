@@ -8,21 +8,95 @@ class Khetma:
         ACTIVE = "ACTIVE"
         FINISHED = "FINISHED"
     
-    def __init__(self, khetma_id, number, status=khetma_status.ACTIVE, chapters: list[Chapter]=None):
+    # Chapter n is bit (n - 1) of a mask
+    FULL_MASK = (1 << 30) - 1
+
+    def __init__(self, khetma_id, number, status=khetma_status.ACTIVE, chapters: list[Chapter]=None, chat_id=None, version=0):
         self.khetma_id = khetma_id
         self.number = number
         self.status = status
+        self.chat_id = chat_id
+        self.version = version # bumped by the storage on every write; conditional writes compare it
+        self._bitmap = None # (reserved_mask, finished_mask, owner_ids, owner_usernames) until chapters are built
         if chapters:
-            self.chapters = chapters
+            self._chapters = chapters
         else:
-            self.chapters = [
-            Chapter(khetma_id, chapter_num, None, Chapter.chapter_status.EMPTY)
+            self._chapters = [
+            Chapter(khetma_id, chapter_num, None, None, Chapter.chapter_status.EMPTY)
             for chapter_num in range(1, 31)
         ] 
 
+    @property
+    def chapters(self) -> list[Chapter]:
+        """The 30 Chapter objects (built on first access for a khetma read as bitmaps)."""
+        if self._chapters is None:
+            reserved_mask, finished_mask, owner_ids, owner_usernames = self._bitmap
+            self._chapters = [
+                Chapter(self.khetma_id, chapter_num, owner_ids[chapter_num - 1], owner_usernames[chapter_num - 1],
+                        self._status_from_masks(chapter_num, reserved_mask, finished_mask))
+                for chapter_num in range(1, 31)
+            ]
+            self._bitmap = None # from now on the chapters are the state
+        return self._chapters
+
+    @chapters.setter
+    def chapters(self, chapters: list[Chapter]):
+        self._chapters = chapters
+        self._bitmap = None
+
+    # ==========================================
+    # BITMAP VIEW (no Chapter objects needed)
+    # ==========================================
+
+    @staticmethod
+    def _status_from_masks(chapter_num, reserved_mask, finished_mask) -> Chapter.chapter_status:
+        bit = 1 << (chapter_num - 1)
+        if finished_mask & bit:
+            return Chapter.chapter_status.FINISHED
+        if reserved_mask & bit:
+            return Chapter.chapter_status.RESERVED
+        return Chapter.chapter_status.EMPTY
+
+    def _mask_of(self, status) -> int:
+        mask = 0
+        for chapter in self._chapters:
+            if chapter.status == status:
+                mask |= 1 << (chapter.number - 1)
+        return mask
+
+    @property
+    def reserved_mask(self) -> int:
+        if self._chapters is None:
+            return self._bitmap[0]
+        return self._mask_of(Chapter.chapter_status.RESERVED)
+
+    @property
+    def finished_mask(self) -> int:
+        if self._chapters is None:
+            return self._bitmap[1]
+        return self._mask_of(Chapter.chapter_status.FINISHED)
+
+    @property
+    def available_mask(self) -> int:
+        return self.FULL_MASK & ~(self.reserved_mask | self.finished_mask)
+
+    @staticmethod
+    def numbers_in_mask(mask) -> list[int]:
+        return [chapter_num for chapter_num in range(1, 31) if mask >> (chapter_num - 1) & 1]
+
+    def available_numbers(self) -> list[int]:
+        return self.numbers_in_mask(self.available_mask)
+
+    def chapter_statuses(self) -> list[Chapter.chapter_status]:
+        """Status of chapters 1..30 in order (what the keyboard and message render from)."""
+        if self._chapters is None:
+            reserved_mask, finished_mask = self._bitmap[0], self._bitmap[1]
+            return [self._status_from_masks(n, reserved_mask, finished_mask) for n in range(1, 31)]
+        return [chapter.status for chapter in self._chapters]
+
     @property
     def is_finished(self):
-        return len(self.get_finished_chapters()) == 30
+        return self.finished_mask == self.FULL_MASK
     
     def get_chapter(self, chapter_num) -> Chapter | None:
         if 1 <= chapter_num <= 30:
@@ -65,6 +139,37 @@ class Khetma:
             return False
         chapter.mark_empty()
 
+    def copy(self) -> 'Khetma':
+        """Returns an independent copy, so callers can't change a shared (cached) object."""
+        if self._chapters is None:
+            reserved_mask, finished_mask, owner_ids, owner_usernames = self._bitmap
+            return Khetma.from_bitmap(
+                self.khetma_id, self.number, self.status, reserved_mask, finished_mask,
+                list(owner_ids), list(owner_usernames), chat_id=self.chat_id, version=self.version
+            )
+        return Khetma(
+            khetma_id=self.khetma_id,
+            number=self.number,
+            status=self.status,
+            chapters=[chapter.copy() for chapter in self.chapters],
+            chat_id=self.chat_id,
+            version=self.version
+        )
+
+    @classmethod
+    def from_bitmap(cls, khetma_id, number, status, reserved_mask, finished_mask,
+                    owner_ids: list, owner_usernames: list, chat_id=None, version=0) -> 'Khetma':
+        """A khetma held as two 30-bit masks plus per-chapter owners; Chapter objects are built only if asked for."""
+        khetma = cls.__new__(cls) # skips building the 30 default chapters
+        khetma.khetma_id = khetma_id
+        khetma.number = number
+        khetma.status = status
+        khetma.chat_id = chat_id
+        khetma.version = version
+        khetma._chapters = None
+        khetma._bitmap = (reserved_mask, finished_mask, owner_ids, owner_usernames)
+        return khetma
+
     @classmethod
     def from_db_row(cls, khetma_row, chapters_rows) -> 'Khetma':
         """Factory: Converts a DB row + List of Chapter rows into a Khetma object."""
@@ -72,6 +177,22 @@ class Khetma:
             khetma_id=khetma_row["khetma_id"],
             number=khetma_row["number"],
             status=cls.khetma_status[khetma_row["status"].upper()],
-            chapters=[Chapter.from_db_row(row) for row in chapters_rows]
+            chapters=[Chapter.from_db_row(row) for row in chapters_rows],
+            chat_id=khetma_row.get("chat_id"),
+            version=khetma_row.get("version", 0)
+        )
+
+    @classmethod
+    def from_bitmap_row(cls, khetma_row) -> 'Khetma':
+        """Factory: Converts a khetmat row (with its bitmap columns) into a Khetma object."""
+        return cls.from_bitmap(
+            khetma_id=khetma_row["khetma_id"],
+            number=khetma_row["number"],
+            status=cls.khetma_status[khetma_row["status"].upper()],
+            reserved_mask=khetma_row["reserved_mask"],
+            finished_mask=khetma_row["finished_mask"],
+            owner_ids=khetma_row["owner_ids"] or [None] * 30,
+            owner_usernames=khetma_row["owner_usernames"] or [None] * 30,
+            chat_id=khetma_row.get("chat_id"),
+            version=khetma_row.get("version", 0)
         )
-    
\ No newline at end of file
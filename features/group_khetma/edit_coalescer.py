@@ -0,0 +1,124 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+from datetime import timedelta
+from telegram import error as TelegramError
+
+logger = logging.getLogger(__name__)
+
+class EditCoalescer:
+    """
+    Schedules edits of bot messages, so a burst of button taps on one khetma costs one edit.
+
+    Edits are keyed by (chat_id, message_id). Each key gets one worker that waits `window`
+    seconds, sends only the latest state scheduled meanwhile, and repeats while more arrive, so
+    at most one edit per message is in flight. States carry the khetma version when there is
+    one, and an older version never replaces a newer one, even after the worker is done: the
+    newest version per message is kept for `version_ttl` seconds, for at most `max_messages`
+    messages. On RetryAfter the worker sleeps as long as Telegram asks, then sends whatever is
+    latest by then. Lives on the event loop, so it needs no lock.
+    """
+    def __init__(self, window=0.5, max_retries=5, version_ttl=600.0, max_messages=10000):
+        self.window = window
+        self.max_retries = max_retries
+        self.version_ttl = version_ttl
+        self.max_messages = max_messages
+
+        self._pending: dict[tuple, dict] = {}         # (chat_id, message_id) -> latest unsent edit
+        self._versions: OrderedDict[tuple, tuple[int, float]] = OrderedDict() # (chat_id, message_id) -> (newest version scheduled, when)
+        self._workers: dict[tuple, asyncio.Task] = {}
+
+        self.scheduled = 0
+        self.sent = 0
+        self.coalesced = 0
+        self.stale = 0
+        self.rate_limited = 0
+        self.failed = 0
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": self.scheduled,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "stale": self.stale,
+            "rate_limited": self.rate_limited,
+            "failed": self.failed,
+            "active_messages": len(self._workers),
+            "tracked_versions": len(self._versions),
+        }
+
+    def _forget_versions(self, now: float):
+        """Drops versions older than `version_ttl`, and the oldest ones past `max_messages`."""
+        while self._versions:
+            key, (_, seen_at) = next(iter(self._versions.items()))
+            if now - seen_at < self.version_ttl and len(self._versions) <= self.max_messages:
+                break
+            del self._versions[key]
+
+    def schedule_edit(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None, parse_mode="Markdown", version=None):
+        """Queues the message's new state and returns at once (the edit is sent by the key's worker)."""
+        key = (chat_id, message_id)
+        self.scheduled += 1
+
+        if version is not None:
+            now = time.monotonic()
+            newest = self._versions.get(key)
+            if newest is not None and now - newest[1] < self.version_ttl and version < newest[0]:
+                self.stale += 1
+                return
+            self._versions[key] = (version, now)
+            self._versions.move_to_end(key)
+            self._forget_versions(now)
+
+        if key in self._pending:
+            self.coalesced += 1
+        self._pending[key] = {"text": text, "reply_markup": reply_markup, "parse_mode": parse_mode}
+        if key not in self._workers:
+            self._workers[key] = asyncio.create_task(self._run(bot, key))
+
+    async def flush(self):
+        """Waits until every scheduled edit has been sent (or given up on)."""
+        while self._workers:
+            await asyncio.gather(*self._workers.values())
+
+    async def _run(self, bot, key):
+        chat_id, message_id = key
+        retries = 0
+        try:
+            while True:
+                await asyncio.sleep(self.window)
+                edit = self._pending.pop(key, None)
+                if edit is None:
+                    return
+
+                try:
+                    await bot.edit_message_text(chat_id=chat_id, message_id=message_id, **edit)
+                    self.sent += 1
+                    retries = 0
+                except TelegramError.RetryAfter as err:
+                    self.rate_limited += 1
+                    retries += 1
+                    if retries > self.max_retries:
+                        logger.warning(f"Gave up editing message {message_id} in chat {chat_id}: {err}")
+                        self.failed += 1
+                        continue
+                    delay = err.retry_after
+                    await asyncio.sleep(delay.total_seconds() if isinstance(delay, timedelta) else delay)
+                    # Whatever was scheduled while we waited is newer than this one
+                    if key in self._pending:
+                        self.coalesced += 1
+                    else:
+                        self._pending[key] = edit
+                except TelegramError.BadRequest as err:
+                    # Mostly "message is not modified", when the latest state is what's already shown
+                    if "not modified" in str(err):
+                        self.sent += 1
+                    else:
+                        logger.warning(f"Could not edit message {message_id} in chat {chat_id}: {err}")
+                        self.failed += 1
+                except TelegramError.TelegramError as err:
+                    logger.warning(f"Could not edit message {message_id} in chat {chat_id}: {err}")
+                    self.failed += 1
+        finally:
+            del self._workers[key]
@@ -59,11 +59,21 @@ class KhetmaNotFoundError(KhetmaError):
     def __init__(self, message="❌ هذه الختمة لم تعد موجودة."):
         super().__init__(message)
 
+class ChapterNotFoundError(KhetmaError):
+    """Raised when a chapter number outside 1-30 is requested."""
+    def __init__(self, message="⚠️ رقم الجزء غير صحيح، الأجزاء من 1 إلى 30."):
+        super().__init__(message)
+
 class KhetmaCompletedError(KhetmaError):
     """Raised when trying to interact with a Khetma that is fully finished."""
     def __init__(self, message="🎉 تم اكتمال هذه الختمة بالكامل! انتظر الختمة الجديدة."):
         super().__init__(message)
 
+class StaleKhetmaError(KhetmaError):
+    """Raised when a conditional write finds the khetma changed since it was read (its version moved)."""
+    def __init__(self, message="⚠️ تغيّرت الختمة في هذه الأثناء، الرجاء المحاولة مرة أخرى."):
+        super().__init__(message)
+
 class MessageExpiredError(KhetmaError):
     """Raised when interacting with a message from a deleted/old chat session."""
     def __init__(self, message="⌛ هذه الرسالة قديمة، يرجى استخدام القائمة الجديدة."):
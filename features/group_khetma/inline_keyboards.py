@@ -10,21 +10,22 @@ def render_khetma_keyboard(khetma: Khetma):
     keyboard = []
     row = []
 
-    for chapter in khetma.chapters:          
+    # Statuses only, so a khetma read as bitmaps renders without building Chapter objects
+    for chapter_number, status in enumerate(khetma.chapter_statuses(), start=1):
         
         # 1. Determine Text & Action
-        if chapter.status.name == "FINISHED": # Use .name if Enum
+        if status.name == "FINISHED": # Use .name if Enum
             text = "✅"
-            callback_data = f"info_{khetma.khetma_id}_{chapter.number}"
+            callback_data = f"info_{khetma.khetma_id}_{chapter_number}"
         
-        elif chapter.status.name == "RESERVED":
+        elif status.name == "RESERVED":
             text = "⬜"
             # We keep the callback so if they click, we can say "Reserved by X"
-            callback_data = f"info_{khetma.khetma_id}_{chapter.number}"
+            callback_data = f"info_{khetma.khetma_id}_{chapter_number}"
         
         else: # AVAILABLE
-            text = str(chapter.number)
-            callback_data = f"reserve_{khetma.khetma_id}_{chapter.number}"
+            text = str(chapter_number)
+            callback_data = f"reserve_{khetma.khetma_id}_{chapter_number}"
 
         # 2. Add Button
         row.append(InlineKeyboardButton(text=text, callback_data=callback_data))
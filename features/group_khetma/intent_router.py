@@ -0,0 +1,79 @@
+import re
+from collections import Counter
+
+from telegram import Update
+from telegram.ext import ContextTypes
+
+# Hamza forms of alef are folded into a bare alef and tatweel is dropped, so "أجزائي" and
+# "اجزائي" (or a stretched "تـم") are the same trigger
+_NORMALIZE = str.maketrans({"أ": "ا", "إ": "ا", "آ": "ا", "ـ": None})
+
+def normalize(text: str) -> str:
+    return text.translate(_NORMALIZE)
+
+class Intent:
+    """
+    One text trigger and the handler it dispatches to.
+    It matches when the message has one of `words` as a whole word (if any are given) and
+    contains every one of `fragments` anywhere. `replies_only` intents skip messages that
+    don't reply to another message, leaving them to the intents after it.
+    """
+    def __init__(self, name: str, handler, words=(), fragments=(), replies_only=False):
+        self.name = name
+        self.handler = handler
+        self.words = frozenset(normalize(word) for word in words)
+        self.fragments = frozenset(normalize(fragment) for fragment in fragments)
+        self.replies_only = replies_only
+
+    def matches(self, hits: set, is_reply: bool) -> bool:
+        if self.replies_only and not is_reply:
+            return False
+        if self.words and not (self.words & hits):
+            return False
+        return self.fragments <= hits
+
+class IntentRouter:
+    """
+    Routes group text messages to at most one khetma handler.
+
+    Every trigger of every intent is compiled into one regex, so a message is normalized and
+    scanned once, however many intents there are; chatter with no trigger in it ends there.
+    Intents are tried in the order given and the first match wins. Counts dispatches per intent.
+    """
+    def __init__(self, intents: list[Intent]):
+        self.intents = intents
+
+        words = {word for intent in intents for word in intent.words}
+        fragments = {fragment for intent in intents for fragment in intent.fragments} - words
+        # Longest first, so "تمت" isn't cut short at "تم"
+        alternation = lambda terms: "|".join(map(re.escape, sorted(terms, key=len, reverse=True))) or "(?!)"
+        self._matcher = re.compile(
+            rf"(?<!\S)(?:{alternation(words)})(?!\S)|{alternation(fragments)}"
+        )
+
+        self.counts = Counter()
+        self.unmatched = 0
+
+    def match(self, text: str, is_reply=False) -> Intent | None:
+        hits = set(self._matcher.findall(normalize(text)))
+        if hits:
+            for intent in self.intents:
+                if intent.matches(hits, is_reply):
+                    return intent
+        return None
+
+    def stats(self) -> dict:
+        return {**{intent.name: self.counts[intent.name] for intent in self.intents}, "unmatched": self.unmatched}
+
+    async def handle(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        message = update.message
+        if message is None or not message.text:
+            return
+
+        intent = self.match(message.text, is_reply=message.reply_to_message is not None)
+        if intent is None:
+            self.unmatched += 1
+            return
+
+        self.counts[intent.name] += 1
+        await intent.handler(update, context)
@@ -0,0 +1,56 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+class KhetmaArchiver:
+    """
+    Periodically moves FINISHED khetmat out of the hot tables (storage.archive_finished_khetmat),
+    in batches so no single statement holds locks for long. Runs on a daemon thread.
+    """
+    def __init__(self, storage, interval=3600.0, batch_size=500):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.archived = 0
+        self.runs = 0
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="khetma-archiver", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run_once(self) -> int:
+        """Archives batches until none is left. Returns: how many khetmat were archived."""
+        total = 0
+        while not self._stop.is_set():
+            archived = self.storage.archive_finished_khetmat(batch_size=self.batch_size)
+            total += archived
+            if archived < self.batch_size:
+                break
+
+        self.archived += total
+        self.runs += 1
+        return total
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                archived = self.run_once()
+                if archived:
+                    logger.info(f"Archived {archived} finished khetmat")
+            except Exception as e:
+                logger.warning(f"Archiving finished khetmat failed: {e}")
+            self._stop.wait(self.interval)
@@ -0,0 +1,350 @@
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+# Local modules
+from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.class_khetma import Khetma
+from features.group_khetma.class_chapter import Chapter
+
+class CachedKhetmaStorage:
+    """
+    Write-through, LRU-bounded cache in front of a KhetmaStorage.
+
+    Keeps the Khetma objects of ACTIVE khetmat in memory and serves get_khetma,
+    get_active_khetmat and get_chapter from them. Every mutation hits the DB first; the
+    ones that return the khetma replace the cached copy with it (versions and all), so
+    redrawing a keyboard right after a click needs no extra query, and the rest drop it.
+    Finished khetmat are never cached.
+    """
+    def __init__(self, storage: KhetmaStorage, max_khetmat=1000):
+        self.storage = storage
+        self.db = storage.db
+        self.max_khetmat = max_khetmat
+
+        self._khetmat: OrderedDict[int, Khetma] = OrderedDict() # khetma_id -> Khetma (LRU order)
+        self._numbers = {}          # (chat_id, khetma_number) -> khetma_id
+        self._active_by_chat = {}   # chat_id -> [khetma_id, ...] (only for chats loaded in full)
+
+        # Bumped by every write; a DB read that overlapped a write is returned but not cached
+        self._generation = 0
+        self._lock = threading.RLock()
+        # Writes run unlocked; a khetma written by two at once can't tell whose patch is newer
+        self._writers = {}          # khetma_id -> writes in flight
+        self._contended = set()     # khetma_ids with overlapping writes in flight
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # ==========================================
+    # CACHE BOOKKEEPING
+    # ==========================================
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "cached_khetmat": len(self._khetmat),
+                "cached_chats": len(self._active_by_chat),
+            }
+
+    @contextmanager
+    def _write(self, khetma_id):
+        """Tracks a write to a khetma while its DB round trip runs, noting any overlap with another."""
+        with self._lock:
+            self._writers[khetma_id] = self._writers.get(khetma_id, 0) + 1
+            if self._writers[khetma_id] > 1:
+                self._contended.add(khetma_id)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._writers[khetma_id] -= 1
+                if not self._writers[khetma_id]:
+                    del self._writers[khetma_id]
+                    self._contended.discard(khetma_id)
+
+    def _hit(self, khetma_id) -> Khetma | None:
+        with self._lock:
+            khetma = self._khetmat.get(khetma_id)
+            if khetma is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._khetmat.move_to_end(khetma_id)
+            return khetma.copy()
+
+    def _store(self, khetma: Khetma):
+        """Caches an ACTIVE khetma (caller holds the lock)."""
+        if khetma.status != Khetma.khetma_status.ACTIVE:
+            self._evict(khetma.khetma_id)
+            return
+
+        old = self._khetmat.get(khetma.khetma_id)
+        if old is not None:
+            self._numbers.pop((old.chat_id, old.number), None)
+
+        self._khetmat[khetma.khetma_id] = khetma.copy()
+        self._khetmat.move_to_end(khetma.khetma_id)
+        if khetma.chat_id is not None:
+            self._numbers[(khetma.chat_id, khetma.number)] = khetma.khetma_id
+
+        while len(self._khetmat) > self.max_khetmat:
+            oldest_id = next(iter(self._khetmat))
+            self._evict(oldest_id)
+            self.evictions += 1
+
+    def _evict(self, khetma_id):
+        """Drops a khetma (caller holds the lock). Its chat's active list is no longer complete."""
+        khetma = self._khetmat.pop(khetma_id, None)
+        if khetma is None:
+            return
+        self._numbers.pop((khetma.chat_id, khetma.number), None)
+        self._active_by_chat.pop(khetma.chat_id, None)
+
+    def invalidate(self, khetma_id, version=None):
+        """Drops a cached khetma, unless `version` is given and the cached copy already is at least that new."""
+        with self._lock:
+            self._generation += 1
+            if khetma_id in self._writers:
+                # A snapshot returned by a write in flight can't tell whether it's before or after this
+                self._contended.add(khetma_id)
+            cached = self._khetmat.get(khetma_id)
+            if version is not None and cached is not None and cached.version >= version:
+                return
+            self._evict(khetma_id)
+
+    def invalidate_chat(self, chat_id):
+        """Forgets which khetmat are active in a chat (e.g. another replica created one)."""
+        with self._lock:
+            self._generation += 1
+            self._active_by_chat.pop(chat_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._khetmat.clear()
+            self._numbers.clear()
+            self._active_by_chat.clear()
+
+    # ==========================================
+    # READS
+    # ==========================================
+
+    def get_khetma(self, khetma_id=None, khetma_number=None, chat_id=None) -> Khetma | None:
+        if khetma_id is None and khetma_number and chat_id:
+            with self._lock:
+                khetma = self._hit(self._numbers.get((chat_id, khetma_number)))
+            return khetma if khetma is not None else self._load_khetma(khetma_number=khetma_number, chat_id=chat_id)
+
+        if khetma_id and not (khetma_number or chat_id):
+            khetma = self._hit(khetma_id)
+            return khetma if khetma is not None else self._load_khetma(khetma_id=khetma_id)
+
+        return self.storage.get_khetma(khetma_id=khetma_id, khetma_number=khetma_number, chat_id=chat_id)
+
+    def _load_khetma(self, **lookup) -> Khetma | None:
+        generation = self._generation
+        khetma = self.storage.get_khetma(**lookup)
+        if khetma is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._store(khetma)
+        return khetma
+
+    def get_active_khetmat(self, chat_id) -> list[Khetma]:
+        with self._lock:
+            khetma_ids = self._active_by_chat.get(chat_id)
+            if khetma_ids is not None:
+                self.hits += 1
+                for khetma_id in khetma_ids:
+                    self._khetmat.move_to_end(khetma_id)
+                return [self._khetmat[khetma_id].copy() for khetma_id in khetma_ids]
+            self.misses += 1
+            generation = self._generation
+
+        khetmat = self.storage.get_active_khetmat(chat_id)
+
+        with self._lock:
+            if generation == self._generation and len(khetmat) <= self.max_khetmat:
+                for khetma in khetmat:
+                    self._store(khetma)
+                # Storing may have evicted an older khetma of this same chat
+                if all(khetma.khetma_id in self._khetmat for khetma in khetmat):
+                    self._active_by_chat[chat_id] = [khetma.khetma_id for khetma in khetmat]
+        return khetmat
+
+    def get_chapter(self, chapter_id=None, khetma_id=None, chapter_number=None) -> Chapter | None:
+        if khetma_id and chapter_number and not chapter_id:
+            with self._lock:
+                khetma = self._khetmat.get(khetma_id)
+                if khetma is not None:
+                    self.hits += 1
+                    self._khetmat.move_to_end(khetma_id)
+                    chapter = khetma.get_chapter(chapter_number)
+                    return chapter.copy() if chapter else None
+                self.misses += 1
+
+        return self.storage.get_chapter(chapter_id=chapter_id, khetma_id=khetma_id, chapter_number=chapter_number)
+
+    def get_khetmat_by_ids(self, khetma_ids: list) -> dict:
+        return self.storage.get_khetmat_by_ids(khetma_ids)
+
+    def get_khetma_version(self, khetma_id) -> int | None:
+        # Always the stored one: this is how a caller checks a (possibly cached) copy is current
+        return self.storage.get_khetma_version(khetma_id)
+
+    def get_chapters_by_user(self, user_id, chat_id=None, khetma_id=None) -> list[Chapter]:
+        return self.storage.get_chapters_by_user(user_id, chat_id=chat_id, khetma_id=khetma_id)
+
+    def get_chat_counters(self, chat_id) -> dict:
+        return self.storage.get_chat_counters(chat_id)
+
+    def get_user_chapters_by_khetma(self, user_id, chat_id) -> dict[int, list[Chapter]]:
+        return self.storage.get_user_chapters_by_khetma(user_id, chat_id)
+
+    def get_finished_khetmat(self, chat_id, limit=10) -> list[Khetma]:
+        return self.storage.get_finished_khetmat(chat_id, limit=limit)
+
+    def get_reading_stats(self, chat_id, user_id) -> dict:
+        return self.storage.get_reading_stats(chat_id, user_id)
+
+    def get_reading_leaderboard(self, chat_id, limit=10) -> list[dict]:
+        return self.storage.get_reading_leaderboard(chat_id, limit=limit)
+
+    def save_user(self, user_id, username, first_name):
+        return self.storage.save_user(user_id, username, first_name)
+
+    def get_users(self, user_ids: list) -> dict[int, dict]:
+        return self.storage.get_users(user_ids)
+
+    def calc_finished_khetmat_number(self, chat_id) -> int:
+        return self.storage.calc_finished_khetmat_number(chat_id)
+
+    def calc_next_khetma_number(self, chat_id: int) -> int:
+        return self.storage.calc_next_khetma_number(chat_id)
+
+    # ==========================================
+    # WRITES (DB first, then the cached copy)
+    # ==========================================
+
+    def create_new_khetma(self, chat_id) -> Khetma:
+        return self.create_new_khetmat([chat_id])[0]
+
+    def create_new_khetmat(self, chat_ids: list) -> list[Khetma]:
+        khetmat = self.storage.create_new_khetmat(chat_ids)
+        with self._lock:
+            self._generation += 1
+            for khetma in khetmat:
+                self._store(khetma)
+                if khetma.chat_id in self._active_by_chat and khetma.khetma_id in self._khetmat:
+                    self._active_by_chat[khetma.chat_id].append(khetma.khetma_id)
+        return khetmat
+
+    def update_khetma(self, khetma: Khetma, expected_version=None):
+        try:
+            return self.storage.update_khetma(khetma, expected_version=expected_version)
+        finally:
+            # Written or found stale, the cached copy is behind (and `khetma` carries no chapters to replace it)
+            self.invalidate(khetma.khetma_id)
+
+    def update_chapters(self, chapters: list[Chapter] | Chapter, expected_version=None) -> bool:
+        if isinstance(chapters, Chapter):
+            chapters = [chapters]
+        try:
+            return self.storage.update_chapters(chapters, expected_version=expected_version)
+        finally:
+            # Written or found stale, the cached copies are behind either way
+            for khetma_id in {chapter.parent_khetma for chapter in chapters}:
+                self.invalidate(khetma_id)
+
+    def reserve_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        result = self.storage.reserve_chapter(khetma_id, chapter_number, user_id, username)
+        self.invalidate(khetma_id) # no snapshot to store, so the cached copy goes
+        return result
+
+    def withdraw_chapter(self, khetma_id, chapter_number, user_id, is_admin=False) -> bool:
+        result = self.storage.withdraw_chapter(khetma_id, chapter_number, user_id, is_admin=is_admin)
+        self.invalidate(khetma_id) # no snapshot to store, so the cached copy goes
+        return result
+
+    def finish_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        result = self.storage.finish_chapter(khetma_id, chapter_number, user_id, username)
+        self.invalidate(khetma_id) # no snapshot to store, so the cached copy goes
+        return result
+
+    def _store_snapshot(self, khetma: Khetma):
+        """
+        Replaces the cached copy with a post-mutation snapshot returned by the storage, unless the
+        cached copy is already that version or newer. When another write or an invalidation
+        overlapped and nothing is cached, the snapshot may be the older state, so it isn't cached.
+        """
+        with self._lock:
+            self._generation += 1
+            cached = self._khetmat.get(khetma.khetma_id)
+            if cached is not None and cached.version >= khetma.version:
+                return
+            if cached is None and khetma.khetma_id in self._contended:
+                return
+            self._store(khetma)
+
+    def reserve_chapter_returning(self, khetma_id, chapter_number, user_id, username) -> Khetma:
+        with self._write(khetma_id):
+            khetma = self.storage.reserve_chapter_returning(khetma_id, chapter_number, user_id, username)
+            self._store_snapshot(khetma)
+            return khetma
+
+    def withdraw_chapters(self, khetma_id, chapter_numbers: list[int], user_id, is_admin=False) -> tuple[Khetma, dict]:
+        with self._write(khetma_id):
+            khetma, outcomes = self.storage.withdraw_chapters(khetma_id, chapter_numbers, user_id, is_admin=is_admin)
+            self._store_snapshot(khetma)
+            return khetma, outcomes
+
+    def finish_chapters(self, khetma_id, chapter_numbers: list[int], user_id, username) -> tuple[Khetma, dict]:
+        with self._write(khetma_id):
+            khetma, outcomes = self.storage.finish_chapters(khetma_id, chapter_numbers, user_id, username)
+            self._store_snapshot(khetma)
+            return khetma, outcomes
+
+    def withdraw_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self._write(khetma_id):
+            chapters, khetma = self.storage.withdraw_all_user_chapters_returning(chat_id, user_id, khetma_id)
+            self._store_snapshot(khetma)
+            return chapters, khetma
+
+    def finish_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self._write(khetma_id):
+            chapters, khetma = self.storage.finish_all_user_chapters_returning(chat_id, user_id, khetma_id)
+            self._store_snapshot(khetma)
+            return chapters, khetma
+
+    def withdraw_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        if khetma_id is None:
+            chapters = self.storage.withdraw_all_user_chapters(chat_id, user_id)
+            for changed_id in {chapter.parent_khetma for chapter in chapters}:
+                self.invalidate(changed_id)
+            return chapters
+
+        chapters = self.storage.withdraw_all_user_chapters(chat_id, user_id, khetma_id=khetma_id)
+        self.invalidate(khetma_id)
+        return chapters
+
+    def finish_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        if khetma_id is None:
+            chapters = self.storage.finish_all_user_chapters(chat_id, user_id)
+            for changed_id in {chapter.parent_khetma for chapter in chapters}:
+                self.invalidate(changed_id)
+            return chapters
+
+        chapters = self.storage.finish_all_user_chapters(chat_id, user_id, khetma_id=khetma_id)
+        self.invalidate(khetma_id)
+        return chapters
+
+    def archive_finished_khetmat(self, chat_id=None, batch_size=500) -> int:
+        # Only FINISHED khetmat move, and those are never cached
+        return self.storage.archive_finished_khetmat(chat_id=chat_id, batch_size=batch_size)
@@ -1,3 +1,4 @@
+import logging
 from telegram import  Update
 from telegram import  error as TelegramError
 from telegram.ext import ContextTypes
@@ -7,9 +8,71 @@ import features.group_khetma.utilities as utilities
 import features.group_khetma.inline_keyboards as inline_keyboards
 import features.group_khetma.responses as responses
 import features.group_khetma.errors as errors
-from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.async_khetma_storage import AsyncKhetmaStorage
+from features.group_khetma.user_directory import UserDirectory
+from features.group_khetma.admin_cache import AdminCache
+from features.group_khetma.edit_coalescer import EditCoalescer
+from features.group_khetma.intent_router import Intent, IntentRouter
 from features.group_khetma.class_khetma import Khetma
 
+logger = logging.getLogger(__name__)
+
+async def _complete_khetma(storage: AsyncKhetmaStorage, khetma: Khetma) -> Khetma | None:
+    """
+    Marks a fully read khetma FINISHED, as long as it's still the version that was read
+    (re-reading and deciding again when it isn't).
+    Returns: the khetma as finished (re-read if it had moved on) if this call finished it, so
+    only one handler announces the completion and it renders the final state; else None.
+    """
+    while khetma is not None and khetma.is_finished and khetma.status == Khetma.khetma_status.ACTIVE:
+        khetma.status = Khetma.khetma_status.FINISHED
+        try:
+            await storage.update_khetma(khetma, expected_version=khetma.version)
+            return khetma
+        except errors.StaleKhetmaError:
+            khetma = await storage.get_khetma(khetma_id=khetma.khetma_id)
+    return None
+
+def _schedule_khetma_edit(context: ContextTypes.DEFAULT_TYPE, message, khetma: Khetma, keyboard=True):
+    """
+    Re-renders a khetma's message through the edit coalescer, which returns at once and
+    sends a burst of these as one edit (without the keyboard once the khetma is completed).
+    """
+    editor: EditCoalescer = context.bot_data["edit_coalescer"]
+    editor.schedule_edit(
+        context.bot, message.chat.id, message.message_id,
+        text=utilities.create_khetma_message(khetma),
+        reply_markup=inline_keyboards.render_khetma_keyboard(khetma) if keyboard else None,
+        parse_mode="Markdown",
+        version=khetma.version
+    )
+
+async def reply_database_error(update: Update, err: errors.DatabaseConnectionError):
+    """
+    Tells the user to try again when the database couldn't serve their action (every pooled
+    connection stayed busy): answers the tapped button, or replies to the message.
+    """
+    if update.callback_query is not None:
+        await update.callback_query.answer(err.message, show_alert=True)
+    elif update.effective_message is not None:
+        await update.effective_message.reply_text(err.message)
+
+async def record_user_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Runs before every other handler (group -1), so the names there are at most one update old
+    if update.effective_user is None:
+        return
+    users: UserDirectory = context.bot_data["user_directory"]
+    try:
+        await users.record(update.effective_user)
+    except errors.DatabaseConnectionError as e:
+        # Best effort: the name is recorded with the user's next update, and nobody should get a reply for it
+        logger.warning(f"Could not record user {update.effective_user.id}: {e.__cause__ or e}")
+
+async def chat_member_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Promotions, demotions and departures keep the cached admin lists current
+    admins: AdminCache = context.bot_data["admin_cache"]
+    admins.member_updated(update.chat_member or update.my_chat_member, bot_id=context.bot.id)
+
 async def start_khetma_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
@@ -21,9 +84,9 @@ async def start_khetma_command(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text(errors.NotAdminError().message)
         return
         
-    storage : KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
-    khetma = storage.create_new_khetma(chat_id)
+    khetma = await storage.create_new_khetma(chat_id)
 
     khetma_message = await context.bot.send_message(
         chat_id=chat_id,
@@ -43,18 +106,14 @@ async def start_khetma_command(update: Update, context: ContextTypes.DEFAULT_TYP
         pass
 
 async def finish_message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # Reached through intent_router, which only routes replies containing "تم"/"تمت"
     message_text = update.message.text or ""
-    words = message_text.split()
-
-    if not ({"تم", "تمت"} & set(words)):
-        return
-
     chat_id = update.effective_chat.id
     user = update.effective_user
-    username = await utilities.get_username(chat_id, user.id, context)
+    username = UserDirectory.display_name(user.username, user.first_name)
     user_message = update.message
     reply_text = ""
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
     if not user_message.reply_to_message:
         return
@@ -65,112 +124,121 @@ async def finish_message_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     khetma_num = numbers_in_text[0]
-    khetma_obj = storage.get_khetma(khetma_number=khetma_num, chat_id=chat_id)
+    khetma_obj = await storage.get_khetma(khetma_number=khetma_num, chat_id=chat_id)
     if not khetma_obj:
         await user_message.reply_text(errors.KhetmaNotFoundError().message)
         return
+    # get_khetma also finds archived khetmat, which can't be written to any more
+    if khetma_obj.status == Khetma.khetma_status.FINISHED:
+        await user_message.reply_text(errors.KhetmaCompletedError().message)
+        return
 
     chapters = utilities.extract_arabic_numbers(message_text)
     if not chapters:
         reply_text = errors.NoOwnedChapters().message
+        updated_khetma = khetma_obj
     else:
-        for chapter_num in chapters:
-            try:
-                if storage.finish_chapter(khetma_obj.khetma_id, int(chapter_num), user.id, username):
-                    reply_text += responses.TEXT_TEMPLATES["finish_chapter_body"].format(
-                        chapter_num=chapter_num,
-                        khetma_num=khetma_obj.number
-                    ) + "\n"
-            except (errors.DatabaseConnectionError, errors.ChapterFinishedError, errors.ChapterNotOwnedError) as err:
+        # One transaction for all the numbers, and it hands back the updated khetma
+        try:
+            updated_khetma, outcomes = await storage.finish_chapters(khetma_obj.khetma_id, chapters, user.id, username)
+        except errors.KhetmaNotFoundError as e: # archived since it was read
+            await user_message.reply_text(e.message)
+            return
+        for chapter_num, err in outcomes.items():
+            if err is None:
+                reply_text += responses.TEXT_TEMPLATES["finish_chapter_body"].format(
+                    chapter_num=chapter_num,
+                    khetma_num=khetma_obj.number
+                ) + "\n"
+            else:
                 reply_text += err.message + "\n"
         reply_text += responses.TEXT_TEMPLATES["finish_chapter_footer"]
 
-    updated_khetma = storage.get_khetma(khetma_id=khetma_obj.khetma_id)
-    new_keyboard = inline_keyboards.render_khetma_keyboard(updated_khetma)
-    await user_message.reply_to_message.edit_text(
-        text=utilities.create_khetma_message(updated_khetma),
-        reply_markup=new_keyboard,
-        parse_mode="Markdown"
-    )
+    _schedule_khetma_edit(context, user_message.reply_to_message, updated_khetma)
 
-    if updated_khetma.is_finished:
-        updated_khetma.status = Khetma.khetma_status.FINISHED
-        storage.update_khetma(updated_khetma)
-        completed_khetma_text = responses.TEXT_TEMPLATES["completed_khetma"].format(khetma_num=updated_khetma.number)
-        await user_message.reply_to_message.edit_text(
-            text=utilities.create_khetma_message(updated_khetma),
-            parse_mode="Markdown"
-        )
+    completed_khetma = await _complete_khetma(storage, updated_khetma)
+    if completed_khetma is not None:
+        completed_khetma_text = responses.TEXT_TEMPLATES["completed_khetma"].format(khetma_num=completed_khetma.number)
+        _schedule_khetma_edit(context, user_message.reply_to_message, completed_khetma, keyboard=False)
         await context.bot.send_message(chat_id, completed_khetma_text, parse_mode="Markdown")
 
     if reply_text:
         await update.message.reply_text(reply_text)
 
 async def my_chapters_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_text = update.message.text or ""
-    words = set(message_text.split())
-
-    if not ({"أجزائي", "اجزائي"} & words):
-        return
-
     chat_id = update.effective_chat.id
     user = update.effective_user
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
     try:
-        chapters = storage.get_chapters_by_user(user.id, chat_id)
+        chapters_by_khetma = await storage.get_user_chapters_by_khetma(user.id, chat_id)
     except errors.NoOwnedChapters:
         await update.message.reply_text(errors.NoOwnedChapters().message)
         return
 
-    # Group chapters by khetma
-    khetma_ids = list({ch.parent_khetma for ch in chapters})
-    khetma_cache = storage.get_khetmat_by_ids(khetma_ids)
-
     reply_text = ""
-    for khetma_id, khetma_number in khetma_cache.items():
-        khetma_chapters = [ch for ch in chapters if ch.parent_khetma == khetma_id]
+    for khetma_number, khetma_chapters in chapters_by_khetma.items():
         chapters_text = " و ".join(str(ch.number) for ch in khetma_chapters)
         reply_text += f"الختمة {khetma_number}: الجزء {chapters_text}\n"
 
     await update.message.reply_text(reply_text.strip())
 
 async def available_chapters_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_text = update.message.text or ""
-
-    if not (("أجزاء" in message_text or "اجزاء" in message_text) and "في" in message_text):
-        return
-
     chat_id = update.effective_chat.id
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
-    khetmat = storage.get_active_khetmat(chat_id)
+    khetmat = await storage.get_active_khetmat(chat_id)
     if not khetmat:
         await update.message.reply_text("لا توجد ختمة نشطة في هذه المجموعة.")
         return
 
     reply_text = ""
     for khetma in khetmat:
-        available = khetma.get_available_chapters()
+        available = khetma.available_numbers()
         if not available:
             reply_text += f"الختمة {khetma.number}: لا توجد أجزاء متاحة\n"
         else:
-            chapters_text = " و ".join(str(ch.number) for ch in available)
+            chapters_text = " و ".join(str(number) for number in available)
             reply_text += f"الختمة {khetma.number}: {chapters_text}\n"
 
     await update.message.reply_text(reply_text.strip())
 
-async def admin_withdraw_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_text = update.message.text or ""
-    words = set(message_text.split())
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.effective_chat.id
+    user = update.effective_user
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
+    users: UserDirectory = context.bot_data["user_directory"]
+
+    # Both read the precomputed reading_stats rows, not the chapters history
+    leaderboard = await storage.get_reading_leaderboard(chat_id)
+    own_stats = await storage.get_reading_stats(chat_id, user.id)
+    names = await users.display_names(row["user_id"] for row in leaderboard)
 
-    if "سحب" not in words:
+    if not leaderboard:
+        await update.message.reply_text(responses.TEXT_TEMPLATES["stats_empty"])
         return
 
+    reply_text = responses.TEXT_TEMPLATES["stats_header"] + "\n"
+    for rank, row in enumerate(leaderboard, start=1):
+        reply_text += responses.TEXT_TEMPLATES["stats_row"].format(
+            rank=rank,
+            username=names.get(row["user_id"]) or row["username"] or row["user_id"],
+            chapters=row["chapters_finished"],
+            khetmat=row["khetmat_participated"]
+        ) + "\n"
+    reply_text += "\n" + responses.TEXT_TEMPLATES["stats_own"].format(
+        chapters=own_stats["chapters_finished"],
+        khetmat=own_stats["khetmat_participated"]
+    )
+
+    await update.message.reply_text(reply_text)
+
+async def admin_withdraw_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    message_text = update.message.text or ""
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
     user_message = update.message
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
     if not await utilities.is_user_admin(chat_id, user_id, context):
         await user_message.reply_text(errors.NotAdminError().message)
@@ -186,10 +254,14 @@ async def admin_withdraw_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     khetma_num = numbers_in_text[0]
-    khetma_obj = storage.get_khetma(khetma_number=khetma_num, chat_id=chat_id)
+    khetma_obj = await storage.get_khetma(khetma_number=khetma_num, chat_id=chat_id)
     if not khetma_obj:
         await user_message.reply_text(errors.KhetmaNotFoundError().message)
         return
+    # get_khetma also finds archived khetmat, which can't be written to any more
+    if khetma_obj.status == Khetma.khetma_status.FINISHED:
+        await user_message.reply_text(errors.KhetmaCompletedError().message)
+        return
 
     chapters = utilities.extract_arabic_numbers(message_text)
     if not chapters:
@@ -197,47 +269,45 @@ async def admin_withdraw_handler(update: Update, context: ContextTypes.DEFAULT_T
         return
 
     reply_text = ""
-    action_happened = False
-    for chapter_num in chapters:
-        try:
-            storage.withdraw_chapter(khetma_obj.khetma_id, int(chapter_num), user_id, is_admin=True)
+    try:
+        updated_khetma, outcomes = await storage.withdraw_chapters(khetma_obj.khetma_id, chapters, user_id, is_admin=True)
+    except errors.KhetmaNotFoundError as e: # archived since it was read
+        await user_message.reply_text(e.message)
+        return
+    for chapter_num, err in outcomes.items():
+        if err is None:
             reply_text += f"✅ تم سحب الجزء {chapter_num} من الختمة {khetma_obj.number}\n"
-            action_happened = True
-        except (errors.ChapterAlreadyEmptyError, errors.DatabaseConnectionError, errors.ChapterFinishedError) as err:
+        else:
             reply_text += f"{err.message}\n"
 
-    if action_happened:
-        updated_khetma = storage.get_khetma(khetma_id=khetma_obj.khetma_id)
-        new_keyboard = inline_keyboards.render_khetma_keyboard(updated_khetma)
-        await user_message.reply_to_message.edit_text(
-            text=utilities.create_khetma_message(updated_khetma),
-            reply_markup=new_keyboard,
-            parse_mode="Markdown"
-        )
+    if any(err is None for err in outcomes.values()):
+        _schedule_khetma_edit(context, user_message.reply_to_message, updated_khetma)
 
     if reply_text:
         await user_message.reply_text(reply_text.strip())
 
 async def remind_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    message_text = update.message.text or ""
-    words = set(message_text.split())
-
-    if "تذكير" not in words:
-        return
-
     chat_id = update.effective_chat.id
     user_id = update.effective_user.id
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
+    users: UserDirectory = context.bot_data["user_directory"]
 
     if not await utilities.is_user_admin(chat_id, user_id, context):
         await update.message.reply_text(errors.NotAdminError().message)
         return
 
-    khetmat = storage.get_active_khetmat(chat_id)
+    khetmat = await storage.get_active_khetmat(chat_id)
     if not khetmat:
         await update.message.reply_text("لا توجد ختمة نشطة في هذه المجموعة.")
         return
 
+    # Every distinct owner is resolved up front: one users table lookup, then concurrent
+    # (bounded) Telegram lookups for the few it doesn't know
+    names = await users.resolve(
+        context.bot, chat_id,
+        (chapter.owner_id for khetma in khetmat for chapter in khetma.get_reserved_chapters())
+    )
+
     reply_text = ""
     for khetma in khetmat:
         reserved = khetma.get_reserved_chapters()
@@ -246,7 +316,7 @@ async def remind_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
         reply_text += f"الختمة رقم {khetma.number}:\n"
         for chapter in reserved:
-            username = await utilities.get_username(chat_id, chapter.owner_id, context)
+            username = names.get(chapter.owner_id) or chapter.owner_username
             reply_text += f"• الجزء {chapter.number} ← {username}\n"
         reply_text += "\n"
 
@@ -255,13 +325,15 @@ async def remind_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     header = "📢 تذكير بالأجزاء غير المكتملة:\n━━━━━━━━━━━━━━━━━━\n"
-    await update.message.reply_text(header + reply_text.strip())
+    # Large groups can reserve more than one message holds
+    for part in utilities.split_message(header + reply_text.strip()):
+        await update.message.reply_text(part)
 
 
-async def _handle_finish_all(query, user, chat_id, storage: KhetmaStorage, context):
+async def _handle_finish_all(query, user, chat_id, storage: AsyncKhetmaStorage, context):
     khetma_id = int(query.data.split("_")[2])
     try:
-        finished_chapters = storage.finish_all_user_chapters(chat_id, user.id, khetma_id)
+        finished_chapters, updated_khetma = await storage.finish_all_user_chapters_returning(chat_id, user.id, khetma_id)
     except errors.NoOwnedChapters:
         await query.answer("لا يوجد أي أجزاء محجوزة باسمك ⛔", show_alert=True)
         return
@@ -272,32 +344,21 @@ async def _handle_finish_all(query, user, chat_id, storage: KhetmaStorage, conte
     chapters_text = " و ".join(str(ch.number) for ch in finished_chapters)
     await query.answer(f"تم إنهاء الأجزاء: {chapters_text} ✅", show_alert=True)
 
-    updated_khetma = storage.get_khetma(khetma_id=khetma_id)
-    new_keyboard = inline_keyboards.render_khetma_keyboard(updated_khetma)
-    await query.edit_message_text(
-        text=utilities.create_khetma_message(updated_khetma),
-        reply_markup=new_keyboard,
-        parse_mode="Markdown"
-    )
+    _schedule_khetma_edit(context, query.message, updated_khetma)
 
-    if updated_khetma.is_finished:
-        updated_khetma.status = Khetma.khetma_status.FINISHED
-        storage.update_khetma(updated_khetma)
+    completed_khetma = await _complete_khetma(storage, updated_khetma)
+    if completed_khetma is not None:
         completed_khetma_text = responses.TEXT_TEMPLATES["completed_khetma"].format(
-            khetma_num=updated_khetma.number
-        )
-        await query.edit_message_text(
-            text=utilities.create_khetma_message(updated_khetma),
-            reply_markup=None,
-            parse_mode="Markdown"
+            khetma_num=completed_khetma.number
         )
+        _schedule_khetma_edit(context, query.message, completed_khetma, keyboard=False)
         await context.bot.send_message(chat_id, completed_khetma_text, parse_mode="Markdown")
 
 
-async def _handle_my_chapters(query, user, storage: KhetmaStorage):
+async def _handle_my_chapters(query, user, storage: AsyncKhetmaStorage):
     khetma_id = int(query.data.split("_")[2])
     try:
-        chapters = storage.get_chapters_by_user(user.id, khetma_id=khetma_id)
+        chapters = await storage.get_chapters_by_user(user.id, khetma_id=khetma_id)
     except errors.NoOwnedChapters:
         await query.answer("لا يوجد أي أجزاء محجوزة باسمك ⛔", show_alert=True)
         return
@@ -306,8 +367,8 @@ async def _handle_my_chapters(query, user, storage: KhetmaStorage):
     await query.answer(f"أجزاؤك في هذه الختمة: {chapters_text} 📋", show_alert=True)
 
 
-async def _handle_info(query, khetma_id, chapter_number, storage: KhetmaStorage):
-    chapter = storage.get_chapter(khetma_id=khetma_id, chapter_number=chapter_number)
+async def _handle_info(query, khetma_id, chapter_number, storage: AsyncKhetmaStorage, users: UserDirectory):
+    chapter = await storage.get_chapter(khetma_id=khetma_id, chapter_number=chapter_number)
     if not chapter:
         await query.answer(errors.KhetmaNotFoundError().message, show_alert=True)
         return
@@ -317,8 +378,9 @@ async def _handle_info(query, khetma_id, chapter_number, storage: KhetmaStorage)
         return
 
     if chapter.is_reserved:
+        names = await users.display_names([chapter.owner_id])
         await query.answer(
-            f"الجزء {chapter_number} محجوز بواسطة {chapter.owner_username}",
+            f"الجزء {chapter_number} محجوز بواسطة {names.get(chapter.owner_id) or chapter.owner_username}",
             show_alert=True
         )
         return
@@ -326,29 +388,24 @@ async def _handle_info(query, khetma_id, chapter_number, storage: KhetmaStorage)
     return chapter  # returns chapter only if it's available for reservation
 
 
-async def _handle_reserve(query, user, chat_id, khetma_id, chapter_number, storage: KhetmaStorage, context):
+async def _handle_reserve(query, user, chat_id, khetma_id, chapter_number, storage: AsyncKhetmaStorage, context):
     try:
-        storage.reserve_chapter(
+        updated_khetma = await storage.reserve_chapter_returning(
             khetma_id, chapter_number, user.id,
-            await utilities.get_username(chat_id, user.id, context)
+            UserDirectory.display_name(user.username, user.first_name)
         )
     except (errors.ChapterAlreadyReservedError, errors.ChapterFinishedError) as e:
         await query.answer(e.message, show_alert=True)
         return
 
-    updated_khetma = storage.get_khetma(khetma_id=khetma_id)
-    new_keyboard = inline_keyboards.render_khetma_keyboard(updated_khetma)
-    await query.edit_message_text(
-        text=utilities.create_khetma_message(updated_khetma),
-        reply_markup=new_keyboard,
-        parse_mode="Markdown"
-    )
+    # The tap is acknowledged right away; the grid catches up with the next coalesced edit
     await query.answer()
+    _schedule_khetma_edit(context, query.message, updated_khetma)
 
-async def _handle_withdraw_all(query, user, chat_id, storage: KhetmaStorage, context):
+async def _handle_withdraw_all(query, user, chat_id, storage: AsyncKhetmaStorage, context):
     khetma_id = int(query.data.split("_")[2])
     try:
-        withdrawn_chapters = storage.withdraw_all_user_chapters(chat_id, user.id, khetma_id)
+        withdrawn_chapters, updated_khetma = await storage.withdraw_all_user_chapters_returning(chat_id, user.id, khetma_id)
     except errors.NoOwnedChapters:
         await query.answer("لا يوجد أي أجزاء محجوزة باسمك ⛔", show_alert=True)
         return
@@ -356,19 +413,13 @@ async def _handle_withdraw_all(query, user, chat_id, storage: KhetmaStorage, con
     chapters_text = " و ".join(str(ch.number) for ch in withdrawn_chapters)
     await query.answer(f"تم سحب الأجزاء: {chapters_text} 🔄", show_alert=True)
 
-    updated_khetma = storage.get_khetma(khetma_id=khetma_id)
-    new_keyboard = inline_keyboards.render_khetma_keyboard(updated_khetma)
-    await query.edit_message_text(
-        text=utilities.create_khetma_message(updated_khetma),
-        reply_markup=new_keyboard,
-        parse_mode="Markdown"
-    )
+    _schedule_khetma_edit(context, query.message, updated_khetma)
 
 async def handle_khetma_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user = query.from_user
     chat_id = update.effective_chat.id
-    storage: KhetmaStorage = context.bot_data["khetma_storage"]
+    storage: AsyncKhetmaStorage = context.bot_data["khetma_storage"]
 
     if query.data.startswith("finish_all_"):
         await _handle_finish_all(query, user, chat_id, storage, context)
@@ -387,9 +438,18 @@ async def handle_khetma_buttons(update: Update, context: ContextTypes.DEFAULT_TY
     khetma_id = int(callback_data[1])
     chapter_number = int(callback_data[2])
 
-    chapter = await _handle_info(query, khetma_id, chapter_number, storage)
+    chapter = await _handle_info(query, khetma_id, chapter_number, storage, context.bot_data["user_directory"])
     if chapter is None:
         return  # info was shown or error was answered
 
     await _handle_reserve(query, user, chat_id, khetma_id, chapter_number, storage, context)
-   
\ No newline at end of file
+   
+# The single entry point for group text messages, in the order the old handler groups ran.
+# "تم" only counts on a reply, so "تم أجزائي" sent on its own still lists the user's chapters.
+intent_router = IntentRouter([
+    Intent("finish", finish_message_handler, words=["تم", "تمت"], replies_only=True),
+    Intent("my_chapters", my_chapters_handler, words=["أجزائي"]),
+    Intent("available_chapters", available_chapters_handler, fragments=["أجزاء", "في"]),
+    Intent("withdraw", admin_withdraw_handler, words=["سحب"]),
+    Intent("remind", remind_handler, words=["تذكير"]),
+])
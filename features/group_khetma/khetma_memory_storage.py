@@ -0,0 +1,436 @@
+import threading
+from datetime import datetime, timezone
+
+# Local modules
+import features.group_khetma.errors as errors
+from features.group_khetma.khetma_storage import unique_chapter_numbers, finish_outcomes, withdraw_outcomes
+from features.group_khetma.class_khetma import Khetma
+from features.group_khetma.class_chapter import Chapter
+
+class InMemoryKhetmaStorage:
+    """
+    The KhetmaStorage contract (same methods, results and domain errors) on plain dicts.
+
+    One lock guards everything, and every mutation checks before it changes anything,
+    so each call is atomic like its single-statement SQL counterpart. Callers only ever
+    get copies. Meant for tests, benchmarks and trying the bot out without a database;
+    nothing survives a restart.
+    """
+    db = None # no database behind it (AsyncKhetmaStorage sizes its executor from this)
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._chats = {}        # chat_id -> counters, like the chats row
+        self._khetmat = {}      # khetma_id -> Khetma (the stored state, never handed out)
+        self._archive = {}      # khetma_id -> Khetma, for archived FINISHED khetmat
+        self._reading_stats = {} # (chat_id, user_id) -> counters, like the reading_stats row
+        self._users = {}        # user_id -> names, like the users row
+        self._chapter_ids = {}  # chapter_id -> (khetma_id, chapter_number)
+        self._last_khetma_id = 0
+
+    # ==========================================
+    # HELPERS (caller holds the lock)
+    # ==========================================
+
+    @staticmethod
+    def _empty_counters() -> dict:
+        return {"last_khetma_number": 0, "active_khetmat_count": 0, "finished_khetmat_count": 0}
+
+    def _stored_khetma(self, khetma_id) -> Khetma:
+        khetma = self._khetmat.get(khetma_id)
+        if khetma is None:
+            raise errors.KhetmaNotFoundError()
+        return khetma
+
+    def _stored_chapter(self, khetma_id, chapter_number) -> Chapter:
+        khetma = self._khetmat.get(khetma_id)
+        chapter = khetma.get_chapter(chapter_number) if khetma is not None else None
+        if chapter is None:
+            raise errors.ChapterNotFoundError()
+        return chapter
+
+    def _set_chapter(self, chapter: Chapter, status, owner_id, owner_username):
+        """Changes a stored chapter, moving the reading stats the way the SQL triggers do."""
+        counted_before = chapter.owner_id if chapter.is_finished else None
+        chapter.status, chapter.owner_id, chapter.owner_username = status, owner_id, owner_username
+        counted_after = chapter.owner_id if chapter.is_finished else None
+        if counted_before == counted_after:
+            return
+
+        khetma = self._khetmat[chapter.parent_khetma]
+        finished_by = lambda user_id: sum(1 for ch in khetma.get_finished_chapters() if ch.owner_id == user_id)
+
+        if counted_before is not None:
+            stats = self._reading_stats[(khetma.chat_id, counted_before)]
+            stats["chapters_finished"] -= 1
+            stats["khetmat_participated"] -= finished_by(counted_before) == 0
+        if counted_after is not None:
+            stats = self._reading_stats.setdefault((khetma.chat_id, counted_after), {
+                "user_id": counted_after, "username": None, "chapters_finished": 0, "khetmat_participated": 0
+            })
+            stats["username"] = owner_username or stats["username"]
+            stats["chapters_finished"] += 1
+            stats["khetmat_participated"] += finished_by(counted_after) == 1
+
+    def _bump_versions(self, khetma_ids):
+        """One version step per call per khetma it changed (like one statement on PostgreSQL)."""
+        for khetma_id in dict.fromkeys(khetma_ids):
+            self._khetmat[khetma_id].version += 1
+
+    def _chat_khetma_ids(self, chat_id) -> list[int]:
+        return [khetma_id for khetma_id, khetma in self._khetmat.items() if khetma.chat_id == chat_id]
+
+    def _user_reserved_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        khetma_ids = self._chat_khetma_ids(chat_id)
+        if khetma_id:
+            khetma_ids = [candidate for candidate in khetma_ids if candidate == khetma_id]
+        return [
+            chapter
+            for candidate in khetma_ids
+            for chapter in self._khetmat[candidate].get_reserved_chapters()
+            if chapter.owner_id == user_id
+        ]
+
+    # ==========================================
+    # CREATION
+    # ==========================================
+
+    def create_new_khetma(self, chat_id) -> Khetma:
+        return self.create_new_khetmat([chat_id])[0]
+
+    def create_new_khetmat(self, chat_ids: list) -> list[Khetma]:
+        khetmat = []
+        with self._lock:
+            for chat_id in dict.fromkeys(chat_ids):
+                counters = self._chats.setdefault(chat_id, self._empty_counters())
+                counters["last_khetma_number"] += 1
+                counters["active_khetmat_count"] += 1
+
+                self._last_khetma_id += 1
+                khetma = Khetma(self._last_khetma_id, counters["last_khetma_number"], Khetma.khetma_status.ACTIVE, chat_id=chat_id)
+                for chapter in khetma.chapters:
+                    self._chapter_ids[len(self._chapter_ids) + 1] = (khetma.khetma_id, chapter.number)
+
+                self._khetmat[khetma.khetma_id] = khetma
+                khetmat.append(khetma.copy())
+        return khetmat
+
+    # ==========================================
+    # READS
+    # ==========================================
+
+    def get_khetma(self, khetma_id=None, khetma_number=None, chat_id=None) -> Khetma | None:
+        if not (khetma_id or khetma_number or chat_id):
+            return None
+
+        with self._lock:
+            for khetma in (*self._khetmat.values(), *self._archive.values()):
+                if khetma_id and khetma.khetma_id != khetma_id:
+                    continue
+                if khetma_number and khetma.number != khetma_number:
+                    continue
+                if chat_id and khetma.chat_id != chat_id:
+                    continue
+                return khetma.copy()
+        return None
+
+    def get_khetmat_by_ids(self, khetma_ids: list) -> dict:
+        """Returns a dict of {khetma_id: khetma_number} for a list of IDs."""
+        with self._lock:
+            stored = {**self._archive, **self._khetmat}
+            return {khetma_id: stored[khetma_id].number for khetma_id in khetma_ids if khetma_id in stored}
+
+    def get_active_khetmat(self, chat_id) -> list[Khetma]:
+        with self._lock:
+            active = [
+                khetma.copy() for khetma in self._khetmat.values()
+                if khetma.chat_id == chat_id and khetma.status == Khetma.khetma_status.ACTIVE
+            ]
+        return sorted(active, key=lambda khetma: khetma.number)
+
+    def get_chapter(self, chapter_id=None, khetma_id=None, chapter_number=None) -> Chapter | None:
+        if not (chapter_id or khetma_id or chapter_number):
+            return None
+
+        with self._lock:
+            for candidate_id, (stored_khetma_id, number) in self._chapter_ids.items():
+                if chapter_id and candidate_id != chapter_id:
+                    continue
+                if khetma_id and stored_khetma_id != khetma_id:
+                    continue
+                if chapter_number and number != chapter_number:
+                    continue
+                return self._khetmat[stored_khetma_id].get_chapter(number).copy()
+        return None
+
+    def get_chapters_by_user(self, user_id, chat_id=None, khetma_id=None) -> list[Chapter]:
+        with self._lock:
+            chapters = [
+                chapter.copy()
+                for khetma in self._khetmat.values()
+                if (not chat_id or khetma.chat_id == chat_id) and (not khetma_id or khetma.khetma_id == khetma_id)
+                for chapter in khetma.get_reserved_chapters()
+                if chapter.owner_id == user_id
+            ]
+
+        if not chapters:
+            raise errors.NoOwnedChapters()
+        return chapters
+
+    def get_user_chapters_by_khetma(self, user_id, chat_id) -> dict[int, list[Chapter]]:
+        grouped = {}
+        with self._lock:
+            for khetma in sorted(self._khetmat.values(), key=lambda khetma: khetma.number):
+                if khetma.chat_id != chat_id:
+                    continue
+                owned = [chapter.copy() for chapter in khetma.get_reserved_chapters() if chapter.owner_id == user_id]
+                if owned:
+                    grouped[khetma.number] = owned
+
+        if not grouped:
+            raise errors.NoOwnedChapters()
+        return grouped
+
+    def get_chat_counters(self, chat_id) -> dict:
+        with self._lock:
+            return dict(self._chats.get(chat_id, self._empty_counters()))
+
+    def get_finished_khetmat(self, chat_id, limit=10) -> list[Khetma]:
+        with self._lock:
+            finished = [
+                khetma.copy() for khetma in (*self._khetmat.values(), *self._archive.values())
+                if khetma.chat_id == chat_id and khetma.status == Khetma.khetma_status.FINISHED
+            ]
+        return sorted(finished, key=lambda khetma: khetma.number, reverse=True)[:limit]
+
+    def get_reading_stats(self, chat_id, user_id) -> dict:
+        with self._lock:
+            stats = self._reading_stats.get((chat_id, user_id))
+            if stats is None:
+                return {"user_id": user_id, "username": None, "chapters_finished": 0, "khetmat_participated": 0}
+            return dict(stats)
+
+    def get_reading_leaderboard(self, chat_id, limit=10) -> list[dict]:
+        with self._lock:
+            rows = [
+                dict(stats) for (stats_chat_id, _), stats in self._reading_stats.items()
+                if stats_chat_id == chat_id and stats["chapters_finished"] > 0
+            ]
+        rows.sort(key=lambda row: (-row["chapters_finished"], -row["khetmat_participated"], row["user_id"]))
+        return rows[:limit]
+
+    def calc_finished_khetmat_number(self, chat_id) -> int:
+        return self.get_chat_counters(chat_id)["finished_khetmat_count"] + 1
+
+    def calc_next_khetma_number(self, chat_id: int) -> int:
+        return self.get_chat_counters(chat_id)["last_khetma_number"] + 1
+
+    # ==========================================
+    # KHETMA / CHAPTER UPDATES
+    # ==========================================
+
+    def update_khetma(self, khetma: Khetma, expected_version=None):
+        with self._lock:
+            stored = self._khetmat.get(khetma.khetma_id)
+            if stored is None:
+                return False
+            if expected_version is not None and stored.version != expected_version:
+                raise errors.StaleKhetmaError()
+
+            counters = self._chats[stored.chat_id]
+            for status, counter in ((Khetma.khetma_status.ACTIVE, "active_khetmat_count"),
+                                    (Khetma.khetma_status.FINISHED, "finished_khetmat_count")):
+                counters[counter] += (khetma.status == status) - (stored.status == status)
+            counters["last_khetma_number"] = max(counters["last_khetma_number"], khetma.number)
+
+            stored.status = khetma.status
+            stored.number = khetma.number
+            stored.version += 1
+            khetma.version = stored.version
+            return True
+
+    def update_chapters(self, chapters: list[Chapter] | Chapter, expected_version=None) -> bool:
+        if isinstance(chapters, Chapter):
+            chapters = [chapters]
+
+        khetma_ids = {chapter.parent_khetma for chapter in chapters}
+        if expected_version is not None and len(khetma_ids) != 1:
+            raise ValueError("expected_version needs the chapters of a single khetma")
+
+        updated = []
+        with self._lock:
+            if expected_version is not None:
+                khetma = self._khetmat.get(next(iter(khetma_ids)))
+                if khetma is None:
+                    return False
+                if khetma.version != expected_version:
+                    raise errors.StaleKhetmaError()
+
+            for chapter in chapters:
+                khetma = self._khetmat.get(chapter.parent_khetma)
+                stored = khetma.get_chapter(chapter.number) if khetma is not None else None
+                if stored is None:
+                    continue
+                self._set_chapter(stored, chapter.status, chapter.owner_id, chapter.owner_username)
+                updated.append(chapter.parent_khetma)
+            self._bump_versions(updated)
+        return bool(updated)
+
+    def get_khetma_version(self, khetma_id) -> int | None:
+        with self._lock:
+            khetma = self._khetmat.get(khetma_id) or self._archive.get(khetma_id)
+            return khetma.version if khetma is not None else None
+
+    # ==========================================
+    # RESERVE
+    # ==========================================
+
+    def reserve_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        with self._lock:
+            chapter = self._stored_chapter(khetma_id, chapter_number)
+            if chapter.is_reserved:
+                raise errors.ChapterAlreadyReservedError()
+            elif chapter.is_finished:
+                raise errors.ChapterFinishedError()
+            chapter.reserve(user_id, username)
+            self._bump_versions([khetma_id])
+            return True
+
+    def reserve_chapter_returning(self, khetma_id, chapter_number, user_id, username) -> Khetma:
+        with self._lock:
+            self._stored_khetma(khetma_id)
+            self.reserve_chapter(khetma_id, chapter_number, user_id, username)
+            return self._khetmat[khetma_id].copy()
+
+    # ==========================================
+    # WITHDRAW
+    # ==========================================
+
+    def withdraw_chapter(self, khetma_id, chapter_number, user_id, is_admin=False) -> bool:
+        with self._lock:
+            chapter = self._stored_chapter(khetma_id, chapter_number)
+            if chapter.is_available:
+                raise errors.ChapterAlreadyEmptyError()
+            elif chapter.is_finished:
+                raise errors.ChapterFinishedError()
+            elif not is_admin and chapter.owner_id != user_id:
+                raise errors.ChapterNotOwnedError()
+            chapter.mark_empty()
+            self._bump_versions([khetma_id])
+            return True
+
+    def withdraw_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        with self._lock:
+            changed = self._user_reserved_chapters(chat_id, user_id, khetma_id)
+            if not changed:
+                raise errors.NoOwnedChapters()
+            for chapter in changed:
+                chapter.mark_empty()
+            self._bump_versions(chapter.parent_khetma for chapter in changed)
+            return [chapter.copy() for chapter in changed]
+
+    def withdraw_chapters(self, khetma_id, chapter_numbers: list[int], user_id, is_admin=False) -> tuple[Khetma, dict]:
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+
+        with self._lock:
+            khetma = self._stored_khetma(khetma_id)
+            changed = set()
+            for chapter in (khetma.get_chapter(num) for num in chapter_numbers):
+                if chapter is not None and chapter.is_reserved and (is_admin or chapter.owner_id == user_id):
+                    chapter.mark_empty()
+                    changed.add(chapter.number)
+            if changed:
+                self._bump_versions([khetma_id])
+            khetma = khetma.copy()
+
+        return khetma, withdraw_outcomes(khetma, chapter_numbers, changed)
+
+    def withdraw_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self._lock:
+            self._stored_khetma(khetma_id)
+            changed = self.withdraw_all_user_chapters(chat_id, user_id, khetma_id)
+            khetma = self._khetmat[khetma_id].copy()
+        return [khetma.get_chapter(chapter.number) for chapter in changed], khetma
+
+    # ==========================================
+    # FINISH
+    # ==========================================
+
+    def finish_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        with self._lock:
+            chapter = self._stored_chapter(khetma_id, chapter_number)
+            if chapter.is_finished:
+                raise errors.ChapterFinishedError()
+            elif chapter.is_reserved and chapter.owner_id != user_id:
+                raise errors.ChapterNotOwnedError()
+            self._set_chapter(chapter, Chapter.chapter_status.FINISHED, user_id, username)
+            self._bump_versions([khetma_id])
+            return True
+
+    def finish_chapters(self, khetma_id, chapter_numbers: list[int], user_id, username) -> tuple[Khetma, dict]:
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+
+        with self._lock:
+            khetma = self._stored_khetma(khetma_id)
+            changed = set()
+            for chapter in (khetma.get_chapter(num) for num in chapter_numbers):
+                if chapter is not None and (chapter.is_available or (chapter.is_reserved and chapter.owner_id == user_id)):
+                    self._set_chapter(chapter, Chapter.chapter_status.FINISHED, user_id, username)
+                    changed.add(chapter.number)
+            if changed:
+                self._bump_versions([khetma_id])
+            khetma = khetma.copy()
+
+        return khetma, finish_outcomes(khetma, chapter_numbers, changed)
+
+    def finish_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        with self._lock:
+            changed = self._user_reserved_chapters(chat_id, user_id, khetma_id)
+            if not changed:
+                raise errors.NoOwnedChapters()
+            for chapter in changed:
+                self._set_chapter(chapter, Chapter.chapter_status.FINISHED, chapter.owner_id, chapter.owner_username)
+            self._bump_versions(chapter.parent_khetma for chapter in changed)
+            return [chapter.copy() for chapter in changed]
+
+    def finish_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self._lock:
+            self._stored_khetma(khetma_id)
+            changed = self.finish_all_user_chapters(chat_id, user_id, khetma_id)
+            khetma = self._khetmat[khetma_id].copy()
+        return [khetma.get_chapter(chapter.number) for chapter in changed], khetma
+
+    # ==========================================
+    # ARCHIVE
+    # ==========================================
+
+    def archive_finished_khetmat(self, chat_id=None, batch_size=500) -> int:
+        with self._lock:
+            picked = [
+                khetma_id for khetma_id, khetma in sorted(self._khetmat.items())
+                if khetma.status == Khetma.khetma_status.FINISHED and (not chat_id or khetma.chat_id == chat_id)
+            ][:batch_size]
+
+            for khetma_id in picked:
+                self._archive[khetma_id] = self._khetmat.pop(khetma_id)
+            # Archived chapters are no longer found by get_chapter, like on the SQL backends
+            self._chapter_ids = {
+                chapter_id: location for chapter_id, location in self._chapter_ids.items()
+                if location[0] in self._khetmat
+            }
+            return len(picked)
+
+    # ==========================================
+    # USERS
+    # ==========================================
+
+    def save_user(self, user_id, username, first_name):
+        with self._lock:
+            self._users[user_id] = {
+                "user_id": user_id, "username": username, "first_name": first_name,
+                "last_seen": datetime.now(timezone.utc)
+            }
+
+    def get_users(self, user_ids: list) -> dict[int, dict]:
+        with self._lock:
+            return {user_id: dict(self._users[user_id]) for user_id in user_ids if user_id in self._users}
@@ -0,0 +1,593 @@
+from storage_manager import Migration
+
+COMPONENT = "khetma"
+
+# LISTEN/NOTIFY channel carrying {"khetma_id", "chat_id"?, "version", "origin"} payloads
+# ("version" is the khetma's version after the change, null once it's deleted)
+CHANGES_CHANNEL = "khetma_changes"
+
+def _create_index_concurrently(index_name: str, definition: str) -> list[str]:
+    """
+    Statements that build an index without blocking writes.
+    A failed CONCURRENTLY build leaves an INVALID index behind, so drop that first to stay re-runnable.
+    """
+    return [
+        f'''
+            DO $$
+            BEGIN
+                IF EXISTS (
+                    SELECT 1 FROM pg_index
+                    JOIN pg_class ON pg_class.oid = pg_index.indexrelid
+                    WHERE pg_class.relname = '{index_name}' AND NOT pg_index.indisvalid
+                ) THEN
+                    DROP INDEX {index_name};
+                END IF;
+            END $$;
+        ''',
+        f"CREATE {definition.replace('INDEX', f'INDEX CONCURRENTLY IF NOT EXISTS {index_name}', 1)}",
+    ]
+
+def _add_unique_constraint_using_index(table: str, constraint_name: str) -> str:
+    """Promotes an already built unique index to a constraint (a metadata-only change)."""
+    return f'''
+        DO $$
+        BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = '{constraint_name}') THEN
+                ALTER TABLE {table} ADD CONSTRAINT {constraint_name} UNIQUE USING INDEX {constraint_name};
+            END IF;
+        END $$;
+    '''
+
+MIGRATIONS = [
+    Migration(1, "create khetmat table", '''
+        CREATE TABLE IF NOT EXISTS khetmat(
+            khetma_id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+            chat_id BIGINT NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            status TEXT CHECK(status IN ('ACTIVE', 'FINISHED')) DEFAULT 'ACTIVE'
+        );
+    '''),
+
+    Migration(2, "create chapters table", '''
+        CREATE TABLE IF NOT EXISTS chapters (
+            chapter_id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+            khetma_id INTEGER NOT NULL REFERENCES khetmat(khetma_id) ON DELETE CASCADE,
+            number INTEGER NOT NULL,
+            status TEXT DEFAULT 'EMPTY',
+            owner_id BIGINT,
+            owner_username TEXT
+        );
+    '''),
+
+    # Every reserve/finish/withdraw looks a chapter up by (khetma_id, number). Older databases
+    # can hold the same chapter twice; the copy that got furthest (FINISHED, then RESERVED) stays.
+    Migration(3, "unique chapter number per khetma", [
+        '''
+            DELETE FROM chapters WHERE chapter_id IN (
+                SELECT chapter_id FROM (
+                    SELECT chapter_id, row_number() OVER (
+                        PARTITION BY khetma_id, number
+                        ORDER BY CASE status WHEN 'FINISHED' THEN 0 WHEN 'RESERVED' THEN 1 ELSE 2 END, chapter_id
+                    ) AS copy
+                    FROM chapters
+                ) AS copies
+                WHERE copy > 1
+            )
+        ''',
+        *_create_index_concurrently("chapters_khetma_id_number_key", "UNIQUE INDEX ON chapters (khetma_id, number)"),
+        _add_unique_constraint_using_index("chapters", "chapters_khetma_id_number_key"),
+    ], concurrent=True),
+
+    # "My chapters", finish-all and withdraw-all only ever look at RESERVED chapters of a user
+    Migration(4, "index reserved chapters by owner", [
+        *_create_index_concurrently(
+            "chapters_reserved_owner_idx",
+            "INDEX ON chapters (owner_id, khetma_id) WHERE status = 'RESERVED'"
+        ),
+    ], concurrent=True),
+
+    # Khetma lookups by number inside a chat (also guards the numbering against duplicates).
+    # Older databases can hold duplicate numbers from racing creations: the first khetma keeps
+    # its number and the later ones are renumbered after the chat's last.
+    Migration(5, "unique khetma number per chat", [
+        '''
+            WITH copies AS (
+                SELECT khetma_id, chat_id,
+                    row_number() OVER (PARTITION BY chat_id, number ORDER BY khetma_id) AS copy,
+                    MAX(number) OVER (PARTITION BY chat_id) AS last_number
+                FROM khetmat
+            ),
+            renumbered AS (
+                SELECT khetma_id, last_number + row_number() OVER (PARTITION BY chat_id ORDER BY khetma_id) AS number
+                FROM copies
+                WHERE copy > 1
+            )
+            UPDATE khetmat SET number = renumbered.number
+            FROM renumbered
+            WHERE khetmat.khetma_id = renumbered.khetma_id
+        ''',
+        *_create_index_concurrently("khetmat_chat_id_number_key", "UNIQUE INDEX ON khetmat (chat_id, number)"),
+        _add_unique_constraint_using_index("khetmat", "khetmat_chat_id_number_key"),
+    ], concurrent=True),
+
+    # Active khetmat of a chat and the finished-khetmat count
+    Migration(6, "index khetmat by chat and status", [
+        *_create_index_concurrently("khetmat_chat_id_status_idx", "INDEX ON khetmat (chat_id, status)"),
+    ], concurrent=True),
+
+    # Every committed write tells the other replicas which khetma changed (see khetma_notifications.py).
+    # Identical payloads are merged by Postgres per transaction, so a 30-row write sends one event.
+    Migration(7, "notify khetma changes", [
+        f'''
+            CREATE OR REPLACE FUNCTION khetma_notify_chapter_change() RETURNS trigger AS $$
+            DECLARE
+                changed_khetma_id INTEGER := CASE WHEN TG_OP = 'DELETE' THEN OLD.khetma_id ELSE NEW.khetma_id END;
+            BEGIN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'khetma_id', changed_khetma_id,
+                    'origin', current_setting('application_name')
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        f'''
+            CREATE OR REPLACE FUNCTION khetma_notify_khetma_change() RETURNS trigger AS $$
+            DECLARE
+                changed_row khetmat := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+            BEGIN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'khetma_id', changed_row.khetma_id,
+                    'chat_id', changed_row.chat_id,
+                    'origin', current_setting('application_name')
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        "DROP TRIGGER IF EXISTS chapters_notify_change ON chapters",
+        '''
+            CREATE TRIGGER chapters_notify_change
+            AFTER INSERT OR UPDATE OR DELETE ON chapters
+            FOR EACH ROW EXECUTE FUNCTION khetma_notify_chapter_change()
+        ''',
+        "DROP TRIGGER IF EXISTS khetmat_notify_change ON khetmat",
+        '''
+            CREATE TRIGGER khetmat_notify_change
+            AFTER INSERT OR UPDATE OR DELETE ON khetmat
+            FOR EACH ROW EXECUTE FUNCTION khetma_notify_khetma_change()
+        ''',
+    ]),
+
+    # A compact copy of each khetma's 30 chapters on its own row: chapter n is bit (n - 1) of
+    # reserved_mask/finished_mask, and owner_ids[n]/owner_usernames[n] hold its owner.
+    # `chapters` stays the source of truth; statement triggers keep the copy in step with it.
+    Migration(8, "chapter bitmaps on khetmat", [
+        '''
+            ALTER TABLE khetmat
+                ADD COLUMN IF NOT EXISTS reserved_mask INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS finished_mask INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS owner_ids BIGINT[],
+                ADD COLUMN IF NOT EXISTS owner_usernames TEXT[]
+        ''',
+        '''
+            CREATE OR REPLACE FUNCTION khetma_refresh_bitmaps(khetma_ids INTEGER[]) RETURNS void AS $$
+            BEGIN
+                -- Lock in a fixed order, so two chat-wide writes can't deadlock on each other's khetmat
+                PERFORM 1 FROM khetmat WHERE khetma_id = ANY(khetma_ids) ORDER BY khetma_id FOR UPDATE;
+
+                UPDATE khetmat SET
+                    reserved_mask = bitmaps.reserved_mask,
+                    finished_mask = bitmaps.finished_mask,
+                    owner_ids = bitmaps.owner_ids,
+                    owner_usernames = bitmaps.owner_usernames
+                FROM (
+                    SELECT khetma_id,
+                        COALESCE(bit_or(1 << (number - 1)) FILTER (WHERE status = 'RESERVED'), 0) AS reserved_mask,
+                        COALESCE(bit_or(1 << (number - 1)) FILTER (WHERE status = 'FINISHED'), 0) AS finished_mask,
+                        array_agg(owner_id ORDER BY number) AS owner_ids,
+                        array_agg(owner_username ORDER BY number) AS owner_usernames
+                    FROM (
+                        SELECT ids.khetma_id, numbers.number, chapters.status, chapters.owner_id, chapters.owner_username
+                        FROM unnest(khetma_ids) AS ids(khetma_id)
+                        CROSS JOIN generate_series(1, 30) AS numbers(number)
+                        LEFT JOIN chapters ON chapters.khetma_id = ids.khetma_id AND chapters.number = numbers.number
+                    ) AS slots
+                    GROUP BY khetma_id
+                ) AS bitmaps
+                WHERE khetmat.khetma_id = bitmaps.khetma_id;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        '''
+            CREATE OR REPLACE FUNCTION khetma_sync_bitmaps() RETURNS trigger AS $$
+            BEGIN
+                PERFORM khetma_refresh_bitmaps(ARRAY(SELECT DISTINCT khetma_id FROM changed_chapters));
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        # Transition tables allow a single event per trigger, hence one trigger per event
+        "DROP TRIGGER IF EXISTS chapters_sync_bitmaps_insert ON chapters",
+        '''
+            CREATE TRIGGER chapters_sync_bitmaps_insert
+            AFTER INSERT ON chapters REFERENCING NEW TABLE AS changed_chapters
+            FOR EACH STATEMENT EXECUTE FUNCTION khetma_sync_bitmaps()
+        ''',
+        "DROP TRIGGER IF EXISTS chapters_sync_bitmaps_update ON chapters",
+        '''
+            CREATE TRIGGER chapters_sync_bitmaps_update
+            AFTER UPDATE ON chapters REFERENCING NEW TABLE AS changed_chapters
+            FOR EACH STATEMENT EXECUTE FUNCTION khetma_sync_bitmaps()
+        ''',
+        # Bitmap refreshes follow chapter changes, which already notify; only the khetma's own fields should
+        "DROP TRIGGER IF EXISTS khetmat_notify_change ON khetmat",
+        '''
+            CREATE TRIGGER khetmat_notify_change
+            AFTER INSERT OR DELETE OR UPDATE OF chat_id, number, status ON khetmat
+            FOR EACH ROW EXECUTE FUNCTION khetma_notify_khetma_change()
+        ''',
+        "SELECT khetma_refresh_bitmaps(ARRAY(SELECT khetma_id FROM khetmat))",
+    ]),
+
+    # Khetma numbers are handed out from a per-chat counter instead of MAX(number) + 1
+    Migration(9, "per-chat khetma number counter", [
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_khetma_number INTEGER NOT NULL DEFAULT 0",
+        '''
+            UPDATE chats SET last_khetma_number = numbers.last_number
+            FROM (SELECT chat_id, MAX(number) AS last_number FROM khetmat GROUP BY chat_id) AS numbers
+            WHERE chats.chat_id = numbers.chat_id
+        ''',
+    ]),
+
+    # Khetma counts per chat, kept up to date by the storage writes that change them
+    Migration(10, "per-chat khetma counts", [
+        '''
+            ALTER TABLE chats
+                ADD COLUMN IF NOT EXISTS active_khetmat_count INTEGER NOT NULL DEFAULT 0,
+                ADD COLUMN IF NOT EXISTS finished_khetmat_count INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+            UPDATE chats SET
+                active_khetmat_count = counts.active_count,
+                finished_khetmat_count = counts.finished_count
+            FROM (
+                SELECT chat_id,
+                    COUNT(*) FILTER (WHERE status = 'ACTIVE') AS active_count,
+                    COUNT(*) FILTER (WHERE status = 'FINISHED') AS finished_count
+                FROM khetmat GROUP BY chat_id
+            ) AS counts
+            WHERE chats.chat_id = counts.chat_id
+        ''',
+    ]),
+
+    # Finished khetmat are moved here (see KhetmaStorage.archive_finished_khetmat), so the hot
+    # tables only hold what is still being read. Ids and numbers are kept, and the chats counters
+    # still count archived khetmat.
+    Migration(11, "archive tables for finished khetmat", [
+        '''
+            CREATE TABLE IF NOT EXISTS khetmat_archive(
+                khetma_id INTEGER PRIMARY KEY,
+                chat_id BIGINT NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                archived_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                CONSTRAINT khetmat_archive_chat_id_number_key UNIQUE (chat_id, number)
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS chapters_archive(
+                chapter_id INTEGER PRIMARY KEY,
+                khetma_id INTEGER NOT NULL REFERENCES khetmat_archive(khetma_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                owner_id BIGINT,
+                owner_username TEXT,
+                CONSTRAINT chapters_archive_khetma_id_number_key UNIQUE (khetma_id, number)
+            )
+        ''',
+    ]),
+
+    # Per-member reading counters, kept by a statement trigger inside the very transaction that
+    # finishes the chapters, so /stats reads one row per member instead of aggregating history.
+    # A chapter counts for its owner while it is FINISHED; archiving (a DELETE) leaves them alone.
+    Migration(12, "per-user reading stats", [
+        '''
+            CREATE TABLE IF NOT EXISTS reading_stats(
+                chat_id BIGINT NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+                user_id BIGINT NOT NULL,
+                username TEXT,
+                chapters_finished INTEGER NOT NULL DEFAULT 0,
+                khetmat_participated INTEGER NOT NULL DEFAULT 0,
+                last_finished_at TIMESTAMPTZ,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS reading_stats_leaderboard_idx ON reading_stats (chat_id, chapters_finished DESC)",
+        '''
+            CREATE OR REPLACE FUNCTION khetma_update_reading_stats() RETURNS trigger AS $$
+            BEGIN
+                WITH changes AS (
+                    -- +1 for a chapter that now counts for its owner, -1 for one that stopped counting
+                    SELECT new_chapters.khetma_id, new_chapters.owner_id AS user_id,
+                        new_chapters.owner_username AS username, 1 AS delta
+                    FROM new_chapters JOIN old_chapters USING (chapter_id)
+                    WHERE new_chapters.status = 'FINISHED' AND new_chapters.owner_id IS NOT NULL
+                    AND NOT (old_chapters.status = 'FINISHED' AND old_chapters.owner_id IS NOT DISTINCT FROM new_chapters.owner_id)
+                    UNION ALL
+                    SELECT old_chapters.khetma_id, old_chapters.owner_id, NULL, -1
+                    FROM old_chapters JOIN new_chapters USING (chapter_id)
+                    WHERE old_chapters.status = 'FINISHED' AND old_chapters.owner_id IS NOT NULL
+                    AND NOT (new_chapters.status = 'FINISHED' AND new_chapters.owner_id IS NOT DISTINCT FROM old_chapters.owner_id)
+                ),
+                per_khetma AS (
+                    SELECT khetma_id, user_id, MAX(username) AS username, SUM(delta) AS delta,
+                        (
+                            SELECT COUNT(*) FROM chapters
+                            WHERE chapters.khetma_id = changes.khetma_id
+                            AND chapters.owner_id = changes.user_id AND chapters.status = 'FINISHED'
+                        ) AS finished_after
+                    FROM changes
+                    GROUP BY khetma_id, user_id
+                ),
+                per_user AS (
+                    SELECT khetmat.chat_id, per_khetma.user_id, MAX(per_khetma.username) AS username,
+                        SUM(per_khetma.delta) AS delta,
+                        -- joined a khetma (first finished chapter in it) or left it (none left)
+                        SUM(CASE
+                            WHEN finished_after > 0 AND finished_after = delta THEN 1
+                            WHEN finished_after = 0 AND delta < 0 THEN -1
+                            ELSE 0
+                        END) AS participation_delta,
+                        bool_or(per_khetma.delta > 0) AS finished_now
+                    FROM per_khetma JOIN khetmat USING (khetma_id)
+                    GROUP BY khetmat.chat_id, per_khetma.user_id
+                )
+                INSERT INTO reading_stats (chat_id, user_id, username, chapters_finished, khetmat_participated, last_finished_at)
+                SELECT chat_id, user_id, username, delta, participation_delta, CASE WHEN finished_now THEN now() END
+                FROM per_user
+                ORDER BY chat_id, user_id
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    username = COALESCE(EXCLUDED.username, reading_stats.username),
+                    chapters_finished = reading_stats.chapters_finished + EXCLUDED.chapters_finished,
+                    khetmat_participated = reading_stats.khetmat_participated + EXCLUDED.khetmat_participated,
+                    last_finished_at = COALESCE(EXCLUDED.last_finished_at, reading_stats.last_finished_at);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        "DROP TRIGGER IF EXISTS chapters_reading_stats ON chapters",
+        '''
+            CREATE TRIGGER chapters_reading_stats
+            AFTER UPDATE ON chapters REFERENCING OLD TABLE AS old_chapters NEW TABLE AS new_chapters
+            FOR EACH STATEMENT EXECUTE FUNCTION khetma_update_reading_stats()
+        ''',
+        '''
+            INSERT INTO reading_stats (chat_id, user_id, username, chapters_finished, khetmat_participated)
+            SELECT chat_id, owner_id, MAX(owner_username), COUNT(*), COUNT(DISTINCT khetma_id)
+            FROM (
+                SELECT khetmat.chat_id, chapters.khetma_id, chapters.owner_id, chapters.owner_username
+                FROM chapters JOIN khetmat USING (khetma_id)
+                WHERE chapters.status = 'FINISHED' AND chapters.owner_id IS NOT NULL
+                UNION ALL
+                SELECT khetmat_archive.chat_id, chapters_archive.khetma_id, chapters_archive.owner_id, chapters_archive.owner_username
+                FROM chapters_archive JOIN khetmat_archive USING (khetma_id)
+                WHERE chapters_archive.status = 'FINISHED' AND chapters_archive.owner_id IS NOT NULL
+            ) AS finished
+            GROUP BY chat_id, owner_id
+            ON CONFLICT (chat_id, user_id) DO NOTHING
+        ''',
+    ]),
+
+    # Names are upserted from the user on each update (user_directory.py); the backfill
+    # takes every owner's most recent chapter name ("@username" or first name)
+    Migration(13, "users table", [
+        '''
+            CREATE TABLE IF NOT EXISTS users(
+                user_id BIGINT PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_seen TIMESTAMPTZ
+            )
+        ''',
+        '''
+            INSERT INTO users (user_id, username, first_name)
+            SELECT DISTINCT ON (owner_id) owner_id,
+                CASE WHEN owner_username LIKE '@%' THEN substr(owner_username, 2) END,
+                CASE WHEN owner_username NOT LIKE '@%' THEN owner_username END
+            FROM (
+                SELECT chapter_id, owner_id, owner_username FROM chapters
+                UNION ALL
+                SELECT chapter_id, owner_id, owner_username FROM chapters_archive
+            ) AS owned
+            WHERE owner_id IS NOT NULL AND owner_username IS NOT NULL
+            ORDER BY owner_id, chapter_id DESC
+            ON CONFLICT (user_id) DO NOTHING
+        ''',
+    ]),
+
+    # The version moves in the writing statement itself (an UPDATE khetmat ... RETURNING version in
+    # KhetmaStorage's chapter mutations), so the statement can hand back the value it stored.
+    # Inserting the 30 chapters of a new khetma leaves it at 0. Notifications carry the version too,
+    # so a listener can tell whether its cached copy already has the change: a chapter's AFTER ROW
+    # trigger fires once the statement is done, so it reads the version the statement stored.
+    Migration(14, "khetma versions", [
+        "ALTER TABLE khetmat ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0",
+        "ALTER TABLE khetmat_archive ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0",
+        f'''
+            CREATE OR REPLACE FUNCTION khetma_notify_chapter_change() RETURNS trigger AS $$
+            DECLARE
+                changed_khetma_id INTEGER := CASE WHEN TG_OP = 'DELETE' THEN OLD.khetma_id ELSE NEW.khetma_id END;
+            BEGIN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'khetma_id', changed_khetma_id,
+                    'version', (SELECT version FROM khetmat WHERE khetma_id = changed_khetma_id),
+                    'origin', current_setting('application_name')
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+        f'''
+            CREATE OR REPLACE FUNCTION khetma_notify_khetma_change() RETURNS trigger AS $$
+            DECLARE
+                changed_row khetmat := CASE WHEN TG_OP = 'DELETE' THEN OLD ELSE NEW END;
+            BEGIN
+                PERFORM pg_notify('{CHANGES_CHANNEL}', json_build_object(
+                    'khetma_id', changed_row.khetma_id,
+                    'chat_id', changed_row.chat_id,
+                    -- A deleted khetma (archived) has no version left to compare against
+                    'version', CASE WHEN TG_OP = 'DELETE' THEN NULL ELSE changed_row.version END,
+                    'origin', current_setting('application_name')
+                )::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        ''',
+    ]),
+]
+
+# The same schema for the embedded SQLite backend (khetma_sqlite_storage.py)
+SQLITE_MIGRATIONS = [
+    Migration(1, "khetma schema", [
+        '''
+            ALTER TABLE chats ADD COLUMN last_khetma_number INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+            ALTER TABLE chats ADD COLUMN active_khetmat_count INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+            ALTER TABLE chats ADD COLUMN finished_khetmat_count INTEGER NOT NULL DEFAULT 0
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS khetmat(
+                khetma_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT CHECK(status IN ('ACTIVE', 'FINISHED')) DEFAULT 'ACTIVE',
+                UNIQUE (chat_id, number)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS khetmat_chat_id_status_idx ON khetmat (chat_id, status)",
+        '''
+            CREATE TABLE IF NOT EXISTS chapters (
+                chapter_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                khetma_id INTEGER NOT NULL REFERENCES khetmat(khetma_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT DEFAULT 'EMPTY',
+                owner_id INTEGER,
+                owner_username TEXT,
+                UNIQUE (khetma_id, number)
+            )
+        ''',
+        '''
+            CREATE INDEX IF NOT EXISTS chapters_reserved_owner_idx
+            ON chapters (owner_id, khetma_id) WHERE status = 'RESERVED'
+        ''',
+    ]),
+
+    Migration(2, "archive tables for finished khetmat", [
+        '''
+            CREATE TABLE IF NOT EXISTS khetmat_archive(
+                khetma_id INTEGER PRIMARY KEY,
+                chat_id INTEGER NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                archived_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (chat_id, number)
+            )
+        ''',
+        '''
+            CREATE TABLE IF NOT EXISTS chapters_archive(
+                chapter_id INTEGER PRIMARY KEY,
+                khetma_id INTEGER NOT NULL REFERENCES khetmat_archive(khetma_id) ON DELETE CASCADE,
+                number INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                owner_id INTEGER,
+                owner_username TEXT,
+                UNIQUE (khetma_id, number)
+            )
+        ''',
+    ]),
+
+    # Row triggers here: each chapter row that starts/stops counting for its owner moves the counters
+    Migration(3, "per-user reading stats", [
+        '''
+            CREATE TABLE IF NOT EXISTS reading_stats(
+                chat_id INTEGER NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
+                user_id INTEGER NOT NULL,
+                username TEXT,
+                chapters_finished INTEGER NOT NULL DEFAULT 0,
+                khetmat_participated INTEGER NOT NULL DEFAULT 0,
+                last_finished_at TEXT,
+                PRIMARY KEY (chat_id, user_id)
+            )
+        ''',
+        "CREATE INDEX IF NOT EXISTS reading_stats_leaderboard_idx ON reading_stats (chat_id, chapters_finished DESC)",
+        '''
+            CREATE TRIGGER IF NOT EXISTS chapters_reading_stats_finished
+            AFTER UPDATE ON chapters
+            WHEN NEW.status = 'FINISHED' AND NEW.owner_id IS NOT NULL
+            AND NOT (OLD.status = 'FINISHED' AND OLD.owner_id IS NEW.owner_id)
+            BEGIN
+                INSERT INTO reading_stats (chat_id, user_id, username, chapters_finished, khetmat_participated, last_finished_at)
+                VALUES (
+                    (SELECT chat_id FROM khetmat WHERE khetma_id = NEW.khetma_id), NEW.owner_id, NEW.owner_username, 1,
+                    (SELECT COUNT(*) = 1 FROM chapters WHERE khetma_id = NEW.khetma_id AND owner_id = NEW.owner_id AND status = 'FINISHED'),
+                    CURRENT_TIMESTAMP
+                )
+                ON CONFLICT (chat_id, user_id) DO UPDATE SET
+                    username = COALESCE(excluded.username, username),
+                    chapters_finished = chapters_finished + 1,
+                    khetmat_participated = khetmat_participated + excluded.khetmat_participated,
+                    last_finished_at = excluded.last_finished_at;
+            END
+        ''',
+        '''
+            CREATE TRIGGER IF NOT EXISTS chapters_reading_stats_unfinished
+            AFTER UPDATE ON chapters
+            WHEN OLD.status = 'FINISHED' AND OLD.owner_id IS NOT NULL
+            AND NOT (NEW.status = 'FINISHED' AND NEW.owner_id IS OLD.owner_id)
+            BEGIN
+                UPDATE reading_stats SET
+                    chapters_finished = chapters_finished - 1,
+                    khetmat_participated = khetmat_participated - (
+                        SELECT COUNT(*) = 0 FROM chapters WHERE khetma_id = OLD.khetma_id AND owner_id = OLD.owner_id AND status = 'FINISHED'
+                    )
+                WHERE chat_id = (SELECT chat_id FROM khetmat WHERE khetma_id = OLD.khetma_id) AND user_id = OLD.owner_id;
+            END
+        ''',
+    ]),
+
+    Migration(4, "users table", [
+        '''
+            CREATE TABLE IF NOT EXISTS users(
+                user_id INTEGER PRIMARY KEY,
+                username TEXT,
+                first_name TEXT,
+                last_seen TEXT
+            )
+        ''',
+        '''
+            INSERT OR IGNORE INTO users (user_id, username, first_name)
+            SELECT owner_id,
+                CASE WHEN owner_username LIKE '@%' THEN substr(owner_username, 2) END,
+                CASE WHEN owner_username NOT LIKE '@%' THEN owner_username END
+            FROM (
+                SELECT owner_id, owner_username, MAX(chapter_id) FROM (
+                    SELECT chapter_id, owner_id, owner_username FROM chapters
+                    UNION ALL
+                    SELECT chapter_id, owner_id, owner_username FROM chapters_archive
+                )
+                WHERE owner_id IS NOT NULL AND owner_username IS NOT NULL
+                GROUP BY owner_id
+            )
+        ''',
+    ]),
+
+    # Bumped by the storage itself, once per write transaction per khetma it changed
+    Migration(5, "khetma versions", [
+        "ALTER TABLE khetmat ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE khetmat_archive ADD COLUMN version INTEGER NOT NULL DEFAULT 0",
+    ]),
+]
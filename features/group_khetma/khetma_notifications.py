@@ -0,0 +1,106 @@
+import json
+import logging
+import select
+import threading
+import psycopg2
+
+# Local modules
+from features.group_khetma.khetma_cache import CachedKhetmaStorage
+from features.group_khetma.khetma_migrations import CHANGES_CHANNEL
+
+logger = logging.getLogger(__name__)
+
+class KhetmaChangeListener:
+    """
+    Keeps a replica's CachedKhetmaStorage coherent with writes made by the other replicas.
+
+    The khetma triggers NOTIFY every committed change on CHANGES_CHANNEL; this listener
+    holds its own connection (outside the pool) on a daemon thread and evicts the khetmat
+    named there, unless the cached copy already has the notified version. Our own writes are
+    skipped by their `origin` (the session's application_name), since the write-through cache
+    already applied them. Whenever the connection is
+    (re)established the whole cache is cleared, as notifications sent meanwhile are lost.
+    Payloads that can't be parsed are logged and skipped; any other failure clears the cache
+    and reconnects, so the thread never dies quietly and leaves the cache unwatched.
+    """
+    def __init__(self, dsn: str, cache: CachedKhetmaStorage, origin: str, poll_interval=1.0, reconnect_delay=5.0):
+        self.dsn = dsn
+        self.cache = cache
+        self.origin = origin
+        self.poll_interval = poll_interval
+        self.reconnect_delay = reconnect_delay
+
+        self.received = 0
+        self.applied = 0
+
+        self._stop = threading.Event()
+        self._listening = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="khetma-change-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        self._listening.clear()
+
+    def wait_until_listening(self, timeout=None) -> bool:
+        return self._listening.wait(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(self.dsn, application_name=f"{self.origin}-listener")
+                conn.autocommit = True
+                with conn.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANGES_CHANNEL}")
+
+                self.cache.clear()
+                self._listening.set()
+                self._consume(conn)
+            except psycopg2.Error as e:
+                logger.warning(f"Khetma change listener lost its connection: {e}")
+                self._stop.wait(self.reconnect_delay)
+            except Exception:
+                logger.exception("Khetma change listener failed, clearing the cache and reconnecting")
+                self.cache.clear()
+                self._stop.wait(self.reconnect_delay)
+            finally:
+                self._listening.clear()
+                if conn is not None and not conn.closed:
+                    conn.close()
+
+    def _consume(self, conn):
+        while not self._stop.is_set():
+            if select.select([conn], [], [], self.poll_interval) == ([], [], []):
+                continue
+            conn.poll()
+            while conn.notifies:
+                self.handle_payload(conn.notifies.pop(0).payload)
+
+    def handle_payload(self, payload: str):
+        self.received += 1
+        try:
+            change = json.loads(payload)
+        except ValueError:
+            change = None
+        if not isinstance(change, dict):
+            logger.warning(f"Ignoring malformed khetma change notification: {payload!r}")
+            return
+
+        if change.get("origin") == self.origin:
+            return
+
+        if change.get("chat_id") is not None:
+            self.cache.invalidate_chat(change["chat_id"])
+        if change.get("khetma_id") is not None:
+            self.cache.invalidate(change["khetma_id"], version=change.get("version"))
+        self.applied += 1
@@ -0,0 +1,594 @@
+# Local modules
+import sqlite_storage_manager
+import features.group_khetma.errors as errors
+import features.group_khetma.khetma_migrations as khetma_migrations
+from features.group_khetma.khetma_storage import unique_chapter_numbers, finish_outcomes, withdraw_outcomes
+from features.group_khetma.class_khetma import Khetma
+from features.group_khetma.class_chapter import Chapter
+
+def _placeholders(values) -> str:
+    return ", ".join(["?"] * len(values))
+
+class SQLiteKhetmaStorage:
+    """
+    The KhetmaStorage contract (same methods, results and domain errors) on an embedded
+    SQLite database. Every mutation reads and writes inside one IMMEDIATE transaction on the
+    single writer connection, so it is atomic against every other mutation; reads run on the
+    reader connections and never wait for the writer.
+    """
+    def __init__(self, db_core: sqlite_storage_manager.SQLiteStorageManager):
+        self.db = db_core
+        self.db.apply_migrations(khetma_migrations.COMPONENT, khetma_migrations.SQLITE_MIGRATIONS)
+
+    # ==========================================
+    # HELPERS
+    # ==========================================
+
+    def _read_khetma(self, cursor, condition, params, archived=False) -> Khetma | None:
+        khetmat_table, chapters_table = ("khetmat_archive", "chapters_archive") if archived else ("khetmat", "chapters")
+
+        cursor.execute(f"SELECT * FROM {khetmat_table} WHERE {condition}", params)
+        khetma_row = cursor.fetchone()
+        if khetma_row is None:
+            return None
+
+        cursor.execute(f"SELECT * FROM {chapters_table} WHERE khetma_id = ? ORDER BY number ASC", (khetma_row["khetma_id"],))
+        return Khetma.from_db_row(khetma_row, cursor.fetchall())
+
+    def _lock_khetma(self, cursor, khetma_id) -> Khetma:
+        khetma = self._read_khetma(cursor, "khetma_id = ?", (khetma_id,))
+        if khetma is None:
+            raise errors.KhetmaNotFoundError()
+        return khetma
+
+    def _chapter_state(self, cursor, khetma_id, chapter_number) -> dict:
+        cursor.execute(
+            "SELECT status, owner_id FROM chapters WHERE khetma_id = ? AND number = ?",
+            (khetma_id, chapter_number)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            raise errors.ChapterNotFoundError()
+        return row
+
+    def _bump_versions(self, cursor, khetma_ids):
+        """One version step per write transaction per khetma it changed (like one statement on PostgreSQL)."""
+        khetma_ids = list(dict.fromkeys(khetma_ids))
+        if khetma_ids:
+            cursor.execute(
+                f"UPDATE khetmat SET version = version + 1 WHERE khetma_id IN ({_placeholders(khetma_ids)})", khetma_ids
+            )
+
+    def _save_chapters(self, cursor, chapters: list[Chapter], khetma: Khetma = None) -> int:
+        """
+        Writes the chapters and bumps their khetmat's versions (also on `khetma`, the locked copy they came from).
+        Returns: how many chapter rows were updated.
+        """
+        if not chapters:
+            return 0
+        cursor.executemany(
+            "UPDATE chapters SET status = ?, owner_id = ?, owner_username = ? WHERE khetma_id = ? AND number = ?",
+            [
+                (chapter.status.value, chapter.owner_id, chapter.owner_username, chapter.parent_khetma, chapter.number)
+                for chapter in chapters
+            ]
+        )
+        updated = cursor.rowcount
+        self._bump_versions(cursor, [chapter.parent_khetma for chapter in chapters])
+        if khetma is not None:
+            khetma.version += 1
+        return updated
+
+    # ==========================================
+    # CREATION
+    # ==========================================
+
+    def create_new_khetma(self, chat_id) -> Khetma:
+        return self.create_new_khetmat([chat_id])[0]
+
+    def create_new_khetmat(self, chat_ids: list) -> list[Khetma]:
+        chat_ids = list(dict.fromkeys(chat_ids))
+        if not chat_ids:
+            return []
+
+        khetmat = []
+        with self.db.write_transaction() as cursor:
+            for chat_id in chat_ids:
+                cursor.execute("""
+                    INSERT INTO chats (chat_id, last_khetma_number, active_khetmat_count) VALUES (?, 1, 1)
+                    ON CONFLICT (chat_id) DO UPDATE SET
+                        last_khetma_number = last_khetma_number + 1,
+                        active_khetmat_count = active_khetmat_count + 1
+                    RETURNING last_khetma_number
+                """, (chat_id,))
+                number = cursor.fetchone()["last_khetma_number"]
+
+                cursor.execute(
+                    "INSERT INTO khetmat (chat_id, number, status) VALUES (?, ?, 'ACTIVE') RETURNING khetma_id",
+                    (chat_id, number)
+                )
+                khetma_id = cursor.fetchone()["khetma_id"]
+
+                cursor.executemany(
+                    "INSERT INTO chapters (khetma_id, number, status) VALUES (?, ?, 'EMPTY')",
+                    [(khetma_id, chapter_num) for chapter_num in range(1, 31)]
+                )
+                khetmat.append(Khetma(khetma_id, number, Khetma.khetma_status.ACTIVE, chat_id=chat_id))
+
+        return khetmat
+
+    # ==========================================
+    # READS
+    # ==========================================
+
+    def get_khetma(self, khetma_id=None, khetma_number=None, chat_id=None) -> Khetma | None:
+        params = []
+        conditions = []
+
+        if khetma_id:
+            conditions.append("khetma_id = ?")
+            params.append(khetma_id)
+        if khetma_number:
+            conditions.append("number = ?")
+            params.append(khetma_number)
+        if chat_id:
+            conditions.append("chat_id = ?")
+            params.append(chat_id)
+
+        if not conditions:
+            return None
+
+        # Archived khetmat are still found: the archive is only read when the hot tables miss
+        with self.db.read_transaction() as cursor:
+            condition = " AND ".join(conditions)
+            return self._read_khetma(cursor, condition, params) or self._read_khetma(cursor, condition, params, archived=True)
+
+    def get_khetmat_by_ids(self, khetma_ids: list) -> dict:
+        """Returns a dict of {khetma_id: khetma_number} for a list of IDs (archived ones included)."""
+        if not khetma_ids:
+            return {}
+
+        with self.db.read_transaction() as cursor:
+            cursor.execute(f"""
+                SELECT khetma_id, number FROM khetmat WHERE khetma_id IN ({_placeholders(khetma_ids)})
+                UNION ALL
+                SELECT khetma_id, number FROM khetmat_archive WHERE khetma_id IN ({_placeholders(khetma_ids)})
+            """, tuple(khetma_ids) * 2)
+            return {row["khetma_id"]: row["number"] for row in cursor.fetchall()}
+
+    def get_active_khetmat(self, chat_id) -> list[Khetma]:
+        with self.db.read_transaction() as cursor:
+            cursor.execute(
+                "SELECT * FROM khetmat WHERE chat_id = ? AND status = 'ACTIVE' ORDER BY number ASC", (chat_id,)
+            )
+            khetma_rows = cursor.fetchall()
+            if not khetma_rows:
+                return []
+
+            khetma_ids = [row["khetma_id"] for row in khetma_rows]
+            cursor.execute(
+                f"SELECT * FROM chapters WHERE khetma_id IN ({_placeholders(khetma_ids)}) ORDER BY khetma_id, number",
+                khetma_ids
+            )
+            chapters_rows = cursor.fetchall()
+
+        chapters_by_khetma = {}
+        for chapter_row in chapters_rows:
+            chapters_by_khetma.setdefault(chapter_row["khetma_id"], []).append(chapter_row)
+
+        return [
+            Khetma.from_db_row(khetma_row, chapters_by_khetma.get(khetma_row["khetma_id"], []))
+            for khetma_row in khetma_rows
+        ]
+
+    def get_chapter(self, chapter_id=None, khetma_id=None, chapter_number=None) -> Chapter | None:
+        params = []
+        conditions = []
+
+        if chapter_id:
+            conditions.append("chapter_id = ?")
+            params.append(chapter_id)
+        if khetma_id:
+            conditions.append("khetma_id = ?")
+            params.append(khetma_id)
+        if chapter_number:
+            conditions.append("number = ?")
+            params.append(chapter_number)
+
+        if not conditions:
+            return None
+
+        with self.db.read_transaction() as cursor:
+            cursor.execute("SELECT * FROM chapters WHERE " + " AND ".join(conditions), params)
+            chapter_row = cursor.fetchone()
+
+        return Chapter.from_db_row(chapter_row) if chapter_row else None
+
+    def get_chapters_by_user(self, user_id, chat_id=None, khetma_id=None) -> list[Chapter]:
+        sql_command = "SELECT * FROM chapters WHERE owner_id = ? AND status = 'RESERVED'"
+        params = [user_id]
+
+        if chat_id:
+            sql_command += " AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = ?)"
+            params.append(chat_id)
+
+        if khetma_id:
+            sql_command += " AND khetma_id = ?"
+            params.append(khetma_id)
+
+        with self.db.read_transaction() as cursor:
+            cursor.execute(sql_command + " ORDER BY khetma_id, number", params)
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise errors.NoOwnedChapters()
+        return [Chapter.from_db_row(row) for row in rows]
+
+    def get_user_chapters_by_khetma(self, user_id, chat_id) -> dict[int, list[Chapter]]:
+        with self.db.read_transaction() as cursor:
+            cursor.execute("""
+                SELECT chapters.*, khetmat.number AS khetma_number
+                FROM chapters
+                JOIN khetmat ON khetmat.khetma_id = chapters.khetma_id
+                WHERE chapters.owner_id = ? AND chapters.status = 'RESERVED' AND khetmat.chat_id = ?
+                ORDER BY khetmat.number, chapters.number
+            """, (user_id, chat_id))
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise errors.NoOwnedChapters()
+
+        grouped = {}
+        for row in rows:
+            grouped.setdefault(row["khetma_number"], []).append(Chapter.from_db_row(row))
+        return grouped
+
+    def get_chat_counters(self, chat_id) -> dict:
+        with self.db.read_transaction() as cursor:
+            cursor.execute(
+                "SELECT last_khetma_number, active_khetmat_count, finished_khetmat_count FROM chats WHERE chat_id = ?",
+                (chat_id,)
+            )
+            row = cursor.fetchone()
+
+        if row is None:
+            return {"last_khetma_number": 0, "active_khetmat_count": 0, "finished_khetmat_count": 0}
+        return row
+
+    def get_finished_khetmat(self, chat_id, limit=10) -> list[Khetma]:
+        with self.db.read_transaction() as cursor:
+            cursor.execute("""
+                SELECT khetma_id, number, 0 AS archived FROM khetmat WHERE chat_id = ? AND status = 'FINISHED'
+                UNION ALL
+                SELECT khetma_id, number, 1 AS archived FROM khetmat_archive WHERE chat_id = ?
+                ORDER BY number DESC LIMIT ?
+            """, (chat_id, chat_id, limit))
+            rows = cursor.fetchall()
+
+            return [
+                self._read_khetma(cursor, "khetma_id = ?", (row["khetma_id"],), archived=bool(row["archived"]))
+                for row in rows
+            ]
+
+    def get_reading_stats(self, chat_id, user_id) -> dict:
+        with self.db.read_transaction() as cursor:
+            cursor.execute("""
+                SELECT user_id, username, chapters_finished, khetmat_participated
+                FROM reading_stats WHERE chat_id = ? AND user_id = ?
+            """, (chat_id, user_id))
+            row = cursor.fetchone()
+
+        if row is None:
+            return {"user_id": user_id, "username": None, "chapters_finished": 0, "khetmat_participated": 0}
+        return row
+
+    def get_reading_leaderboard(self, chat_id, limit=10) -> list[dict]:
+        with self.db.read_transaction() as cursor:
+            cursor.execute("""
+                SELECT user_id, username, chapters_finished, khetmat_participated
+                FROM reading_stats
+                WHERE chat_id = ? AND chapters_finished > 0
+                ORDER BY chapters_finished DESC, khetmat_participated DESC, user_id
+                LIMIT ?
+            """, (chat_id, limit))
+            return cursor.fetchall()
+
+    def calc_finished_khetmat_number(self, chat_id) -> int:
+        return self.get_chat_counters(chat_id)["finished_khetmat_count"] + 1
+
+    def calc_next_khetma_number(self, chat_id: int) -> int:
+        return self.get_chat_counters(chat_id)["last_khetma_number"] + 1
+
+    # ==========================================
+    # KHETMA / CHAPTER UPDATES
+    # ==========================================
+
+    def update_khetma(self, khetma: Khetma, expected_version=None):
+        with self.db.write_transaction() as cursor:
+            cursor.execute("SELECT chat_id, status, version FROM khetmat WHERE khetma_id = ?", (khetma.khetma_id,))
+            previous = cursor.fetchone()
+            if previous is None:
+                return False
+            if expected_version is not None and previous["version"] != expected_version:
+                raise errors.StaleKhetmaError()
+
+            status = khetma.status.value.upper()
+            cursor.execute(
+                "UPDATE khetmat SET status = ?, number = ?, version = version + 1 WHERE khetma_id = ?",
+                (status, khetma.number, khetma.khetma_id)
+            )
+            cursor.execute("""
+                UPDATE chats SET
+                    active_khetmat_count = active_khetmat_count + ? - ?,
+                    finished_khetmat_count = finished_khetmat_count + ? - ?,
+                    last_khetma_number = MAX(last_khetma_number, ?)
+                WHERE chat_id = ?
+            """, (
+                status == "ACTIVE", previous["status"] == "ACTIVE",
+                status == "FINISHED", previous["status"] == "FINISHED",
+                khetma.number, previous["chat_id"]
+            ))
+
+        khetma.version = previous["version"] + 1
+        return True
+
+    def update_chapters(self, chapters: list[Chapter] | Chapter, expected_version=None) -> bool:
+        if isinstance(chapters, Chapter):
+            chapters = [chapters]
+        if not chapters:
+            return False
+
+        khetma_ids = {chapter.parent_khetma for chapter in chapters}
+        if expected_version is not None and len(khetma_ids) != 1:
+            raise ValueError("expected_version needs the chapters of a single khetma")
+
+        with self.db.write_transaction() as cursor:
+            if expected_version is not None:
+                cursor.execute("SELECT version FROM khetmat WHERE khetma_id = ?", (next(iter(khetma_ids)),))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                if row["version"] != expected_version:
+                    raise errors.StaleKhetmaError()
+
+            return self._save_chapters(cursor, chapters) > 0
+
+    def get_khetma_version(self, khetma_id) -> int | None:
+        with self.db.read_transaction() as cursor:
+            cursor.execute("""
+                SELECT version FROM khetmat WHERE khetma_id = ?
+                UNION ALL
+                SELECT version FROM khetmat_archive WHERE khetma_id = ?
+            """, (khetma_id, khetma_id))
+            row = cursor.fetchone()
+
+        return row["version"] if row else None
+
+    # ==========================================
+    # RESERVE
+    # ==========================================
+
+    def reserve_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        with self.db.write_transaction() as cursor:
+            row = self._chapter_state(cursor, khetma_id, chapter_number)
+            if row["status"] == Chapter.chapter_status.EMPTY.value:
+                cursor.execute(
+                    "UPDATE chapters SET status = 'RESERVED', owner_id = ?, owner_username = ? WHERE khetma_id = ? AND number = ?",
+                    (user_id, username, khetma_id, chapter_number)
+                )
+                self._bump_versions(cursor, [khetma_id])
+                return True
+
+        if row["status"] == Chapter.chapter_status.RESERVED.value:
+            raise errors.ChapterAlreadyReservedError()
+        raise errors.ChapterFinishedError()
+
+    def reserve_chapter_returning(self, khetma_id, chapter_number, user_id, username) -> Khetma:
+        with self.db.write_transaction() as cursor:
+            khetma = self._lock_khetma(cursor, khetma_id)
+            chapter = khetma.get_chapter(chapter_number)
+            if chapter is not None and chapter.is_available:
+                chapter.reserve(user_id, username)
+                self._save_chapters(cursor, [chapter], khetma)
+                return khetma
+
+        if chapter is None:
+            raise errors.ChapterNotFoundError()
+        elif chapter.is_reserved:
+            raise errors.ChapterAlreadyReservedError()
+        raise errors.ChapterFinishedError()
+
+    # ==========================================
+    # WITHDRAW
+    # ==========================================
+
+    def withdraw_chapter(self, khetma_id, chapter_number, user_id, is_admin=False) -> bool:
+        with self.db.write_transaction() as cursor:
+            row = self._chapter_state(cursor, khetma_id, chapter_number)
+            if row["status"] == Chapter.chapter_status.RESERVED.value and (is_admin or row["owner_id"] == user_id):
+                cursor.execute(
+                    "UPDATE chapters SET status = 'EMPTY', owner_id = NULL, owner_username = NULL WHERE khetma_id = ? AND number = ?",
+                    (khetma_id, chapter_number)
+                )
+                self._bump_versions(cursor, [khetma_id])
+                return True
+
+        if row["status"] == Chapter.chapter_status.EMPTY.value:
+            raise errors.ChapterAlreadyEmptyError()
+        elif row["status"] == Chapter.chapter_status.FINISHED.value:
+            raise errors.ChapterFinishedError()
+        raise errors.ChapterNotOwnedError()
+
+    def withdraw_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        sql_command = """
+            UPDATE chapters SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
+            WHERE owner_id = ? AND status = 'RESERVED'
+            AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = ?)
+        """
+        return self._update_user_chapters(sql_command, chat_id, user_id, khetma_id)
+
+    def withdraw_chapters(self, khetma_id, chapter_numbers: list[int], user_id, is_admin=False) -> tuple[Khetma, dict]:
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+
+        with self.db.write_transaction() as cursor:
+            khetma = self._lock_khetma(cursor, khetma_id)
+            changed = [
+                chapter for chapter in (khetma.get_chapter(num) for num in chapter_numbers)
+                if chapter is not None and chapter.is_reserved and (is_admin or chapter.owner_id == user_id)
+            ]
+            for chapter in changed:
+                chapter.mark_empty()
+            self._save_chapters(cursor, changed, khetma)
+
+        return khetma, withdraw_outcomes(khetma, chapter_numbers, {chapter.number for chapter in changed})
+
+    def withdraw_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self.db.write_transaction() as cursor:
+            khetma = self._lock_khetma(cursor, khetma_id)
+            changed = self._owned_reserved_chapters(khetma, chat_id, user_id)
+            for chapter in changed:
+                chapter.mark_empty()
+            self._save_chapters(cursor, changed, khetma)
+
+        if not changed:
+            raise errors.NoOwnedChapters()
+        return changed, khetma
+
+    # ==========================================
+    # FINISH
+    # ==========================================
+
+    def finish_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
+        with self.db.write_transaction() as cursor:
+            row = self._chapter_state(cursor, khetma_id, chapter_number)
+            if row["status"] == Chapter.chapter_status.EMPTY.value or (
+                row["status"] == Chapter.chapter_status.RESERVED.value and row["owner_id"] == user_id
+            ):
+                cursor.execute(
+                    "UPDATE chapters SET status = 'FINISHED', owner_id = ?, owner_username = ? WHERE khetma_id = ? AND number = ?",
+                    (user_id, username, khetma_id, chapter_number)
+                )
+                self._bump_versions(cursor, [khetma_id])
+                return True
+
+        if row["status"] == Chapter.chapter_status.FINISHED.value:
+            raise errors.ChapterFinishedError()
+        raise errors.ChapterNotOwnedError()
+
+    def finish_chapters(self, khetma_id, chapter_numbers: list[int], user_id, username) -> tuple[Khetma, dict]:
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+
+        with self.db.write_transaction() as cursor:
+            khetma = self._lock_khetma(cursor, khetma_id)
+            changed = [
+                chapter for chapter in (khetma.get_chapter(num) for num in chapter_numbers)
+                if chapter is not None and (chapter.is_available or (chapter.is_reserved and chapter.owner_id == user_id))
+            ]
+            for chapter in changed:
+                chapter.owner_id, chapter.owner_username = user_id, username
+                chapter.mark_finished()
+            self._save_chapters(cursor, changed, khetma)
+
+        return khetma, finish_outcomes(khetma, chapter_numbers, {chapter.number for chapter in changed})
+
+    def finish_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
+        sql_command = """
+            UPDATE chapters SET status = 'FINISHED'
+            WHERE owner_id = ? AND status = 'RESERVED'
+            AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = ?)
+        """
+        return self._update_user_chapters(sql_command, chat_id, user_id, khetma_id)
+
+    def finish_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        with self.db.write_transaction() as cursor:
+            khetma = self._lock_khetma(cursor, khetma_id)
+            changed = self._owned_reserved_chapters(khetma, chat_id, user_id)
+            for chapter in changed:
+                chapter.mark_finished()
+            self._save_chapters(cursor, changed, khetma)
+
+        if not changed:
+            raise errors.NoOwnedChapters()
+        return changed, khetma
+
+    # ==========================================
+    # CHAT-WIDE HELPERS
+    # ==========================================
+
+    def _owned_reserved_chapters(self, khetma: Khetma, chat_id, user_id) -> list[Chapter]:
+        if khetma.chat_id != chat_id:
+            return []
+        return [chapter for chapter in khetma.get_reserved_chapters() if chapter.owner_id == user_id]
+
+    def _update_user_chapters(self, sql_command, chat_id, user_id, khetma_id) -> list[Chapter]:
+        params = [user_id, chat_id]
+        if khetma_id:
+            sql_command += " AND khetma_id = ?"
+            params.append(khetma_id)
+
+        with self.db.write_transaction() as cursor:
+            cursor.execute(sql_command + " RETURNING *", params)
+            rows = cursor.fetchall()
+            self._bump_versions(cursor, [row["khetma_id"] for row in rows])
+
+        if not rows:
+            raise errors.NoOwnedChapters()
+        return [Chapter.from_db_row(row) for row in sorted(rows, key=lambda row: (row["khetma_id"], row["number"]))]
+
+    # ==========================================
+    # ARCHIVE
+    # ==========================================
+
+    def archive_finished_khetmat(self, chat_id=None, batch_size=500) -> int:
+        sql_command = "SELECT khetma_id FROM khetmat WHERE status = 'FINISHED'"
+        params = []
+        if chat_id:
+            sql_command += " AND chat_id = ?"
+            params.append(chat_id)
+
+        with self.db.write_transaction() as cursor:
+            cursor.execute(sql_command + " ORDER BY khetma_id LIMIT ?", (*params, batch_size))
+            khetma_ids = [row["khetma_id"] for row in cursor.fetchall()]
+            if not khetma_ids:
+                return 0
+
+            picked = _placeholders(khetma_ids)
+            cursor.execute(f"""
+                INSERT INTO khetmat_archive (khetma_id, chat_id, number, status, version)
+                SELECT khetma_id, chat_id, number, status, version FROM khetmat WHERE khetma_id IN ({picked})
+            """, khetma_ids)
+            cursor.execute(f"""
+                INSERT INTO chapters_archive (chapter_id, khetma_id, number, status, owner_id, owner_username)
+                SELECT chapter_id, khetma_id, number, status, owner_id, owner_username FROM chapters WHERE khetma_id IN ({picked})
+            """, khetma_ids)
+            cursor.execute(f"DELETE FROM chapters WHERE khetma_id IN ({picked})", khetma_ids)
+            cursor.execute(f"DELETE FROM khetmat WHERE khetma_id IN ({picked})", khetma_ids)
+
+        return len(khetma_ids)
+
+    # ==========================================
+    # USERS
+    # ==========================================
+
+    def save_user(self, user_id, username, first_name):
+        with self.db.write_transaction() as cursor:
+            cursor.execute("""
+                INSERT INTO users (user_id, username, first_name, last_seen)
+                VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_seen = excluded.last_seen
+            """, (user_id, username, first_name))
+
+    def get_users(self, user_ids: list) -> dict[int, dict]:
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+
+        with self.db.read_transaction() as cursor:
+            cursor.execute(
+                f"SELECT user_id, username, first_name, last_seen FROM users WHERE user_id IN ({_placeholders(user_ids)})",
+                user_ids
+            )
+            return {row["user_id"]: row for row in cursor.fetchall()}
@@ -1,145 +1,278 @@
 # Local modules
 import storage_manager
 import features.group_khetma.errors as errors
+import features.group_khetma.khetma_migrations as khetma_migrations
 from features.group_khetma.class_khetma import Khetma
 from features.group_khetma.class_chapter import Chapter
 
+# Follows a `changed` CTE (an UPDATE chapters ... RETURNING) in every chapter mutation: bumps the
+# version of each khetma it changed chapters of, once per statement, and returns the new values.
+# ARRAY(...) runs `changed` to completion first, so the chapter rows are always locked before the
+# khetmat row, the order every chapter write takes them in. (Under READ COMMITTED the UPDATE waits
+# for a concurrent writer's commit and adds to the version it stored, so RETURNING is exact.)
+_BUMP_VERSIONS_SQL = """
+    bumped AS (
+        UPDATE khetmat SET version = version + 1
+        WHERE khetma_id = ANY(ARRAY(SELECT DISTINCT khetma_id FROM changed))
+        RETURNING khetma_id, version
+    )
+"""
+
+# Appended to a mutation written as two CTEs:
+#   target  -> the chapter rows the mutation looks at (locked with FOR UPDATE)
+#   changed -> the UPDATE ... RETURNING chapters.*
+# It returns all 30 chapters as they are *after* the mutation, plus the khetma row,
+# so the caller gets the updated khetma from the same statement (one round trip).
+_KHETMA_SNAPSHOT_SQL = _BUMP_VERSIONS_SQL + """,
+    snapshot AS (
+        SELECT * FROM changed
+        UNION ALL
+        SELECT * FROM target
+        WHERE chapter_id NOT IN (SELECT chapter_id FROM changed)
+        UNION ALL
+        SELECT * FROM chapters
+        WHERE khetma_id = %(khetma_id)s
+        AND chapter_id NOT IN (SELECT chapter_id FROM target)
+    )
+    SELECT snapshot.*,
+        snapshot.chapter_id IN (SELECT chapter_id FROM changed) AS changed,
+        khetmat.number AS khetma_number,
+        khetmat.status AS khetma_status,
+        khetmat.chat_id AS khetma_chat_id,
+        COALESCE((SELECT version FROM bumped), khetmat.version) AS khetma_version
+    FROM snapshot
+    JOIN khetmat ON khetmat.khetma_id = snapshot.khetma_id
+    ORDER BY snapshot.number ASC
+"""
+
+# ==========================================
+# BULK OUTCOMES (shared by every storage backend)
+# ==========================================
+
+def unique_chapter_numbers(chapter_numbers) -> list[int]:
+    """De-duplicates the requested numbers, keeping their order."""
+    return list(dict.fromkeys(int(num) for num in chapter_numbers))
+
+def finish_outcomes(khetma: Khetma, chapter_numbers: list[int], changed_numbers: set) -> dict:
+    """
+    {chapter_number: None | KhetmaError} for a bulk finish, judged on the khetma *after* it:
+    None means the chapter was finished now, otherwise the error says why not.
+    """
+    outcomes = {}
+    for chapter_num in chapter_numbers:
+        chapter = khetma.get_chapter(chapter_num)
+        if chapter is None:
+            outcomes[chapter_num] = errors.ChapterNotFoundError()
+        elif chapter_num in changed_numbers:
+            outcomes[chapter_num] = None
+        elif chapter.is_finished:
+            outcomes[chapter_num] = errors.ChapterFinishedError()
+        else:
+            outcomes[chapter_num] = errors.ChapterNotOwnedError()
+    return outcomes
+
+def withdraw_outcomes(khetma: Khetma, chapter_numbers: list[int], changed_numbers: set) -> dict:
+    """{chapter_number: None | KhetmaError} for a bulk withdraw (same contract as finish_outcomes)."""
+    outcomes = {}
+    for chapter_num in chapter_numbers:
+        chapter = khetma.get_chapter(chapter_num)
+        if chapter is None:
+            outcomes[chapter_num] = errors.ChapterNotFoundError()
+        elif chapter_num in changed_numbers:
+            outcomes[chapter_num] = None
+        elif chapter.is_available:
+            outcomes[chapter_num] = errors.ChapterAlreadyEmptyError()
+        elif chapter.is_finished:
+            outcomes[chapter_num] = errors.ChapterFinishedError()
+        else:
+            outcomes[chapter_num] = errors.ChapterNotOwnedError()
+    return outcomes
+
+# Select list for khetmat rows that carry their 30 chapters along, aggregated by the
+# server into one JSON array (ordered by number), so a khetma is a single row to fetch.
+_KHETMA_WITH_CHAPTERS_COLUMNS = """
+    khetmat.*,
+    (
+        SELECT json_agg(chapters ORDER BY chapters.number)
+        FROM chapters
+        WHERE chapters.khetma_id = khetmat.khetma_id
+    ) AS chapters
+"""
+
+# The same select list for khetmat_archive/chapters_archive (no bitmap columns there)
+_ARCHIVED_KHETMA_COLUMNS = """
+    khetmat_archive.khetma_id, khetmat_archive.chat_id, khetmat_archive.number, khetmat_archive.status,
+    khetmat_archive.version,
+    (
+        SELECT json_agg(chapters_archive ORDER BY chapters_archive.number)
+        FROM chapters_archive
+        WHERE chapters_archive.khetma_id = khetmat_archive.khetma_id
+    ) AS chapters
+"""
+
 class KhetmaStorage:
-    def __init__(self, db_core: storage_manager.StorageManager):
+    def __init__(self, db_core: storage_manager.StorageManager, bitmap_reads=False, prepared_statements=True):
+        """
+        bitmap_reads: read khetmat from the chapter bitmaps kept on the khetmat row
+        (one row per khetma, Chapter objects built lazily) instead of their 30 chapter rows.
+        prepared_statements: run the hot statements as server-side prepared statements
+        (turn off behind a transaction-pooling proxy such as PgBouncer).
+        """
         self.db = db_core
-        self._init_khetma_table()
-        self._init_chapters_table()
-    
-    def _init_khetma_table(self):
-        with self.db.managed_connection() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS khetmat(
-                    khetma_id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
-                    chat_id BIGINT NOT NULL REFERENCES chats(chat_id) ON DELETE CASCADE,
-                    number INTEGER NOT NULL,
-                    status TEXT CHECK(status IN ('ACTIVE', 'FINISHED')) DEFAULT 'ACTIVE'
-                );
-            ''')
-
-    def _init_chapters_table(self):
-        with self.db.managed_connection() as cursor:
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS chapters (
-                chapter_id INTEGER PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
-                khetma_id INTEGER NOT NULL REFERENCES khetmat(khetma_id) ON DELETE CASCADE,
-                number INTEGER NOT NULL,
-                status TEXT DEFAULT 'EMPTY', 
-                owner_id BIGINT,          
-                owner_username TEXT                                    
-                );
-            ''')
+        self.bitmap_reads = bitmap_reads
+        self.prepared_statements = prepared_statements
+        self.db.apply_migrations(khetma_migrations.COMPONENT, khetma_migrations.MIGRATIONS)
 
     def create_new_khetma(self, chat_id) -> Khetma:
-        sql_insert_chat = "INSERT INTO chats (chat_id) VALUES (%s) ON CONFLICT DO NOTHING"
-        
-        sql_insert_khetma = """
-            INSERT INTO khetmat (chat_id, number, status)
-            VALUES (%s, COALESCE((SELECT MAX(number) FROM khetmat WHERE chat_id = %s), 0) + 1, 'ACTIVE')
-            RETURNING khetma_id, number
+        return self.create_new_khetmat([chat_id])[0]
+
+    def create_new_khetmat(self, chat_ids: list) -> list[Khetma]:
+        """
+        Creates one new khetma (with its 30 empty chapters) in each chat, in a single statement.
+        Numbers come from the per-chat counter on `chats`: bumping it row-locks the chat,
+        so concurrent creations in the same chat queue up instead of reading the same MAX.
+        Returns: the new khetmat, in the order the chats were given (each chat once).
         """
+        chat_ids = list(dict.fromkeys(chat_ids))
+        if not chat_ids:
+            return []
 
-        sql_insert_chapters = "INSERT INTO chapters (khetma_id, number, status) VALUES (%s, %s, 'EMPTY')"
+        sql_command = """
+            WITH counters AS (
+                -- Sorted, so two bulk creations lock overlapping chats in the same order
+                INSERT INTO chats (chat_id, last_khetma_number, active_khetmat_count)
+                SELECT chat_id, 1, 1 FROM unnest(%(chat_ids)s::BIGINT[]) AS requested(chat_id)
+                ORDER BY chat_id
+                ON CONFLICT (chat_id) DO UPDATE SET
+                    last_khetma_number = chats.last_khetma_number + 1,
+                    active_khetmat_count = chats.active_khetmat_count + 1
+                RETURNING chat_id, last_khetma_number
+            ),
+            new_khetmat AS (
+                INSERT INTO khetmat (chat_id, number, status)
+                SELECT chat_id, last_khetma_number, 'ACTIVE' FROM counters
+                RETURNING khetma_id, chat_id, number
+            ),
+            new_chapters AS (
+                INSERT INTO chapters (khetma_id, number, status)
+                SELECT new_khetmat.khetma_id, chapter_number, 'EMPTY'
+                FROM new_khetmat CROSS JOIN generate_series(1, 30) AS chapter_number
+            )
+            SELECT khetma_id, chat_id, number FROM new_khetmat
+        """
 
         with self.db.managed_connection() as cursor:
-            cursor.execute(sql_insert_chat, (chat_id,))
-            cursor.execute(sql_insert_khetma, (chat_id, chat_id))
-            row = cursor.fetchone()
-            khetma_id = row["khetma_id"]
-            khetma_num = row["number"]
+            cursor.execute(sql_command, {"chat_ids": chat_ids})
+            rows = {row["chat_id"]: row for row in cursor.fetchall()}
 
-            chapters_data = [(khetma_id, num) for num in range(1, 31)]
-            cursor.executemany(sql_insert_chapters, chapters_data)
-
-            return Khetma(khetma_id, khetma_num, Khetma.khetma_status.ACTIVE)
+        return [
+            Khetma(rows[chat_id]["khetma_id"], rows[chat_id]["number"], Khetma.khetma_status.ACTIVE, chat_id=chat_id)
+            for chat_id in chat_ids
+        ]
         
+    def _execute(self, cursor, name, sql_command, params: dict):
+        """Runs a hot statement, prepared once per connection under `name` when enabled."""
+        if self.prepared_statements:
+            self.db.statements.execute(cursor, name, sql_command, params)
+        else:
+            cursor.execute(sql_command, params)
+
     def get_khetma(self, khetma_id=None, khetma_number=None, chat_id=None) -> Khetma | None:
         """
-        Fetches a single specific Khetma directly from the DB.
+        Fetches a single specific Khetma (with its chapters) in one query.
+        Archived khetmat are still found: the archive is only read when the hot tables miss.
         """
-        sql_khetma_command = "SELECT * FROM khetmat" 
-        params = []
-        conditions = []
+        lookup = {"khetma_id": khetma_id, "number": khetma_number, "chat_id": chat_id}
+        lookup = {column: value for column, value in lookup.items() if value}
+        if not lookup:
+            return None
 
-        if khetma_id:
-            conditions.append("khetma_id = %s")
-            params.append(khetma_id)
-        if khetma_number:
-            conditions.append("number = %s")
-            params.append(khetma_number)
-        if chat_id:
-            conditions.append("chat_id = %s")
-            params.append(chat_id)
+        # The two lookups the handlers make on every click have fixed statements
+        name = {("khetma_id",): "khetma_by_id", ("number", "chat_id"): "khetma_by_number"}.get(tuple(lookup))
+        condition = " AND ".join(f"{column} = %({column})s" for column in lookup)
 
-        if conditions:
-            sql_khetma_command += " WHERE " + " AND ".join(conditions)
-        else:
-            return None 
+        khetma = self._fetch_khetma(name, condition, lookup)
+        if khetma is None:
+            khetma = self._fetch_archived_khetma(condition, lookup)
+        return khetma
 
-        sql_chapters_command = "SELECT * FROM chapters WHERE khetma_id = %s ORDER BY number ASC"
+    def _fetch_khetma(self, name, condition, params: dict) -> Khetma | None:
+        sql_command = f"SELECT {self._khetma_columns()} FROM khetmat WHERE {condition}"
 
         with self.db.managed_connection() as cursor:
-            
-            # A. Fetch Khetma
-            cursor.execute(sql_khetma_command, params)
+            if name is None:
+                cursor.execute(sql_command, params)
+            else:
+                self._execute(cursor, name + "_bitmap" if self.bitmap_reads else name, sql_command, params)
             khetma_row = cursor.fetchone()
 
-            if khetma_row is None:
-                return None
-            
-            # B. Fetch Chapters
-            cursor.execute(sql_chapters_command, (khetma_row["khetma_id"],))
-            chapters_rows = cursor.fetchall()
+        if khetma_row is None:
+            return None
+        return self._khetma_from_row(khetma_row)
+
+    def _fetch_archived_khetma(self, condition, params: dict) -> Khetma | None:
+        sql_command = f"SELECT {_ARCHIVED_KHETMA_COLUMNS} FROM khetmat_archive WHERE {condition}"
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, params)
+            khetma_row = cursor.fetchone()
 
-        return Khetma.from_db_row(khetma_row, chapters_rows)
+        if khetma_row is None:
+            return None
+        return Khetma.from_db_row(khetma_row, khetma_row["chapters"] or [])
+
+    def _khetma_columns(self) -> str:
+        # Bitmap reads don't need the chapter rows at all
+        return "khetmat.*" if self.bitmap_reads else _KHETMA_WITH_CHAPTERS_COLUMNS
+
+    def _khetma_from_row(self, khetma_row) -> Khetma:
+        if self.bitmap_reads:
+            return Khetma.from_bitmap_row(khetma_row)
+        return Khetma.from_db_row(khetma_row, khetma_row["chapters"] or [])
     
     def get_khetmat_by_ids(self, khetma_ids: list) -> dict:
-        """Returns a dict of {khetma_id: khetma_number} for a list of IDs."""
+        """Returns a dict of {khetma_id: khetma_number} for a list of IDs (archived ones included)."""
 
         placeholders = ",".join(["%s"] * len(khetma_ids))
-        sql = f"SELECT khetma_id, number FROM khetmat WHERE khetma_id IN ({placeholders})"
+        sql = f"""
+            SELECT khetma_id, number FROM khetmat WHERE khetma_id IN ({placeholders})
+            UNION ALL
+            SELECT khetma_id, number FROM khetmat_archive WHERE khetma_id IN ({placeholders})
+        """
         
         with self.db.managed_connection() as cursor:
-            cursor.execute(sql, tuple(khetma_ids))
+            cursor.execute(sql, tuple(khetma_ids) * 2)
             return {row["khetma_id"]: row["number"] for row in cursor.fetchall()}
     
     def get_active_khetmat(self, chat_id) -> list[Khetma]:
-        """Returns all ACTIVE khetmat in a chat with their chapters."""
-        sql_khetmat = "SELECT * FROM khetmat WHERE chat_id = %s AND status = 'ACTIVE'"
+        """Returns all ACTIVE khetmat in a chat with their chapters (one query, one row per khetma)."""
+        sql_command = f"""
+            SELECT {self._khetma_columns()} FROM khetmat
+            WHERE chat_id = %(chat_id)s AND status = 'ACTIVE'
+            ORDER BY number ASC
+        """
 
         with self.db.managed_connection() as cursor:
-            cursor.execute(sql_khetmat, (chat_id,))
+            self._execute(cursor, "active_khetmat_bitmap" if self.bitmap_reads else "active_khetmat",
+                          sql_command, {"chat_id": chat_id})
             khetma_rows = cursor.fetchall()
 
-            if not khetma_rows:
-                return []
-
-            khetma_ids = [row["khetma_id"] for row in khetma_rows]
-            placeholders = ",".join(["%s"] * len(khetma_ids))
-            cursor.execute(
-                f"SELECT * FROM chapters WHERE khetma_id IN ({placeholders}) ORDER BY khetma_id, number ASC",
-                tuple(khetma_ids)
-            )
-            chapters_rows = cursor.fetchall()
-
-        # Group chapters by khetma_id
-        chapters_by_khetma = {}
-        for ch_row in chapters_rows:
-            chapters_by_khetma.setdefault(ch_row["khetma_id"], []).append(ch_row)
-
-        return [
-            Khetma.from_db_row(khetma_row, chapters_by_khetma.get(khetma_row["khetma_id"], []))
-            for khetma_row in khetma_rows
-        ]
+        return [self._khetma_from_row(khetma_row) for khetma_row in khetma_rows]
     
     def get_chapter(self, chapter_id=None, khetma_id=None, chapter_number=None) -> Chapter | None:
         """
         Fetches a single specific Chapter directly from the DB.
         """
+        if khetma_id and chapter_number and not chapter_id:
+            with self.db.managed_connection() as cursor:
+                self._execute(
+                    cursor, "chapter_by_number",
+                    "SELECT * FROM chapters WHERE khetma_id = %(khetma_id)s AND number = %(chapter_number)s",
+                    {"khetma_id": khetma_id, "chapter_number": chapter_number}
+                )
+                chapter_row = cursor.fetchone()
+            return Chapter.from_db_row(chapter_row) if chapter_row else None
+
         sql_chapter_command = "SELECT * FROM chapters" 
         params = []
         conditions = []
@@ -195,21 +328,89 @@ class KhetmaStorage:
             
             return [Chapter.from_db_row(row) for row in rows]
 
-    def update_khetma(self, khetma: Khetma):
-        
+    def get_user_chapters_by_khetma(self, user_id, chat_id) -> dict[int, list[Chapter]]:
+        """
+        The user's RESERVED chapters in a chat, grouped by the server per khetma.
+        Returns: {khetma_number: [Chapter, ...]} ordered by khetma number, then chapter number.
+        """
         sql_command = """
-            UPDATE khetmat 
-            SET status = %s,
-            number = %s
-            WHERE khetma_id = %s
+            SELECT khetmat.number AS khetma_number,
+                json_agg(chapters ORDER BY chapters.number) AS chapters
+            FROM chapters
+            JOIN khetmat ON khetmat.khetma_id = chapters.khetma_id
+            WHERE chapters.owner_id = %s
+            AND chapters.status = 'RESERVED'
+            AND khetmat.chat_id = %s
+            GROUP BY khetmat.khetma_id, khetmat.number
+            ORDER BY khetmat.number ASC
         """
 
         with self.db.managed_connection() as cursor:
-            cursor.execute(sql_command, (khetma.status.value.upper(), khetma.number, khetma.khetma_id))
-            return cursor.rowcount > 0 # True: the updating succeeded, Flase: the update failed
-        
-    def update_chapters(self, chapters: list[Chapter] | Chapter) -> bool:
+            cursor.execute(sql_command, (user_id, chat_id))
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise errors.NoOwnedChapters()
+
+        return {
+            row["khetma_number"]: [Chapter.from_db_row(chapter_row) for chapter_row in row["chapters"]]
+            for row in rows
+        }
+
+    def update_khetma(self, khetma: Khetma, expected_version=None):
+        """
+        Writes the khetma's status and number, and bumps its version (set back on `khetma`).
+        expected_version: only write if the stored version still is this one, else raise
+        StaleKhetmaError (someone changed the khetma since it was read).
+        """
+        # The chat's counts move with the status change in the same statement
+        sql_command = """
+            WITH previous AS (
+                SELECT khetma_id, status, version FROM khetmat WHERE khetma_id = %(khetma_id)s FOR UPDATE
+            ),
+            updated AS (
+                UPDATE khetmat 
+                SET status = %(status)s,
+                number = %(number)s,
+                version = previous.version + 1
+                FROM previous
+                WHERE khetmat.khetma_id = previous.khetma_id
+                AND (%(expected_version)s::BIGINT IS NULL OR previous.version = %(expected_version)s)
+                RETURNING khetmat.chat_id, khetmat.number, khetmat.status, khetmat.version, previous.status AS previous_status
+            ),
+            counted AS (
+                UPDATE chats SET
+                    active_khetmat_count = active_khetmat_count
+                        + (updated.status = 'ACTIVE')::INTEGER - (updated.previous_status = 'ACTIVE')::INTEGER,
+                    finished_khetmat_count = finished_khetmat_count
+                        + (updated.status = 'FINISHED')::INTEGER - (updated.previous_status = 'FINISHED')::INTEGER,
+                    last_khetma_number = GREATEST(last_khetma_number, updated.number)
+                FROM updated
+                WHERE chats.chat_id = updated.chat_id
+            )
+            SELECT EXISTS (SELECT 1 FROM previous) AS found, (SELECT version FROM updated) AS version
+        """
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, {
+                "khetma_id": khetma.khetma_id, "status": khetma.status.value.upper(), "number": khetma.number,
+                "expected_version": expected_version
+            })
+            row = cursor.fetchone()
 
+        if not row["found"]:
+            return False # no such khetma
+        if row["version"] is None:
+            raise errors.StaleKhetmaError()
+        khetma.version = row["version"]
+        return True
+
+    def update_chapters(self, chapters: list[Chapter] | Chapter, expected_version=None) -> bool:
+        """
+        Writes the chapters as they are, in one statement (so each khetma's version moves by one).
+        expected_version: the chapters must all belong to one khetma; only write if its stored
+        version still is this one, else raise StaleKhetmaError.
+        """
         # 1. Normalize the input: If it's a single object, make it a list of one.
         if isinstance(chapters, Chapter):
             chapters = [chapters]
@@ -217,76 +418,205 @@ class KhetmaStorage:
         # 2. Safety check
         if not chapters:
             return False
-            
+
+        # The last state given for a chapter wins
+        chapters = list({(chapter.parent_khetma, chapter.number): chapter for chapter in chapters}.values())
+        khetma_ids = {chapter.parent_khetma for chapter in chapters}
+        if expected_version is not None and len(khetma_ids) != 1:
+            raise ValueError("expected_version needs the chapters of a single khetma")
+
         # 3. Exactly ONE SQL string and ONE execution path
         sql_command = """
-            UPDATE chapters 
-            SET status = %s, owner_id = %s, owner_username = %s
-            WHERE khetma_id = %s AND number = %s
+            WITH changed AS (
+                UPDATE chapters
+                SET status = data.status, owner_id = data.owner_id, owner_username = data.owner_username
+                FROM unnest(%s::INTEGER[], %s::INTEGER[], %s::TEXT[], %s::BIGINT[], %s::TEXT[])
+                    AS data(khetma_id, number, status, owner_id, owner_username)
+                WHERE chapters.khetma_id = data.khetma_id AND chapters.number = data.number
+                RETURNING chapters.khetma_id
+            ),
+        """ + _BUMP_VERSIONS_SQL + """
+            SELECT COUNT(*) AS updated FROM changed
         """
-        
+
         with self.db.managed_connection() as cursor:
-            data_to_update = [
-                (chapter.status.value.upper(), chapter.owner_id, chapter.owner_username, chapter.parent_khetma, chapter.number)
-                for chapter in chapters
-            ]
-            
-            # This works perfectly whether the list has 1 item or 30 items
-            cursor.executemany(sql_command, data_to_update)
-            
-            return cursor.rowcount > 0
+            if expected_version is not None:
+                # Chapter rows first, then the khetma row: the order every chapter mutation locks them in.
+                # With all its chapters locked, no other write to the khetma can be half done.
+                khetma_id = khetma_ids.pop()
+                cursor.execute("SELECT 1 FROM chapters WHERE khetma_id = %s ORDER BY number FOR UPDATE", (khetma_id,))
+                cursor.execute("SELECT version FROM khetmat WHERE khetma_id = %s FOR UPDATE", (khetma_id,))
+                row = cursor.fetchone()
+                if row is None:
+                    return False
+                if row["version"] != expected_version:
+                    raise errors.StaleKhetmaError()
+
+            cursor.execute(sql_command, (
+                [chapter.parent_khetma for chapter in chapters],
+                [chapter.number for chapter in chapters],
+                [chapter.status.value.upper() for chapter in chapters],
+                [chapter.owner_id for chapter in chapters],
+                [chapter.owner_username for chapter in chapters],
+            ))
+            return cursor.fetchone()["updated"] > 0
+
+    def get_khetma_version(self, khetma_id) -> int | None:
+        """
+        The khetma's current version (a primary-key read of one column), or None if it doesn't exist.
+        Cheaper than get_khetma for telling whether a copy read earlier is still current.
+        """
+        with self.db.managed_connection() as cursor:
+            self._execute(
+                cursor, "khetma_version",
+                """
+                    SELECT version FROM khetmat WHERE khetma_id = %(khetma_id)s
+                    UNION ALL
+                    SELECT version FROM khetmat_archive WHERE khetma_id = %(khetma_id)s
+                """,
+                {"khetma_id": khetma_id}
+            )
+            row = cursor.fetchone()
+
+        return row["version"] if row else None
+
+    def _mutate_chapter(self, name, sql_command, params) -> dict:
+        """
+        Runs a single-statement conditional chapter mutation.
+        The statement locks the target row, applies the change if allowed and returns
+        the chapter's status/owner *before* the change plus a `changed` flag, so the
+        caller can pick the right domain error without a second query.
+        """
+        with self.db.managed_connection() as cursor:
+            self._execute(cursor, name, sql_command, params)
+            row = cursor.fetchone()
+
+        if row is None:
+            raise errors.ChapterNotFoundError()
+        return row
+
+    def _mutate_with_snapshot(self, name, mutation_ctes, params) -> tuple[Khetma, list[Chapter]]:
+        """
+        Runs `mutation_ctes` (the `target` and `changed` CTEs) followed by the khetma snapshot.
+        Returns: the khetma after the mutation and the chapters that were changed.
+        """
+        with self.db.managed_connection() as cursor:
+            self._execute(cursor, name, "WITH " + mutation_ctes + "," + _KHETMA_SNAPSHOT_SQL, params)
+            rows = cursor.fetchall()
+
+        if not rows:
+            raise errors.KhetmaNotFoundError()
+
+        khetma_row = {
+            "khetma_id": params["khetma_id"],
+            "number": rows[0]["khetma_number"],
+            "status": rows[0]["khetma_status"],
+            "chat_id": rows[0]["khetma_chat_id"],
+            "version": rows[0]["khetma_version"],
+        }
+        khetma = Khetma.from_db_row(khetma_row, rows)
+        changed = [khetma.get_chapter(row["number"]) for row in rows if row["changed"]]
+        return khetma, changed
 
     def reserve_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
         sql_command = """
-            UPDATE chapters
-            SET status = 'RESERVED', owner_id = %s, owner_username = %s
-            WHERE khetma_id = %s AND number = %s AND status = 'EMPTY' 
+            WITH target AS (
+                SELECT chapter_id, status, owner_id FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = %(number)s
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'RESERVED', owner_id = %(user_id)s, owner_username = %(username)s
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id AND target.status = 'EMPTY'
+                RETURNING chapters.chapter_id, chapters.khetma_id
+            ),
+            """ + _BUMP_VERSIONS_SQL + """
+            SELECT target.status, target.owner_id, EXISTS (SELECT 1 FROM changed) AS changed
+            FROM target
         """
-        with self.db.managed_connection() as cursor:
-            cursor.execute(sql_command, (user_id, username, khetma_id, chapter_number))
-            if cursor.rowcount > 0:
-                return True
-            
-        chapter = self.get_chapter(khetma_id=khetma_id, chapter_number=chapter_number)
+        row = self._mutate_chapter("reserve_chapter", sql_command, {
+            "khetma_id": khetma_id, "number": chapter_number, "user_id": user_id, "username": username
+        })
+        if row["changed"]:
+            return True
 
-        if chapter.is_reserved:
+        if row["status"] == Chapter.chapter_status.RESERVED.value:
             raise errors.ChapterAlreadyReservedError()
-        elif chapter.is_finished: 
+        elif row["status"] == Chapter.chapter_status.FINISHED.value:
             raise errors.ChapterFinishedError()
 
+    def reserve_chapter_returning(self, khetma_id, chapter_number, user_id, username) -> Khetma:
+        """Same as reserve_chapter, but returns the updated khetma from the same statement."""
+        mutation_ctes = """
+            target AS (
+                SELECT * FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = %(number)s
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'RESERVED', owner_id = %(user_id)s, owner_username = %(username)s
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id AND target.status = 'EMPTY'
+                RETURNING chapters.*
+            )
+        """
+        khetma, changed = self._mutate_with_snapshot("reserve_chapter_returning", mutation_ctes, {
+            "khetma_id": khetma_id, "number": chapter_number, "user_id": user_id, "username": username
+        })
+        if changed:
+            return khetma
+
+        chapter = khetma.get_chapter(chapter_number)
+        if chapter is None:
+            raise errors.ChapterNotFoundError()
+        elif chapter.is_reserved:
+            raise errors.ChapterAlreadyReservedError()
+        raise errors.ChapterFinishedError()
+
     def withdraw_chapter(self, khetma_id, chapter_number, user_id, is_admin=False) -> bool:
         sql_command = """
-            UPDATE chapters
-            SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
-            WHERE khetma_id = %s AND number = %s AND status = 'RESERVED'
+            WITH target AS (
+                SELECT chapter_id, status, owner_id FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = %(number)s
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id AND target.status = 'RESERVED'
+                AND (%(is_admin)s OR target.owner_id = %(user_id)s)
+                RETURNING chapters.chapter_id, chapters.khetma_id
+            ),
+            """ + _BUMP_VERSIONS_SQL + """
+            SELECT target.status, target.owner_id, EXISTS (SELECT 1 FROM changed) AS changed
+            FROM target
         """
-        params = [khetma_id, chapter_number] 
-
-        if not is_admin:
-            sql_command += " AND owner_id = %s"
-            params.append(user_id) 
+        row = self._mutate_chapter("withdraw_chapter", sql_command, {
+            "khetma_id": khetma_id, "number": chapter_number, "user_id": user_id, "is_admin": is_admin
+        })
+        if row["changed"]:
+            return True
 
-        with self.db.managed_connection() as cursor:
-            cursor.execute(sql_command, params)
-            if cursor.rowcount > 0:
-                return True
-            
-        chapter = self.get_chapter(khetma_id=khetma_id, chapter_number=chapter_number)
-        if chapter.is_available:
+        if row["status"] == Chapter.chapter_status.EMPTY.value:
             raise errors.ChapterAlreadyEmptyError()
-        elif chapter.is_finished: 
+        elif row["status"] == Chapter.chapter_status.FINISHED.value:
             raise errors.ChapterFinishedError()
-        elif chapter.is_reserved and not is_admin:
-            if user_id != chapter.owner_id:
+        elif row["status"] == Chapter.chapter_status.RESERVED.value and not is_admin:
+            if user_id != row["owner_id"]:
                 raise errors.ChapterNotOwnedError()
 
     def withdraw_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
         sql_command = """
-            UPDATE chapters
-            SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
-            WHERE owner_id = %s
-            AND status = 'RESERVED'
-            AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %s)
+            WITH changed AS (
+                UPDATE chapters
+                SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
+                WHERE owner_id = %s
+                AND status = 'RESERVED'
+                AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %s)
         """
         params = [user_id, chat_id]
 
@@ -294,7 +624,12 @@ class KhetmaStorage:
             sql_command += " AND khetma_id = %s"
             params.append(khetma_id)
 
-        sql_command += " RETURNING *"
+        sql_command += """
+                RETURNING *
+            ),
+        """ + _BUMP_VERSIONS_SQL + """
+            SELECT * FROM changed
+        """
 
         with self.db.managed_connection() as cursor:
             cursor.execute(sql_command, params)
@@ -304,32 +639,121 @@ class KhetmaStorage:
 
             return [Chapter.from_db_row(row) for row in rows]
     
+    def withdraw_chapters(self, khetma_id, chapter_numbers: list[int], user_id, is_admin=False) -> tuple[Khetma, dict]:
+        """
+        Withdraws many chapters of one khetma in a single statement.
+        Returns the updated khetma and a dict of {chapter_number: None | KhetmaError}.
+        """
+        mutation_ctes = """
+            target AS (
+                SELECT * FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = ANY(%(numbers)s)
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id AND target.status = 'RESERVED'
+                AND (%(is_admin)s OR target.owner_id = %(user_id)s)
+                RETURNING chapters.*
+            )
+        """
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+        khetma, changed = self._mutate_with_snapshot("withdraw_chapters", mutation_ctes, {
+            "khetma_id": khetma_id, "numbers": chapter_numbers, "user_id": user_id, "is_admin": is_admin
+        })
+        return khetma, withdraw_outcomes(khetma, chapter_numbers, {chapter.number for chapter in changed})
+
+    def withdraw_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        """Same as withdraw_all_user_chapters for one khetma, but also returns the updated khetma."""
+        mutation_ctes = """
+            target AS (
+                SELECT * FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND owner_id = %(user_id)s AND status = 'RESERVED'
+                AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %(chat_id)s)
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'EMPTY', owner_id = NULL, owner_username = NULL
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id
+                RETURNING chapters.*
+            )
+        """
+        khetma, changed = self._mutate_with_snapshot("withdraw_all_user_chapters_returning", mutation_ctes, {
+            "khetma_id": khetma_id, "user_id": user_id, "chat_id": chat_id
+        })
+        if not changed:
+            raise errors.NoOwnedChapters()
+        return changed, khetma
+
     def finish_chapter(self, khetma_id, chapter_number, user_id, username) -> bool:
         sql_command = """
-            UPDATE chapters
-            SET status = 'FINISHED', owner_id = %s, owner_username = %s
-            WHERE khetma_id = %s AND number = %s 
-            AND (status = 'EMPTY' OR (status = 'RESERVED' AND owner_id = %s))
+            WITH target AS (
+                SELECT chapter_id, status, owner_id FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = %(number)s
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'FINISHED', owner_id = %(user_id)s, owner_username = %(username)s
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id
+                AND (target.status = 'EMPTY' OR (target.status = 'RESERVED' AND target.owner_id = %(user_id)s))
+                RETURNING chapters.chapter_id, chapters.khetma_id
+            ),
+            """ + _BUMP_VERSIONS_SQL + """
+            SELECT target.status, target.owner_id, EXISTS (SELECT 1 FROM changed) AS changed
+            FROM target
         """
-        with self.db.managed_connection() as cursor:
-            cursor.execute(sql_command, (user_id, username, khetma_id, chapter_number, user_id))
-            if cursor.rowcount > 0:
-                return True
-
-        chapter = self.get_chapter(khetma_id=khetma_id, chapter_number=chapter_number)
+        row = self._mutate_chapter("finish_chapter", sql_command, {
+            "khetma_id": khetma_id, "number": chapter_number, "user_id": user_id, "username": username
+        })
+        if row["changed"]:
+            return True
 
-        if chapter.is_finished:
+        if row["status"] == Chapter.chapter_status.FINISHED.value:
             raise errors.ChapterFinishedError()
-        elif chapter.is_reserved and user_id != chapter.owner_id:
+        elif row["status"] == Chapter.chapter_status.RESERVED.value and user_id != row["owner_id"]:
             raise errors.ChapterNotOwnedError()
     
+    def finish_chapters(self, khetma_id, chapter_numbers: list[int], user_id, username) -> tuple[Khetma, dict]:
+        """
+        Finishes many chapters of one khetma in a single statement (one round trip).
+        Returns the updated khetma and a dict of {chapter_number: None | KhetmaError}:
+        None means the chapter was finished now, otherwise the error says why not.
+        """
+        mutation_ctes = """
+            target AS (
+                SELECT * FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND number = ANY(%(numbers)s)
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'FINISHED', owner_id = %(user_id)s, owner_username = %(username)s
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id
+                AND (target.status = 'EMPTY' OR (target.status = 'RESERVED' AND target.owner_id = %(user_id)s))
+                RETURNING chapters.*
+            )
+        """
+        chapter_numbers = unique_chapter_numbers(chapter_numbers)
+        khetma, changed = self._mutate_with_snapshot("finish_chapters", mutation_ctes, {
+            "khetma_id": khetma_id, "numbers": chapter_numbers, "user_id": user_id, "username": username
+        })
+        return khetma, finish_outcomes(khetma, chapter_numbers, {chapter.number for chapter in changed})
+
     def finish_all_user_chapters(self, chat_id, user_id, khetma_id=None) -> list[Chapter]:
         sql_command = """
-            UPDATE chapters
-            SET status = 'FINISHED'
-            WHERE owner_id = %s 
-            AND status = 'RESERVED'
-            AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %s)
+            WITH changed AS (
+                UPDATE chapters
+                SET status = 'FINISHED'
+                WHERE owner_id = %s 
+                AND status = 'RESERVED'
+                AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %s)
         """
         params = [user_id, chat_id] 
 
@@ -337,7 +761,12 @@ class KhetmaStorage:
             sql_command += " AND khetma_id = %s"
             params.append(khetma_id)
 
-        sql_command += " RETURNING *"
+        sql_command += """
+                RETURNING *
+            ),
+        """ + _BUMP_VERSIONS_SQL + """
+            SELECT * FROM changed
+        """
 
         with self.db.managed_connection() as cursor:
             cursor.execute(sql_command, params)
@@ -347,27 +776,184 @@ class KhetmaStorage:
 
             return [Chapter.from_db_row(row) for row in rows]
         
-    def calc_finished_khetmat_number(self, chat_id) -> int:
-        sql_command = "SELECT COUNT(*) AS total FROM khetmat WHERE chat_id = %s AND status = 'FINISHED'"
-        
+    def finish_all_user_chapters_returning(self, chat_id, user_id, khetma_id) -> tuple[list[Chapter], Khetma]:
+        """Same as finish_all_user_chapters for one khetma, but also returns the updated khetma."""
+        mutation_ctes = """
+            target AS (
+                SELECT * FROM chapters
+                WHERE khetma_id = %(khetma_id)s AND owner_id = %(user_id)s AND status = 'RESERVED'
+                AND khetma_id IN (SELECT khetma_id FROM khetmat WHERE chat_id = %(chat_id)s)
+                FOR UPDATE
+            ),
+            changed AS (
+                UPDATE chapters
+                SET status = 'FINISHED'
+                FROM target
+                WHERE chapters.chapter_id = target.chapter_id
+                RETURNING chapters.*
+            )
+        """
+        khetma, changed = self._mutate_with_snapshot("finish_all_user_chapters_returning", mutation_ctes, {
+            "khetma_id": khetma_id, "user_id": user_id, "chat_id": chat_id
+        })
+        if not changed:
+            raise errors.NoOwnedChapters()
+        return changed, khetma
+
+    def get_chat_counters(self, chat_id) -> dict:
+        """
+        The chat's maintained khetma counters (a primary-key read):
+        {"last_khetma_number", "active_khetmat_count", "finished_khetmat_count"}, all 0 for an unknown chat.
+        """
+        sql_command = """
+            SELECT last_khetma_number, active_khetmat_count, finished_khetmat_count
+            FROM chats WHERE chat_id = %s
+        """
+
         with self.db.managed_connection() as cursor:
             cursor.execute(sql_command, (chat_id,))
-            count = cursor.fetchone()["total"]
-            return count + 1
+            row = cursor.fetchone()
+
+        if row is None:
+            return {"last_khetma_number": 0, "active_khetmat_count": 0, "finished_khetmat_count": 0}
+        return dict(row)
+
+    def calc_finished_khetmat_number(self, chat_id) -> int:
+        return self.get_chat_counters(chat_id)["finished_khetmat_count"] + 1
     
     def calc_next_khetma_number(self, chat_id: int) -> int:
         """
         Calculates the next sequence number for a Khetma in this chat.
-        Logic: Finds the highest existing number and adds 1.
+        Logic: The chat's last handed-out number plus 1.
         Returns: 1 if it's the first Khetma.
         """
-        # COALESCE(MAX(number), 0) handles two cases:
-        # 1. No khetmas exist -> MAX is NULL -> COALESCE returns 0 -> Result: 1
-        # 2. Max is 5 -> Returns 5 -> Result: 6
-        sql = "SELECT COALESCE(MAX(number), 0) + 1 AS next_num FROM khetmat WHERE chat_id = %s"
-        
+        return self.get_chat_counters(chat_id)["last_khetma_number"] + 1
+
+    def get_finished_khetmat(self, chat_id, limit=10) -> list[Khetma]:
+        """
+        The chat's most recent FINISHED khetmat (newest first, with their chapters),
+        whether they are still in the hot tables or already archived.
+        """
+        sql_command = f"""
+            (
+                SELECT khetmat.khetma_id, khetmat.chat_id, khetmat.number, khetmat.status, khetmat.version,
+                    (
+                        SELECT json_agg(chapters ORDER BY chapters.number)
+                        FROM chapters
+                        WHERE chapters.khetma_id = khetmat.khetma_id
+                    ) AS chapters
+                FROM khetmat
+                WHERE chat_id = %(chat_id)s AND status = 'FINISHED'
+                ORDER BY number DESC LIMIT %(limit)s
+            )
+            UNION ALL
+            (
+                SELECT {_ARCHIVED_KHETMA_COLUMNS} FROM khetmat_archive
+                WHERE chat_id = %(chat_id)s
+                ORDER BY number DESC LIMIT %(limit)s
+            )
+            ORDER BY number DESC LIMIT %(limit)s
+        """
+
         with self.db.managed_connection() as cursor:
-            cursor.execute(sql, (chat_id,))
-            return cursor.fetchone()["next_num"]
-        
+            cursor.execute(sql_command, {"chat_id": chat_id, "limit": limit})
+            khetma_rows = cursor.fetchall()
+
+        return [Khetma.from_db_row(khetma_row, khetma_row["chapters"] or []) for khetma_row in khetma_rows]
+
+    def archive_finished_khetmat(self, chat_id=None, batch_size=500) -> int:
+        """
+        Moves up to `batch_size` FINISHED khetmat (and their 30 chapters) from the hot tables
+        to khetmat_archive/chapters_archive, in one statement. Khetmat locked by a running
+        write are skipped and picked up by a later batch.
+        Returns: how many khetmat were archived (less than batch_size means none are left).
+        """
+        chat_filter = "AND chat_id = %(chat_id)s" if chat_id else ""
+        sql_command = f"""
+            WITH picked AS (
+                SELECT khetma_id FROM khetmat
+                WHERE status = 'FINISHED' {chat_filter}
+                ORDER BY khetma_id
+                LIMIT %(batch_size)s
+                FOR UPDATE SKIP LOCKED
+            ),
+            moved_chapters AS (
+                DELETE FROM chapters WHERE khetma_id IN (SELECT khetma_id FROM picked)
+                RETURNING chapter_id, khetma_id, number, status, owner_id, owner_username
+            ),
+            moved_khetmat AS (
+                DELETE FROM khetmat WHERE khetma_id IN (SELECT khetma_id FROM picked)
+                RETURNING khetma_id, chat_id, number, status, version
+            ),
+            archived_khetmat AS (
+                INSERT INTO khetmat_archive (khetma_id, chat_id, number, status, version)
+                SELECT * FROM moved_khetmat
+                RETURNING khetma_id
+            ),
+            archived_chapters AS (
+                INSERT INTO chapters_archive (chapter_id, khetma_id, number, status, owner_id, owner_username)
+                SELECT * FROM moved_chapters
+            )
+            SELECT COUNT(*) AS archived FROM archived_khetmat
+        """
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, {"chat_id": chat_id, "batch_size": batch_size})
+            return cursor.fetchone()["archived"]
 
+    def get_reading_stats(self, chat_id, user_id) -> dict:
+        """
+        A member's reading counters in a chat (a primary-key read, kept up to date by a trigger):
+        {"user_id", "username", "chapters_finished", "khetmat_participated"}, 0s if they never finished a chapter.
+        """
+        sql_command = """
+            SELECT user_id, username, chapters_finished, khetmat_participated
+            FROM reading_stats WHERE chat_id = %s AND user_id = %s
+        """
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, (chat_id, user_id))
+            row = cursor.fetchone()
+
+        if row is None:
+            return {"user_id": user_id, "username": None, "chapters_finished": 0, "khetmat_participated": 0}
+        return dict(row)
+
+    def get_reading_leaderboard(self, chat_id, limit=10) -> list[dict]:
+        """The chat's members who finished the most chapters (same dicts as get_reading_stats), top first."""
+        sql_command = """
+            SELECT user_id, username, chapters_finished, khetmat_participated
+            FROM reading_stats
+            WHERE chat_id = %s AND chapters_finished > 0
+            ORDER BY chapters_finished DESC, khetmat_participated DESC, user_id
+            LIMIT %s
+        """
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, (chat_id, limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def save_user(self, user_id, username, first_name):
+        """Upserts a user's current names and stamps last_seen."""
+        sql_command = """
+            INSERT INTO users (user_id, username, first_name, last_seen)
+            VALUES (%s, %s, %s, now())
+            ON CONFLICT (user_id) DO UPDATE SET
+                username = EXCLUDED.username,
+                first_name = EXCLUDED.first_name,
+                last_seen = EXCLUDED.last_seen
+        """
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, (user_id, username, first_name))
+
+    def get_users(self, user_ids: list) -> dict[int, dict]:
+        """{user_id: {"user_id", "username", "first_name", "last_seen"}} for the ids that have a users row."""
+        if not user_ids:
+            return {}
+
+        sql_command = "SELECT user_id, username, first_name, last_seen FROM users WHERE user_id = ANY(%s)"
+
+        with self.db.managed_connection() as cursor:
+            cursor.execute(sql_command, (list(user_ids),))
+            return {row["user_id"]: dict(row) for row in cursor.fetchall()}
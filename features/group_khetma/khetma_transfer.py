@@ -0,0 +1,233 @@
+import logging
+
+# Local modules
+import storage_manager
+
+logger = logging.getLogger(__name__)
+
+FORMAT_HEADER = "KHETMA-EXPORT 1"
+
+# Exported tables and columns, in load order. Ids are exported so rows can be tied together,
+# but the import hands out fresh ones (the target database has its own sequences).
+TABLES = {
+    "chats": ["chat_id", "last_khetma_number", "active_khetmat_count", "finished_khetmat_count"],
+    "khetmat": ["khetma_id", "chat_id", "number", "status"],
+    "chapters": ["chapter_id", "khetma_id", "number", "status", "owner_id", "owner_username"],
+    "khetmat_archive": ["khetma_id", "chat_id", "number", "status", "archived_at"],
+    "chapters_archive": ["chapter_id", "khetma_id", "number", "status", "owner_id", "owner_username"],
+    "reading_stats": ["chat_id", "user_id", "username", "chapters_finished", "khetmat_participated", "last_finished_at"],
+}
+
+# Temp tables the import COPYs into before moving rows to the real tables
+_STAGING_TABLES = [
+    "CREATE TEMP TABLE import_chats (chat_id BIGINT PRIMARY KEY, last_khetma_number INTEGER, active_khetmat_count INTEGER, finished_khetmat_count INTEGER)",
+    "CREATE TEMP TABLE import_khetmat (khetma_id INTEGER PRIMARY KEY, chat_id BIGINT, number INTEGER, status TEXT)",
+    "CREATE TEMP TABLE import_chapters (chapter_id INTEGER, khetma_id INTEGER, number INTEGER, status TEXT, owner_id BIGINT, owner_username TEXT)",
+    "CREATE TEMP TABLE import_khetmat_archive (khetma_id INTEGER PRIMARY KEY, chat_id BIGINT, number INTEGER, status TEXT, archived_at TIMESTAMPTZ)",
+    "CREATE TEMP TABLE import_chapters_archive (chapter_id INTEGER, khetma_id INTEGER, number INTEGER, status TEXT, owner_id BIGINT, owner_username TEXT)",
+    "CREATE TEMP TABLE import_reading_stats (chat_id BIGINT, user_id BIGINT, username TEXT, chapters_finished INTEGER, khetmat_participated INTEGER, last_finished_at TIMESTAMPTZ)",
+]
+
+# Moves one batch of staged chats (keyset-paginated by chat_id) into the real tables.
+# Chats that already have khetmat in this database are skipped, so a re-run after a
+# failure picks up where it stopped.
+_IMPORT_BATCH_SQL = """
+    WITH batch AS (
+        SELECT chat_id FROM import_chats
+        WHERE %(after)s::BIGINT IS NULL OR chat_id > %(after)s
+        ORDER BY chat_id
+        LIMIT %(batch_size)s
+    ),
+    fresh AS (
+        SELECT chat_id FROM batch
+        WHERE NOT EXISTS (SELECT 1 FROM khetmat WHERE khetmat.chat_id = batch.chat_id)
+        AND NOT EXISTS (SELECT 1 FROM khetmat_archive WHERE khetmat_archive.chat_id = batch.chat_id)
+    ),
+    imported_chats AS (
+        INSERT INTO chats (chat_id, last_khetma_number, active_khetmat_count, finished_khetmat_count)
+        SELECT import_chats.* FROM import_chats JOIN fresh USING (chat_id)
+        ON CONFLICT (chat_id) DO UPDATE SET
+            last_khetma_number = EXCLUDED.last_khetma_number,
+            active_khetmat_count = EXCLUDED.active_khetmat_count,
+            finished_khetmat_count = EXCLUDED.finished_khetmat_count
+    ),
+    hot AS (
+        INSERT INTO khetmat (chat_id, number, status)
+        SELECT chat_id, number, status FROM import_khetmat JOIN fresh USING (chat_id)
+        RETURNING khetma_id, chat_id, number
+    ),
+    hot_chapters AS (
+        INSERT INTO chapters (khetma_id, number, status, owner_id, owner_username)
+        SELECT hot.khetma_id, staged.number, staged.status, staged.owner_id, staged.owner_username
+        FROM import_chapters AS staged
+        JOIN import_khetmat ON import_khetmat.khetma_id = staged.khetma_id
+        JOIN hot ON hot.chat_id = import_khetmat.chat_id AND hot.number = import_khetmat.number
+    ),
+    archived AS (
+        -- Archived ids come from the same sequences as live ones, so they never collide
+        INSERT INTO khetmat_archive (khetma_id, chat_id, number, status, archived_at)
+        SELECT nextval(pg_get_serial_sequence('khetmat', 'khetma_id')), chat_id, number, status, archived_at
+        FROM import_khetmat_archive JOIN fresh USING (chat_id)
+        RETURNING khetma_id, chat_id, number
+    ),
+    archived_chapters AS (
+        INSERT INTO chapters_archive (chapter_id, khetma_id, number, status, owner_id, owner_username)
+        SELECT nextval(pg_get_serial_sequence('chapters', 'chapter_id')),
+            archived.khetma_id, staged.number, staged.status, staged.owner_id, staged.owner_username
+        FROM import_chapters_archive AS staged
+        JOIN import_khetmat_archive ON import_khetmat_archive.khetma_id = staged.khetma_id
+        JOIN archived ON archived.chat_id = import_khetmat_archive.chat_id AND archived.number = import_khetmat_archive.number
+    ),
+    stats AS (
+        -- Chapters arrive as INSERTs, which the reading stats trigger doesn't count, so the
+        -- exported counters come along as they are
+        INSERT INTO reading_stats (chat_id, user_id, username, chapters_finished, khetmat_participated, last_finished_at)
+        SELECT import_reading_stats.* FROM import_reading_stats JOIN fresh USING (chat_id)
+        ON CONFLICT (chat_id, user_id) DO UPDATE SET
+            username = EXCLUDED.username,
+            chapters_finished = EXCLUDED.chapters_finished,
+            khetmat_participated = EXCLUDED.khetmat_participated,
+            last_finished_at = EXCLUDED.last_finished_at
+    )
+    SELECT
+        (SELECT MAX(chat_id) FROM batch) AS last_chat_id,
+        (SELECT COUNT(*) FROM batch) AS batch_chats,
+        (SELECT COUNT(*) FROM fresh) AS imported_chats,
+        (SELECT COUNT(*) FROM hot) + (SELECT COUNT(*) FROM archived) AS imported_khetmat
+"""
+
+class _CopySection:
+    """File-like view of one section of an export: read() stops at the section's `\\.` line."""
+    def __init__(self, source):
+        self.source = source
+        self.done = False
+
+    def read(self, size=-1) -> str:
+        chunks, length = [], 0
+        while not self.done and (size is None or size < 0 or length < size):
+            line = self.source.readline()
+            if not line:
+                raise ValueError("Truncated khetma export: a section has no \\. terminator")
+            if line.rstrip("\n") == "\\.":
+                self.done = True
+                break
+            chunks.append(line)
+            length += len(line)
+        return "".join(chunks)
+
+class KhetmaTransfer:
+    """
+    Streams khetma data between a database and a line-oriented text file through COPY,
+    one table section after the other, so memory use doesn't grow with the data:
+
+        KHETMA-EXPORT 1
+        COPY khetmat (khetma_id, chat_id, number, status)
+        <COPY text-format rows>
+        \\.
+        ...
+    """
+    def __init__(self, db_core: storage_manager.StorageManager):
+        self.db = db_core
+
+    def export_chats(self, out, chat_id=None) -> dict:
+        """
+        Writes one chat (or every chat) to the text file `out`, from a single consistent snapshot.
+        Returns: {table: rows written}.
+        """
+        counts = {}
+        with self.db.managed_connection() as cursor:
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY")
+            out.write(FORMAT_HEADER + "\n")
+
+            for table, columns in TABLES.items():
+                column_list = ", ".join(columns)
+                out.write(f"COPY {table} ({column_list})\n")
+                cursor.copy_expert(
+                    cursor.mogrify(f"COPY ({self._export_query(table, column_list, chat_id)}) TO STDOUT", {"chat_id": chat_id}).decode(),
+                    out
+                )
+                out.write("\\.\n")
+                counts[table] = cursor.rowcount
+
+        return counts
+
+    @staticmethod
+    def _export_query(table, column_list, chat_id) -> str:
+        if chat_id is None:
+            return f"SELECT {column_list} FROM {table}"
+        if table in ("chats", "khetmat", "khetmat_archive", "reading_stats"):
+            return f"SELECT {column_list} FROM {table} WHERE chat_id = %(chat_id)s"
+
+        parent = "khetmat" if table == "chapters" else "khetmat_archive"
+        return f"""
+            SELECT {column_list} FROM {table}
+            WHERE khetma_id IN (SELECT khetma_id FROM {parent} WHERE chat_id = %(chat_id)s)
+        """
+
+    def import_chats(self, source, batch_size=100) -> dict:
+        """
+        Loads an export from the text file `source`: every section is COPYed into a temp
+        staging table, then chats are moved into the real tables `batch_size` at a time,
+        one transaction per batch. Chats that already have khetmat here are skipped.
+        Returns: {"chats": imported, "khetmat": imported, "skipped_chats": skipped}.
+        """
+        header = source.readline().rstrip("\n")
+        if header != FORMAT_HEADER:
+            raise ValueError(f"Not a khetma export (header {header!r})")
+
+        totals = {"chats": 0, "khetmat": 0, "skipped_chats": 0}
+
+        with self.db.autocommit_connection() as conn:
+            with conn.cursor() as cursor:
+                try:
+                    for statement in _STAGING_TABLES:
+                        cursor.execute(statement)
+                    self._load_staging(cursor, source)
+
+                    after = None
+                    while True:
+                        cursor.execute("BEGIN")
+                        try:
+                            cursor.execute(_IMPORT_BATCH_SQL, {"after": after, "batch_size": batch_size})
+                            batch = cursor.fetchone()
+                            cursor.execute("COMMIT")
+                        except Exception:
+                            cursor.execute("ROLLBACK")
+                            raise
+
+                        if not batch["batch_chats"]:
+                            break
+                        after = batch["last_chat_id"]
+                        totals["chats"] += batch["imported_chats"]
+                        totals["khetmat"] += batch["imported_khetmat"]
+                        totals["skipped_chats"] += batch["batch_chats"] - batch["imported_chats"]
+                        logger.info(f"Imported khetma data up to chat {after}: {totals}")
+                finally:
+                    for table in TABLES:
+                        cursor.execute(f"DROP TABLE IF EXISTS import_{table}")
+
+        return totals
+
+    def _load_staging(self, cursor, source):
+        while True:
+            line = source.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+
+            keyword, table, column_list = line.rstrip("\n").split(" ", 2)
+            columns = [column.strip() for column in column_list.strip("()").split(",")]
+            if keyword != "COPY" or table not in TABLES or not set(columns) <= set(TABLES[table]):
+                raise ValueError(f"Unexpected section in khetma export: {line.strip()!r}")
+
+            cursor.copy_expert(f"COPY import_{table} ({', '.join(columns)}) FROM STDIN", _CopySection(source))
+
+        # Each batch joins its chats' rows out of the staging tables
+        cursor.execute("CREATE INDEX ON import_khetmat (chat_id)")
+        cursor.execute("CREATE INDEX ON import_chapters (khetma_id)")
+        cursor.execute("CREATE INDEX ON import_khetmat_archive (chat_id)")
+        cursor.execute("CREATE INDEX ON import_chapters_archive (khetma_id)")
+        cursor.execute("CREATE INDEX ON import_reading_stats (chat_id)")
+        for table in TABLES:
+            cursor.execute(f"ANALYZE import_{table}")
@@ -25,6 +25,10 @@ TEXT_TEMPLATES = {
     "finish_chapter_body": "لقد قرأت الجزء {chapter_num} من الختمة {khetma_num} ✅",
     "finish_chapter_footer": "جزاك الله خيراً 🤍",
     "finish_chapter_error": "بالنسبة للجزء {chapter_num} من الختمة {khetma_num}: {erro_message}",
+    "stats_header": "📊 أكثر المشاركين قراءةً في المجموعة:",
+    "stats_row": "{rank}. {username}: {chapters} جزء في {khetmat} ختمة",
+    "stats_own": "أنت: {chapters} جزء في {khetmat} ختمة",
+    "stats_empty": "لم يُقرأ أي جزء في هذه المجموعة بعد.",
     "completed_khetma":(
         f"🎉 *اكتملت الختمة رقم {{khetma_num}}!*\n"
         "━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━\n"
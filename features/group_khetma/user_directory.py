@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+from telegram import error as TelegramError
+
+# Local modules
+from features.group_khetma.async_khetma_storage import AsyncKhetmaStorage
+
+class UserDirectory:
+    """
+    Display names of the users the bot has seen, from the `users` table with an LRU in front.
+
+    record() takes the effective_user every update already carries and upserts it, but only
+    when a name changed or last_seen is older than `touch_interval` seconds, so a busy chat
+    doesn't cost one write per message. display_names() serves ids from the LRU and fetches
+    the misses in one query; names older than `ttl` seconds count as misses, so a rename seen
+    by another replica shows up here too. resolve() also asks Telegram about the ids the table
+    doesn't know, at most `resolve_concurrency` at a time. Lives on the event loop, so it needs no lock.
+    """
+    def __init__(self, storage: AsyncKhetmaStorage, max_users=10000, touch_interval=3600.0, ttl=3600.0, resolve_concurrency=8):
+        self.storage = storage
+        self.max_users = max_users
+        self.touch_interval = touch_interval
+        self.ttl = ttl
+        self.resolve_concurrency = resolve_concurrency
+
+        # user_id -> (username, first_name, touched_at, loaded_at) (LRU order)
+        self._users: OrderedDict[int, tuple] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.writes = 0
+        self.evictions = 0
+
+    @staticmethod
+    def display_name(username, first_name) -> str | None:
+        """"@username", or the first name of users without one (what chapters show as their owner)."""
+        if username:
+            return f"@{username}"
+        return first_name
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "expired": self.expired,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "cached_users": len(self._users),
+        }
+
+    def _store(self, user_id, username, first_name, touched_at, loaded_at):
+        self._users[user_id] = (username, first_name, touched_at, loaded_at)
+        self._users.move_to_end(user_id)
+        while len(self._users) > self.max_users:
+            self._users.popitem(last=False)
+            self.evictions += 1
+
+    async def record(self, user) -> str | None:
+        """Remembers a telegram User seen on an update. Returns: their display name."""
+        now = time.monotonic()
+        cached = self._users.get(user.id)
+
+        if cached is None or cached[:2] != (user.username, user.first_name) or now - cached[2] >= self.touch_interval:
+            await self.storage.save_user(user.id, user.username, user.first_name)
+            self.writes += 1
+            self._store(user.id, user.username, user.first_name, now, now)
+        else:
+            self._users.move_to_end(user.id)
+
+        return self.display_name(user.username, user.first_name)
+
+    async def display_names(self, user_ids) -> dict[int, str | None]:
+        """{user_id: display name} for the given ids; ids the bot has never seen are left out."""
+        now = time.monotonic()
+        names, missing = {}, []
+        for user_id in dict.fromkeys(user_ids):
+            cached = self._users.get(user_id)
+            if cached is None or now - cached[3] >= self.ttl:
+                self.misses += 1
+                if cached is not None:
+                    self.expired += 1
+                missing.append(user_id)
+                continue
+            self.hits += 1
+            self._users.move_to_end(user_id)
+            name = self.display_name(cached[0], cached[1])
+            if name is not None:
+                names[user_id] = name
+
+        if missing:
+            rows = await self.storage.get_users(missing)
+            for user_id in missing:
+                # Loaded rows count as never touched, so the user's next update stamps last_seen.
+                # Ids with no row are cached nameless too, so they aren't looked up again until they expire.
+                row = rows.get(user_id, {"username": None, "first_name": None})
+                self._store(user_id, row["username"], row["first_name"], float("-inf"), now)
+                name = self.display_name(row["username"], row["first_name"])
+                if name is not None:
+                    names[user_id] = name
+
+        return names
+
+    async def resolve(self, bot, chat_id: int, user_ids) -> dict[int, str | None]:
+        """
+        display_names(), plus get_chat_member for the ids it left out, run concurrently
+        (a semaphore bounds the calls in flight). Members found that way are recorded.
+        Ids Telegram can't resolve either (e.g. members who left) are left out.
+        """
+        user_ids = list(dict.fromkeys(user_ids))
+        names = await self.display_names(user_ids)
+        semaphore = asyncio.Semaphore(self.resolve_concurrency)
+
+        async def fetch(user_id):
+            async with semaphore:
+                try:
+                    member = await bot.get_chat_member(chat_id, user_id)
+                except TelegramError.TelegramError:
+                    return
+            names[user_id] = await self.record(member.user)
+
+        await asyncio.gather(*(fetch(user_id) for user_id in user_ids if user_id not in names))
+        return names
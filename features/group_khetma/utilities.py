@@ -1,37 +1,57 @@
 import re
-from telegram.constants import ChatMemberStatus
+from telegram.constants import MessageLimit
 from telegram.ext import ContextTypes
 
 # Local imports
 from features.group_khetma.class_khetma import Khetma
+from features.group_khetma.admin_cache import AdminCache
 
 async def is_user_admin(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """
     Checks if a user is an Admin or the Creator of the group.
+    (Answered from the cached administrators list, which only calls Telegram for new or expired chats.)
     """
-    try:
-        member = await context.bot.get_chat_member(chat_id, user_id)
-        # Check if status is 'administrator' or 'creator'
-        return member.status in [ChatMemberStatus.ADMINISTRATOR, ChatMemberStatus.OWNER]
-    except Exception:
-        # If user is not found or bot has no access, assume False
-        return False
+    admins: AdminCache = context.bot_data["admin_cache"]
+    return await admins.is_admin(context.bot, chat_id, user_id)
 
-async def get_username(chat_id: int, user_id: int, context: ContextTypes.DEFAULT_TYPE) -> str:
+def utf16_len(text: str) -> int:
+    """Length the way Telegram counts it: in UTF-16 code units, so an emoji outside the BMP counts 2."""
+    return len(text.encode("utf-16-le")) // 2
+
+def _utf16_cut(line: str, limit: int) -> int:
+    """Index of the longest prefix of `line` within `limit` code units (never splitting a character)."""
+    units = 0
+    for index, char in enumerate(line):
+        units += 2 if ord(char) > 0xFFFF else 1
+        if units > limit:
+            return index
+    return len(line)
+
+def split_message(text: str, limit: int = MessageLimit.MAX_TEXT_LENGTH) -> list[str]:
     """
-    Fetches the user's @username. If they don't have one, returns their First Name.
+    Splits a message into parts Telegram accepts (4096 UTF-16 code units each), at line breaks
+    where possible and mid-line only for lines longer than a whole message.
     """
-    try:
-        member = await context.bot.get_chat_member(chat_id, user_id)
-        user = member.user
-        
-        if user.username:
-            return f"@{user.username}"
-        else:
-            return user.first_name
-            
-    except Exception:
-        return "Unknown User"
+    parts, current, current_len = [], "", 0
+    for line in text.splitlines(keepends=True):
+        line_len = utf16_len(line)
+        while line_len > limit:
+            if current:
+                parts.append(current)
+                current, current_len = "", 0
+            cut = _utf16_cut(line, limit)
+            parts.append(line[:cut])
+            line = line[cut:]
+            line_len = utf16_len(line)
+        if current_len + line_len > limit:
+            parts.append(current)
+            current, current_len = "", 0
+        current += line
+        current_len += line_len
+    if current:
+        parts.append(current)
+
+    return [part.strip() for part in parts if part.strip()]
 
 def extract_arabic_numbers(text: str) -> list[int]:
     """
@@ -260,14 +280,9 @@ def number_to_ordinal_arabic(n: int) -> str:
 
 
 def create_khetma_message(khetma: Khetma) -> str:
-    available = reserved = finished = 0
-    for ch in khetma.chapters:
-        if ch.is_available:
-            available += 1
-        elif ch.is_reserved:
-            reserved += 1
-        else:
-            finished += 1
+    reserved = khetma.reserved_mask.bit_count()
+    finished = khetma.finished_mask.bit_count()
+    available = 30 - reserved - finished
 
     message = (
         f"**الختمة رقم -> {khetma.number} | {"مستمرة" if khetma.status.value == "ACTIVE" else "منتهية"}**\n"
@@ -1,4 +1,5 @@
-from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, filters
+from telegram import Update
+from telegram.ext import CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, ChatMemberHandler, filters
 
 # Local imports
 from main_commands import start_command, help_command, settings_command
@@ -11,13 +12,15 @@ def main_commands_handler():
 
 def khetma_handlers(): 
     # Khetma Feature Handlers
+    # (group -1: every update's sender goes to the users table before the handlers below run)
+    bot_app.add_handler(TypeHandler(Update, record_user_handler), group=-1)
+    bot_app.add_handler(ChatMemberHandler(chat_member_handler, ChatMemberHandler.ANY_CHAT_MEMBER))
+
     bot_app.add_handler(CommandHandler("new_khetma", start_khetma_command))
+    bot_app.add_handler(CommandHandler("stats", stats_command))
 
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, finish_message_handler), group=0)
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, my_chapters_handler), group=1)
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, available_chapters_handler), group=2)
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_withdraw_handler), group=3)
-    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, remind_handler), group=4)
+    # One handler for every text trigger: the router picks at most one khetma handler per message
+    bot_app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, intent_router.handle))
     
     bot_app.add_handler(CallbackQueryHandler(handle_khetma_buttons, pattern="^reserve"))
     bot_app.add_handler(CallbackQueryHandler(handle_khetma_buttons, pattern="^info"))
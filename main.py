@@ -1,12 +1,24 @@
 import logging
 import os
+from decouple import config
 from telegram import Update
 from telegram import error as TelegramErrors
 from telegram.ext import ContextTypes
 
 # Database calls
 from storage_manager import StorageManager
+from sqlite_storage_manager import SQLiteStorageManager
 from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.khetma_sqlite_storage import SQLiteKhetmaStorage
+from features.group_khetma.khetma_memory_storage import InMemoryKhetmaStorage
+from features.group_khetma.async_khetma_storage import AsyncKhetmaStorage
+from features.group_khetma.khetma_cache import CachedKhetmaStorage
+from features.group_khetma.khetma_notifications import KhetmaChangeListener
+from features.group_khetma.khetma_archiver import KhetmaArchiver
+from features.group_khetma.user_directory import UserDirectory
+from features.group_khetma.admin_cache import AdminCache
+from features.group_khetma.edit_coalescer import EditCoalescer
+from features.group_khetma.khetma_handlers import reply_database_error
 from features.group_khetma import errors
 
 # Local modules
@@ -26,6 +38,14 @@ async def global_error_handler(update: object, context: ContextTypes.DEFAULT_TYP
     if isinstance(error, TelegramErrors.BadRequest):
         return
 
+    # Database unavailable (e.g. pool exhausted): unlike the domain errors below, nothing has
+    # answered the user yet, and it's worth a log line
+    if isinstance(error, errors.DatabaseConnectionError):
+        logger.warning(f"Database unavailable while handling an update: {error.__cause__ or error}")
+        if isinstance(update, Update):
+            await reply_database_error(update, error)
+        return
+
     # IGNORE: Custom errors
     if isinstance(error, errors.KhetmaError):
         return
@@ -52,10 +72,39 @@ def main(argv=None):
     bot_app.add_error_handler(global_error_handler)
     
     # Initialize Database
-    db_core = StorageManager()
-    
+    # (STORAGE_BACKEND=sqlite runs on an embedded file, for single-node deployments without a DB server;
+    #  STORAGE_BACKEND=memory keeps nothing across restarts, for trying the bot out and benchmarks)
+    storage_backend = config("STORAGE_BACKEND", default="postgres")
+    if storage_backend == "sqlite":
+        db_core = SQLiteStorageManager()
+        khetma_storage = SQLiteKhetmaStorage(db_core)
+    elif storage_backend == "memory":
+        db_core = None
+        khetma_storage = InMemoryKhetmaStorage()
+    else:
+        db_core = StorageManager()
+        # (the chapter triggers keep the bitmaps on every write regardless, so reading them is free)
+        khetma_storage = KhetmaStorage(
+            db_core,
+            bitmap_reads=config("KHETMA_BITMAP_READS", default=True, cast=bool),
+            # Server-side prepared statements don't survive a transaction-pooling proxy (PgBouncer)
+            prepared_statements=config("DB_PREPARED_STATEMENTS", default=True, cast=bool)
+        )
+
     # Khetma feature storage wrapper
-    khetma_storage_engine = KhetmaStorage(db_core)
+    # (the cache keeps active khetmat in memory, the async engine keeps blocking DB calls off the event loop)
+    khetma_cache = CachedKhetmaStorage(khetma_storage)
+    khetma_storage_engine = AsyncKhetmaStorage(khetma_cache)
+
+    # Evicts khetmat changed by the other replicas (LISTEN/NOTIFY), so each one can cache freely
+    # (an embedded database has no other replicas)
+    if isinstance(db_core, StorageManager):
+        khetma_change_listener = KhetmaChangeListener(db_core.dsn, khetma_cache, origin=db_core.instance_id)
+        khetma_change_listener.start()
+
+    # Moves finished khetmat to the archive tables in the background, so the hot ones stay small
+    khetma_archiver = KhetmaArchiver(khetma_storage, interval=config("KHETMA_ARCHIVE_INTERVAL", default=3600.0, cast=float))
+    khetma_archiver.start()
 
     # ==================================================================
     # INJECTIONS:
@@ -63,6 +112,9 @@ def main(argv=None):
     # Now it travels with the bot everywhere.
     # ==================================================================
     bot_app.bot_data["khetma_storage"] = khetma_storage_engine
+    bot_app.bot_data["user_directory"] = UserDirectory(khetma_storage_engine)
+    bot_app.bot_data["admin_cache"] = AdminCache(ttl=config("ADMIN_CACHE_TTL", default=600.0, cast=float))
+    bot_app.bot_data["edit_coalescer"] = EditCoalescer(window=config("KHETMA_EDIT_WINDOW", default=0.5, cast=float))
     
     # Main commands:
     main_commands_handler()
@@ -77,7 +129,9 @@ def main(argv=None):
     bot_app.run_webhook(
     listen="0.0.0.0",
     port=int(os.environ.get("PORT", 8443)),
-    webhook_url=WEBHOOK_URL  # e.g. https://yourapp.railway.app/webhook
+    webhook_url=WEBHOOK_URL,  # e.g. https://yourapp.railway.app/webhook
+    # chat_member updates are opt-in, and the admin cache lives on them
+    allowed_updates=Update.ALL_TYPES
     )
 
 if __name__ == "__main__":
@@ -0,0 +1,27 @@
+import logging
+
+# Local modules
+from storage_manager import StorageManager
+from features.group_khetma import khetma_migrations
+
+# Applies pending schema migrations ahead of a deploy, against the live database:
+# python migrate.py
+#
+# Index builds use CREATE INDEX CONCURRENTLY, so the running bot keeps serving while this runs.
+# The bot also applies anything still pending on startup.
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    db_core = StorageManager()
+    applied = db_core.apply_migrations(khetma_migrations.COMPONENT, khetma_migrations.MIGRATIONS)
+
+    if applied:
+        logging.info(f"Applied {khetma_migrations.COMPONENT} migrations: {applied}")
+    else:
+        logging.info("Schema is already up to date.")
+
+    db_core.pool.closeall()
+
+if __name__ == "__main__":
+    main()
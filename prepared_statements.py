@@ -0,0 +1,107 @@
+import re
+import threading
+import time
+import weakref
+from psycopg2 import errors as pg_errors
+
+# psycopg2-style named placeholders, e.g. %(khetma_id)s
+_NAMED_PARAM = re.compile(r"%\((\w+)\)s")
+
+class PreparedStatement:
+    """One registered statement: its psycopg2 SQL rewritten for PREPARE, plus timing counters."""
+    def __init__(self, name: str, sql: str):
+        self.name = name
+        self.sql = sql
+        self.param_names = []
+
+        def to_positional(match):
+            if match.group(1) not in self.param_names:
+                self.param_names.append(match.group(1))
+            return f"${self.param_names.index(match.group(1)) + 1}"
+
+        self.server_sql = _NAMED_PARAM.sub(to_positional, sql).replace("%%", "%")
+        placeholders = ", ".join(["%s"] * len(self.param_names))
+        self.execute_sql = f"EXECUTE {name} ({placeholders})" if self.param_names else f"EXECUTE {name}"
+
+        self.prepares = 0
+        self.prepare_time = 0.0
+        self.executions = 0
+        self.execute_time = 0.0
+
+class PreparedStatementRegistry:
+    """
+    Hot statements are PREPAREd once per pooled connection and then run with EXECUTE,
+    so Postgres parses them once and can reuse a plan instead of re-planning every click.
+
+    Statements are written with psycopg2 named parameters (%(name)s) like everything else
+    and registered on first use. If the server loses a statement (DISCARD ALL, or a schema
+    change altered a `SELECT *` result), that connection re-prepares everything on its next use.
+    """
+    def __init__(self):
+        self._statements: dict[str, PreparedStatement] = {}
+        self._prepared = weakref.WeakKeyDictionary() # connection -> names prepared on it
+        self._stale = weakref.WeakSet()              # connections that must DEALLOCATE ALL first
+        self._lock = threading.Lock()
+
+    def execute(self, cursor, name: str, sql: str, params: dict):
+        statement = self._register(name, sql)
+        conn = cursor.connection
+
+        with self._lock:
+            if conn in self._stale:
+                self._stale.discard(conn)
+                self._prepared.pop(conn, None)
+                reset = True
+            else:
+                reset = False
+            prepared = self._prepared.setdefault(conn, set())
+
+        if reset:
+            cursor.execute("DEALLOCATE ALL")
+
+        if name not in prepared:
+            started = time.perf_counter()
+            cursor.execute(f"PREPARE {name} AS {statement.server_sql}")
+            self._record(statement, "prepare", time.perf_counter() - started)
+            prepared.add(name)
+
+        started = time.perf_counter()
+        try:
+            cursor.execute(statement.execute_sql, [params[param] for param in statement.param_names])
+        except (pg_errors.InvalidSqlStatementName, pg_errors.FeatureNotSupported):
+            with self._lock:
+                self._stale.add(conn)
+            raise
+        self._record(statement, "execute", time.perf_counter() - started)
+
+    def _register(self, name, sql) -> PreparedStatement:
+        statement = self._statements.get(name)
+        if statement is None:
+            with self._lock:
+                statement = self._statements.setdefault(name, PreparedStatement(name, sql))
+        if statement.sql != sql:
+            raise ValueError(f"Prepared statement {name!r} is already registered with different SQL")
+        return statement
+
+    def _record(self, statement: PreparedStatement, phase: str, elapsed: float):
+        with self._lock:
+            if phase == "prepare":
+                statement.prepares += 1
+                statement.prepare_time += elapsed
+            else:
+                statement.executions += 1
+                statement.execute_time += elapsed
+
+    def stats(self) -> dict:
+        """Per statement: how often it was prepared/executed and the time spent in each (seconds)."""
+        with self._lock:
+            return {
+                name: {
+                    "prepares": statement.prepares,
+                    "prepare_time": statement.prepare_time,
+                    "executions": statement.executions,
+                    "execute_time": statement.execute_time,
+                    "avg_execute_time": statement.execute_time / statement.executions if statement.executions else 0.0,
+                }
+                for name, statement in self._statements.items()
+            }
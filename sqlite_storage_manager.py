@@ -0,0 +1,136 @@
+import logging
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from decouple import config
+
+# Local modules
+from storage_manager import Migration
+
+logger = logging.getLogger(__name__)
+
+# Applied to every connection; journal_mode=WAL lets readers keep reading while the writer commits
+_PRAGMAS = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",   # durable at checkpoints, safe against corruption in WAL mode
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",    # 16 MB page cache per connection
+    "PRAGMA mmap_size = 134217728",  # 128 MB
+]
+
+def _dict_row(cursor, row) -> dict:
+    """Rows as plain dicts, like RealDictCursor rows on the PostgreSQL side."""
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+class SQLiteStorageManager:
+    """
+    Embedded SQLite database for single-node deployments and local development.
+
+    SQLite allows one writer at a time, so there is exactly one write connection
+    (behind a lock, every transaction BEGIN IMMEDIATE) plus a small pool of read
+    connections that, in WAL mode, never wait on the writer.
+    """
+    def __init__(self, path=None, max_readers=4):
+        self.path = path or config("SQLITE_PATH", default="khetma_bot.sqlite3")
+        self.max_readers = max_readers
+
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._readers = queue.Queue()
+        for _ in range(max_readers):
+            self._readers.put(self._connect())
+
+        self._init_chats_table()
+
+    @property
+    def max_connections(self) -> int:
+        return self.max_readers + 1
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None: no implicit transactions, we BEGIN explicitly
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.row_factory = _dict_row
+        for pragma in _PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    @contextmanager
+    def write_transaction(self):
+        """Yields a cursor inside an IMMEDIATE transaction on the single writer connection."""
+        with self._write_lock:
+            cursor = self._writer.cursor()
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                yield cursor
+                cursor.execute("COMMIT")
+            except Exception:
+                if self._writer.in_transaction:
+                    cursor.execute("ROLLBACK")
+                raise
+            finally:
+                cursor.close()
+
+    @contextmanager
+    def read_transaction(self):
+        """Yields a cursor on a pooled read connection; all its reads see one snapshot."""
+        conn = self._readers.get()
+        cursor = conn.cursor()
+        try:
+            cursor.execute("BEGIN")
+            yield cursor
+        finally:
+            if conn.in_transaction:
+                cursor.execute("COMMIT")
+            cursor.close()
+            self._readers.put(conn)
+
+    def close(self):
+        with self._write_lock:
+            self._writer.close()
+        for _ in range(self.max_readers):
+            self._readers.get().close()
+
+    def _init_chats_table(self):
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chats(
+                    chat_id INTEGER PRIMARY KEY
+                )
+            ''')
+
+    def apply_migrations(self, component: str, migrations: list[Migration]) -> list[int]:
+        """
+        Same contract as StorageManager.apply_migrations, in one write transaction
+        (there's only one writer, so no cross-process lock is needed).
+        """
+        applied = []
+
+        with self.write_transaction() as cursor:
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version(
+                    component TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    name TEXT NOT NULL,
+                    applied_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (component, version)
+                )
+            ''')
+            cursor.execute("SELECT version FROM schema_version WHERE component = ?", (component,))
+            done = {row["version"] for row in cursor.fetchall()}
+
+            for migration in sorted(migrations, key=lambda m: m.version):
+                if migration.version in done:
+                    continue
+                logger.info(f"Applying migration {component}:{migration.version} ({migration.name})")
+                for statement in migration.statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_version (component, version, name) VALUES (?, ?, ?)",
+                    (component, migration.version, migration.name)
+                )
+                applied.append(migration.version)
+
+        return applied
@@ -1,24 +1,57 @@
+import logging
+import time
+import uuid
 import psycopg2
-from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 from contextlib import contextmanager
 from decouple import config
 
+# Local modules
+from connection_pool import BoundedConnectionPool
+from prepared_statements import PreparedStatementRegistry
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the advisory lock that serializes migrations across replicas
+MIGRATIONS_LOCK_KEY = 727001
+
+class Migration:
+    """
+    One ordered, idempotent schema step.
+    `concurrent` steps (e.g. CREATE INDEX CONCURRENTLY) run outside a transaction,
+    statement by statement, so they never block writes on a live database.
+    """
+    def __init__(self, version: int, name: str, statements: list[str] | str, concurrent=False):
+        self.version = version
+        self.name = name
+        self.statements = [statements] if isinstance(statements, str) else statements
+        self.concurrent = concurrent
+
 class StorageManager:
     def __init__(self):
         self.dsn = config("DATABASE_URL")
-        self.pool = pool.ThreadedConnectionPool(
+        # Tags this replica's sessions, so change notifications can tell our own writes apart
+        self.instance_id = f"khetma-bot-{uuid.uuid4().hex[:12]}"
+        self.pool = BoundedConnectionPool(
             minconn=5,
-            maxconn=20,
+            maxconn=config("DB_POOL_MAX_CONNECTIONS", default=20, cast=int),
+            acquire_timeout=config("DB_POOL_ACQUIRE_TIMEOUT", default=10.0, cast=float),
+            max_lifetime=config("DB_POOL_MAX_LIFETIME", default=1800.0, cast=float),
             dsn=self.dsn,
-            cursor_factory=RealDictCursor
+            cursor_factory=RealDictCursor,
+            application_name=self.instance_id
         )
+        self.statements = PreparedStatementRegistry()
         self._init_chats_table()
 
+    @property
+    def max_connections(self) -> int:
+        return self.pool.maxconn
+
     @contextmanager
     def managed_connection(self):
         conn: psycopg2.extensions.connection = self.pool.getconn()
-        cursor = None 
+        cursor = None
         try:
             cursor = conn.cursor()
             yield cursor
@@ -31,10 +64,92 @@ class StorageManager:
                 cursor.close()
             self.pool.putconn(conn)
 
+    @contextmanager
+    def autocommit_connection(self):
+        """Yields a pooled connection in autocommit mode (needed for CONCURRENTLY and LISTEN)."""
+        conn: psycopg2.extensions.connection = self.pool.getconn()
+        try:
+            conn.autocommit = True
+            yield conn
+        finally:
+            if not conn.closed:
+                conn.autocommit = False
+            self.pool.putconn(conn)
+
     def _init_chats_table(self):
         with self.managed_connection() as cursor:
             cursor.execute('''
                 CREATE TABLE IF NOT EXISTS chats(
                     chat_id BIGINT PRIMARY KEY
                 )
-            ''')
\ No newline at end of file
+            ''')
+
+    def apply_migrations(self, component: str, migrations: list[Migration], lock_timeout=60) -> list[int]:
+        """
+        Applies every migration of `component` that isn't recorded in schema_version yet, in order.
+        Replicas starting together wait on an advisory lock, so each step runs exactly once.
+        Returns: the versions applied by this call.
+        """
+        applied = []
+
+        with self.autocommit_connection() as conn:
+            with conn.cursor() as cursor:
+                self._acquire_migrations_lock(cursor, lock_timeout)
+                try:
+                    cursor.execute('''
+                        CREATE TABLE IF NOT EXISTS schema_version(
+                            component TEXT NOT NULL,
+                            version INTEGER NOT NULL,
+                            name TEXT NOT NULL,
+                            applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                            PRIMARY KEY (component, version)
+                        )
+                    ''')
+                    cursor.execute("SELECT version FROM schema_version WHERE component = %s", (component,))
+                    done = {row["version"] for row in cursor.fetchall()}
+
+                    for migration in sorted(migrations, key=lambda m: m.version):
+                        if migration.version in done:
+                            continue
+                        logger.info(f"Applying migration {component}:{migration.version} ({migration.name})")
+                        self._run_migration(conn, cursor, component, migration)
+                        applied.append(migration.version)
+                finally:
+                    cursor.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+
+        return applied
+
+    def _acquire_migrations_lock(self, cursor, lock_timeout):
+        # Polling with pg_try_advisory_lock (instead of a blocking pg_advisory_lock) keeps the
+        # waiting replica out of a running statement, which CREATE INDEX CONCURRENTLY would wait on.
+        deadline = time.monotonic() + lock_timeout
+        while True:
+            cursor.execute("SELECT pg_try_advisory_lock(%s) AS locked", (MIGRATIONS_LOCK_KEY,))
+            if cursor.fetchone()["locked"]:
+                return
+            if time.monotonic() > deadline:
+                raise TimeoutError("Timed out waiting for another process to finish migrating the schema.")
+            time.sleep(0.5)
+
+    def _run_migration(self, conn, cursor, component: str, migration: Migration):
+        sql_record = "INSERT INTO schema_version (component, version, name) VALUES (%s, %s, %s)"
+        record_params = (component, migration.version, migration.name)
+
+        if migration.concurrent:
+            # Every statement commits on its own; they are written to be safely re-runnable
+            for statement in migration.statements:
+                cursor.execute(statement)
+            cursor.execute(sql_record, record_params)
+            return
+
+        conn.autocommit = False
+        try:
+            for statement in migration.statements:
+                cursor.execute(statement)
+            cursor.execute(sql_record, record_params)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
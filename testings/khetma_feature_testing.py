@@ -1,14 +1,41 @@
 import unittest
+import asyncio
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 from decouple import config
 import psycopg2
 from psycopg2 import pool
 from psycopg2.extras import RealDictCursor
 from contextlib import contextmanager
+from types import SimpleNamespace
+from telegram import error as TelegramError
+from telegram.constants import ChatMemberStatus
 
 # Local imports
+from prepared_statements import PreparedStatementRegistry
 from storage_manager import StorageManager
+from sqlite_storage_manager import SQLiteStorageManager
+from connection_pool import BoundedConnectionPool
 from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.khetma_sqlite_storage import SQLiteKhetmaStorage
+from features.group_khetma.khetma_memory_storage import InMemoryKhetmaStorage
+from features.group_khetma.async_khetma_storage import AsyncKhetmaStorage
+from features.group_khetma.khetma_cache import CachedKhetmaStorage
+from features.group_khetma.khetma_notifications import KhetmaChangeListener
+from features.group_khetma.khetma_migrations import CHANGES_CHANNEL
+from features.group_khetma.khetma_archiver import KhetmaArchiver
+from features.group_khetma.khetma_transfer import KhetmaTransfer
+from features.group_khetma.user_directory import UserDirectory
+from features.group_khetma.intent_router import Intent, IntentRouter
+from features.group_khetma.admin_cache import AdminCache
+from features.group_khetma.edit_coalescer import EditCoalescer
 from features.group_khetma import errors
+from features.group_khetma import khetma_handlers
 from features.group_khetma import utilities
 from features.group_khetma.class_khetma import Khetma
 from features.group_khetma.class_chapter import Chapter
@@ -34,15 +61,21 @@ class TestStorageManager(StorageManager):
             dsn=self.dsn,
             cursor_factory=RealDictCursor
         )
+        self.statements = PreparedStatementRegistry()
         self._drop_all_tables()
         self._init_chats_table()
 
     def _drop_all_tables(self):
         """Wipes the test database completely before each test."""
         with self.managed_connection() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS chapters_archive CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS khetmat_archive CASCADE;")
             cursor.execute("DROP TABLE IF EXISTS chapters CASCADE;")
             cursor.execute("DROP TABLE IF EXISTS khetmat CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS reading_stats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS users CASCADE;")
             cursor.execute("DROP TABLE IF EXISTS chats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS schema_version CASCADE;")
 
 
 # ==========================================
@@ -53,8 +86,7 @@ class TestGroupKhetma(unittest.TestCase):
 
     def setUp(self):
         """Runs before EVERY test. Creates a fresh database and storage."""
-        self.db_core = TestStorageManager()
-        self.storage = KhetmaStorage(self.db_core)
+        self.storage = self.create_storage()
 
         # Fake Telegram Data
         self.chat_id = -100123456
@@ -67,6 +99,11 @@ class TestGroupKhetma(unittest.TestCase):
         """Runs after EVERY test. Closes all pool connections."""
         self.db_core.pool.closeall()
 
+    def create_storage(self):
+        """The backend under test; subclasses run the same contract against the other backends."""
+        self.db_core = TestStorageManager()
+        return KhetmaStorage(self.db_core)
+
 
     # ==========================================
     # 1. KHETMA CREATION TESTS
@@ -99,6 +136,22 @@ class TestGroupKhetma(unittest.TestCase):
         self.assertEqual(khetma_chat_a.number, 1)
         self.assertEqual(khetma_chat_b.number, 1)
 
+    def test_create_khetmat_in_bulk(self):
+        """A bulk creation should number each chat on its own and create all 30 chapters per khetma."""
+        self.storage.create_new_khetma(self.chat_id)
+
+        khetmat = self.storage.create_new_khetmat([self.chat_id_b, self.chat_id, self.chat_id_b])
+
+        self.assertEqual([(k.chat_id, k.number) for k in khetmat], [(self.chat_id_b, 1), (self.chat_id, 2)])
+        for khetma in khetmat:
+            stored = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+            self.assertEqual([ch.number for ch in stored.chapters], list(range(1, 31)))
+            self.assertTrue(all(ch.is_available for ch in stored.chapters))
+
+    def test_create_khetmat_in_bulk_with_no_chats(self):
+        """An empty bulk creation should do nothing."""
+        self.assertEqual(self.storage.create_new_khetmat([]), [])
+
     def test_chapters_are_numbered_1_to_30(self):
         """Chapters should be numbered 1 through 30 in order."""
         khetma = self.storage.create_new_khetma(self.chat_id)
@@ -559,6 +612,33 @@ class TestGroupKhetma(unittest.TestCase):
         self.assertEqual(len(result), 1)
         self.assertEqual(result[khetma.khetma_id], 1)
 
+    def test_get_user_chapters_grouped_by_khetma(self):
+        """The user's reserved chapters should come back grouped by khetma number, in order."""
+        khetma1 = self.storage.create_new_khetma(self.chat_id)
+        khetma2 = self.storage.create_new_khetma(self.chat_id)
+        other_chat = self.storage.create_new_khetma(self.chat_id_b)
+
+        self.storage.reserve_chapter(khetma2.khetma_id, 9, self.user_a["id"], self.user_a["username"])
+        self.storage.reserve_chapter(khetma1.khetma_id, 12, self.user_a["id"], self.user_a["username"])
+        self.storage.reserve_chapter(khetma1.khetma_id, 3, self.user_a["id"], self.user_a["username"])
+        self.storage.reserve_chapter(khetma1.khetma_id, 4, self.user_b["id"], self.user_b["username"])
+        self.storage.reserve_chapter(other_chat.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+
+        grouped = self.storage.get_user_chapters_by_khetma(self.user_a["id"], self.chat_id)
+
+        self.assertEqual(
+            {number: [ch.number for ch in chapters] for number, chapters in grouped.items()},
+            {1: [3, 12], 2: [9]}
+        )
+        self.assertEqual(list(grouped), [1, 2])
+        self.assertEqual(grouped[1][0].owner_id, self.user_a["id"])
+
+    def test_get_user_chapters_grouped_by_khetma_none_raises(self):
+        """A user with no reserved chapters in the chat should raise NoOwnedChapters."""
+        self.storage.create_new_khetma(self.chat_id)
+        with self.assertRaises(errors.NoOwnedChapters):
+            self.storage.get_user_chapters_by_khetma(self.user_a["id"], self.chat_id)
+
 
     # ==========================================
     # 8. CALC FUNCTIONS TESTS
@@ -588,6 +668,36 @@ class TestGroupKhetma(unittest.TestCase):
         result = self.storage.calc_finished_khetmat_number(self.chat_id)
         self.assertEqual(result, 2)  # 1 finished + 1
 
+    def test_chat_counters_follow_status_changes(self):
+        """The chat counters should match the khetmat rows after creations and status changes."""
+        khetma1 = self.storage.create_new_khetma(self.chat_id)
+        self.storage.create_new_khetmat([self.chat_id, self.chat_id_b])
+
+        khetma1.status = Khetma.khetma_status.FINISHED
+        self.storage.update_khetma(khetma1)
+        self.storage.update_khetma(khetma1) # no status change, no double count
+
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id), {
+            "last_khetma_number": 2, "active_khetmat_count": 1, "finished_khetmat_count": 1
+        })
+
+        khetma1.status = Khetma.khetma_status.ACTIVE
+        self.storage.update_khetma(khetma1)
+
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id)["active_khetmat_count"], 2)
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id)["finished_khetmat_count"], 0)
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id_b)["active_khetmat_count"], 1)
+
+    def test_chat_counters_of_unknown_chat(self):
+        """A chat that never had a khetma should read as all zeros."""
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id), {
+            "last_khetma_number": 0, "active_khetmat_count": 0, "finished_khetmat_count": 0
+        })
+
+    def test_update_khetma_reports_missing_khetma(self):
+        """Updating a khetma that doesn't exist should return False."""
+        self.assertFalse(self.storage.update_khetma(Khetma(999, 1)))
+
 
     # ==========================================
     # 9. KHETMA IS_FINISHED PROPERTY TESTS
@@ -711,6 +821,27 @@ class TestGroupKhetma(unittest.TestCase):
         result = utilities.extract_arabic_numbers("تم 1 و الثاني و ٣")
         self.assertEqual(result, [1, 2, 3])
 
+    def test_split_message_at_line_breaks(self):
+        """split_message should keep every part within the limit, breaking between lines when it can."""
+        lines = [f"• الجزء {number} ← @member{number}" for number in range(1, 31)]
+        parts = utilities.split_message("\n".join(lines), limit=100)
+
+        self.assertTrue(all(len(part) <= 100 for part in parts))
+        self.assertEqual("\n".join(parts).split("\n"), lines)
+        self.assertEqual(utilities.split_message("ا" * 250, limit=100), ["ا" * 100, "ا" * 100, "ا" * 50])
+
+    def test_split_message_counts_utf16_units(self):
+        """Emoji count two toward Telegram's limit, and a part never ends halfway through one."""
+        parts = utilities.split_message("📖" * 75, limit=100)
+
+        self.assertEqual(parts, ["📖" * 50, "📖" * 25])
+        self.assertTrue(all(utilities.utf16_len(part) <= 100 for part in parts))
+
+        lines = [f"• الجزء {number} ✅📖 @member{number}" for number in range(1, 31)]
+        parts = utilities.split_message("\n".join(lines), limit=100)
+        self.assertTrue(all(utilities.utf16_len(part) <= 100 for part in parts))
+        self.assertEqual("\n".join(parts).split("\n"), lines)
+
 
     # ==========================================
     # 12. MULTI-CHAT ISOLATION TESTS
@@ -747,5 +878,1382 @@ class TestGroupKhetma(unittest.TestCase):
             self.storage.finish_all_user_chapters(self.chat_id_b, self.user_a["id"])
 
 
+
+    # ==========================================
+    # 13. BULK FINISH TESTS
+    # ==========================================
+
+    def test_finish_chapters_reports_each_outcome(self):
+        """finish_chapters should finish what it can and explain every other number."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 2, self.user_b["id"], self.user_b["username"]
+        )
+        self.storage.finish_chapter(
+            khetma.khetma_id, 3, self.user_b["id"], self.user_b["username"]
+        )
+
+        updated, outcomes = self.storage.finish_chapters(
+            khetma.khetma_id, [1, 2, 3, 4, 31], self.user_a["id"], self.user_a["username"]
+        )
+
+        self.assertEqual(list(outcomes), [1, 2, 3, 4, 31])
+        self.assertIsNone(outcomes[1])
+        self.assertIsInstance(outcomes[2], errors.ChapterNotOwnedError)
+        self.assertIsInstance(outcomes[3], errors.ChapterFinishedError)
+        self.assertIsNone(outcomes[4])
+        self.assertIsInstance(outcomes[31], errors.ChapterNotFoundError)
+
+        self.assertEqual(len(updated.chapters), 30)
+        self.assertTrue(updated.get_chapter(1).is_finished)
+        self.assertTrue(updated.get_chapter(2).is_reserved)
+        self.assertEqual(updated.get_chapter(4).owner_id, self.user_a["id"])
+
+    def test_finish_chapters_persists_to_db(self):
+        """The khetma returned by finish_chapters should match a fresh read."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        updated, _ = self.storage.finish_chapters(
+            khetma.khetma_id, [5, 6, 5], self.user_a["id"], self.user_a["username"]
+        )
+        refreshed = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+
+        self.assertEqual(
+            [ch.status for ch in updated.chapters],
+            [ch.status for ch in refreshed.chapters]
+        )
+        self.assertEqual(len(refreshed.get_finished_chapters()), 2)
+
+    def test_finish_chapters_completes_khetma(self):
+        """Finishing all 30 numbers at once should leave the khetma finished."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        updated, outcomes = self.storage.finish_chapters(
+            khetma.khetma_id, list(range(1, 31)), self.user_a["id"], self.user_a["username"]
+        )
+
+        self.assertTrue(all(err is None for err in outcomes.values()))
+        self.assertTrue(updated.is_finished)
+
+    def test_finish_chapters_unknown_khetma_raises_error(self):
+        """finish_chapters on a khetma that doesn't exist should raise KhetmaNotFoundError."""
+        with self.assertRaises(errors.KhetmaNotFoundError):
+            self.storage.finish_chapters(99999, [1], self.user_a["id"], self.user_a["username"])
+
+
+
+    # ==========================================
+    # 14. SINGLE-STATEMENT MUTATION TESTS
+    # ==========================================
+
+    def test_reserve_nonexistent_chapter_raises_error(self):
+        """Reserving a chapter number that doesn't exist should raise ChapterNotFoundError."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+
+        with self.assertRaises(errors.ChapterNotFoundError):
+            self.storage.reserve_chapter(
+                khetma.khetma_id, 31, self.user_a["id"], self.user_a["username"]
+            )
+
+    def test_admin_withdraw_empty_chapter_raises_error(self):
+        """Even an admin can't withdraw a chapter that is not reserved."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+
+        with self.assertRaises(errors.ChapterAlreadyEmptyError):
+            self.storage.withdraw_chapter(khetma.khetma_id, 1, self.user_b["id"], is_admin=True)
+
+
+
+
+
+    # ==========================================
+    # 15. MUTATIONS RETURNING THE UPDATED KHETMA
+    # ==========================================
+
+    def test_reserve_chapter_returning_gives_updated_khetma(self):
+        """reserve_chapter_returning should return the khetma with the chapter already reserved."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        updated = self.storage.reserve_chapter_returning(
+            khetma.khetma_id, 12, self.user_a["id"], self.user_a["username"]
+        )
+
+        self.assertEqual(updated.number, 1)
+        self.assertEqual(updated.chat_id, self.chat_id)
+        self.assertEqual(len(updated.chapters), 30)
+        self.assertTrue(updated.get_chapter(12).is_reserved)
+        self.assertEqual(updated.get_chapter(12).owner_id, self.user_a["id"])
+
+    def test_reserve_chapter_returning_raises_domain_errors(self):
+        """reserve_chapter_returning should raise the same errors as reserve_chapter."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter_returning(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+
+        with self.assertRaises(errors.ChapterAlreadyReservedError):
+            self.storage.reserve_chapter_returning(
+                khetma.khetma_id, 1, self.user_b["id"], self.user_b["username"]
+            )
+        with self.assertRaises(errors.ChapterNotFoundError):
+            self.storage.reserve_chapter_returning(
+                khetma.khetma_id, 40, self.user_b["id"], self.user_b["username"]
+            )
+
+    def test_withdraw_chapters_reports_each_outcome(self):
+        """withdraw_chapters should withdraw reserved chapters and explain the rest."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+        self.storage.finish_chapter(
+            khetma.khetma_id, 2, self.user_a["id"], self.user_a["username"]
+        )
+
+        updated, outcomes = self.storage.withdraw_chapters(
+            khetma.khetma_id, [1, 2, 3], self.user_b["id"], is_admin=True
+        )
+
+        self.assertIsNone(outcomes[1])
+        self.assertIsInstance(outcomes[2], errors.ChapterFinishedError)
+        self.assertIsInstance(outcomes[3], errors.ChapterAlreadyEmptyError)
+        self.assertTrue(updated.get_chapter(1).is_available)
+
+    def test_withdraw_chapters_respects_ownership(self):
+        """A non-admin can't withdraw someone else's chapter through withdraw_chapters."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+
+        updated, outcomes = self.storage.withdraw_chapters(khetma.khetma_id, [1], self.user_b["id"])
+
+        self.assertIsInstance(outcomes[1], errors.ChapterNotOwnedError)
+        self.assertTrue(updated.get_chapter(1).is_reserved)
+
+    def test_finish_all_user_chapters_returning(self):
+        """finish_all_user_chapters_returning should return the finished chapters and the updated khetma."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 2, self.user_b["id"], self.user_b["username"]
+        )
+
+        finished, updated = self.storage.finish_all_user_chapters_returning(
+            self.chat_id, self.user_a["id"], khetma.khetma_id
+        )
+
+        self.assertEqual([ch.number for ch in finished], [1])
+        self.assertTrue(updated.get_chapter(1).is_finished)
+        self.assertTrue(updated.get_chapter(2).is_reserved)
+
+        with self.assertRaises(errors.NoOwnedChapters):
+            self.storage.finish_all_user_chapters_returning(
+                self.chat_id, self.user_a["id"], khetma.khetma_id
+            )
+
+    def test_withdraw_all_user_chapters_returning(self):
+        """withdraw_all_user_chapters_returning should free the user's chapters and return the khetma."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 3, self.user_a["id"], self.user_a["username"]
+        )
+
+        withdrawn, updated = self.storage.withdraw_all_user_chapters_returning(
+            self.chat_id, self.user_a["id"], khetma.khetma_id
+        )
+
+        self.assertEqual([ch.number for ch in withdrawn], [3])
+        self.assertTrue(updated.get_chapter(3).is_available)
+
+        with self.assertRaises(errors.NoOwnedChapters):
+            self.storage.withdraw_all_user_chapters_returning(
+                self.chat_id_b, self.user_a["id"], khetma.khetma_id
+            )
+
+
+    # ==========================================
+    # 16. ARCHIVING FINISHED KHETMAT
+    # ==========================================
+
+    def _finish_khetma(self, khetma):
+        self.storage.finish_chapters(khetma.khetma_id, range(1, 31), self.user_a["id"], self.user_a["username"])
+        khetma.status = Khetma.khetma_status.FINISHED
+        self.storage.update_khetma(khetma)
+
+    def test_archive_moves_only_finished_khetmat(self):
+        """Finished khetmat leave the hot tables; active ones and the chat counters stay as they are."""
+        finished = self.storage.create_new_khetma(self.chat_id)
+        active = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(active.khetma_id, 2, self.user_a["id"], self.user_a["username"])
+        self._finish_khetma(finished)
+
+        self.assertEqual(self.storage.archive_finished_khetmat(), 1)
+        self.assertEqual(self.storage.archive_finished_khetmat(), 0)
+
+        self.assertEqual([k.khetma_id for k in self.storage.get_active_khetmat(self.chat_id)], [active.khetma_id])
+        self.assertIsNone(self.storage.get_chapter(khetma_id=finished.khetma_id, chapter_number=1))
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id), {
+            "last_khetma_number": 2, "active_khetmat_count": 1, "finished_khetmat_count": 1
+        })
+        self.assertEqual(self.storage.create_new_khetma(self.chat_id).number, 3)
+
+    def test_archived_khetma_is_still_readable(self):
+        """get_khetma falls back to the archive, with the khetma's chapters and owners intact."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self._finish_khetma(khetma)
+        self.storage.archive_finished_khetmat()
+
+        archived = self.storage.get_khetma(khetma_number=1, chat_id=self.chat_id)
+
+        self.assertEqual(archived.khetma_id, khetma.khetma_id)
+        self.assertEqual(archived.status, Khetma.khetma_status.FINISHED)
+        self.assertTrue(archived.is_finished)
+        self.assertEqual(archived.get_chapter(30).owner_id, self.user_a["id"])
+        self.assertEqual(self.storage.get_khetma(khetma_id=khetma.khetma_id).number, 1)
+        self.assertEqual(self.storage.get_khetmat_by_ids([khetma.khetma_id]), {khetma.khetma_id: 1})
+        self.assertFalse(self.storage.update_khetma(archived))
+
+    def test_archive_in_batches_and_per_chat(self):
+        """batch_size caps one run, and chat_id limits it to one chat."""
+        for chat_id in (self.chat_id, self.chat_id, self.chat_id, self.chat_id_b):
+            self._finish_khetma(self.storage.create_new_khetma(chat_id))
+
+        self.assertEqual(self.storage.archive_finished_khetmat(chat_id=self.chat_id_b), 1)
+        self.assertEqual(self.storage.archive_finished_khetmat(batch_size=2), 2)
+        self.assertEqual(self.storage.archive_finished_khetmat(batch_size=2), 1)
+
+    def test_finished_khetmat_span_hot_and_archive(self):
+        """get_finished_khetmat lists the newest finished khetmat first, archived or not."""
+        for _ in range(3):
+            self._finish_khetma(self.storage.create_new_khetma(self.chat_id))
+        self.storage.create_new_khetma(self.chat_id) # still active
+        self.storage.archive_finished_khetmat(batch_size=2) # khetmat 1 and 2
+
+        finished = self.storage.get_finished_khetmat(self.chat_id)
+
+        self.assertEqual([k.number for k in finished], [3, 2, 1])
+        self.assertTrue(all(k.is_finished for k in finished))
+        self.assertEqual([k.number for k in self.storage.get_finished_khetmat(self.chat_id, limit=2)], [3, 2])
+        self.assertEqual(self.storage.get_finished_khetmat(self.chat_id_b), [])
+
+
+    # ==========================================
+    # 17. READING STATS
+    # ==========================================
+
+    def test_reading_stats_follow_every_finish_path(self):
+        """finish_chapter, finish_chapters and finish_all_user_chapters all count, per chat."""
+        khetma1 = self.storage.create_new_khetma(self.chat_id)
+        khetma2 = self.storage.create_new_khetma(self.chat_id)
+        other_chat = self.storage.create_new_khetma(self.chat_id_b)
+        uid, uname = self.user_a["id"], self.user_a["username"]
+
+        self.storage.finish_chapter(khetma1.khetma_id, 1, uid, uname)
+        self.storage.finish_chapters(khetma1.khetma_id, [2, 3], uid, uname)
+        self.storage.reserve_chapter(khetma2.khetma_id, 4, uid, uname)
+        self.storage.reserve_chapter(khetma2.khetma_id, 5, uid, uname)
+        self.storage.finish_all_user_chapters(self.chat_id, uid)
+        self.storage.finish_chapter(other_chat.khetma_id, 1, uid, uname)
+
+        self.assertEqual(self.storage.get_reading_stats(self.chat_id, uid), {
+            "user_id": uid, "username": uname, "chapters_finished": 5, "khetmat_participated": 2
+        })
+        self.assertEqual(self.storage.get_reading_stats(self.chat_id_b, uid)["chapters_finished"], 1)
+
+    def test_reading_stats_ignore_failed_and_repeated_finishes(self):
+        """A refused finish changes nothing, and a finished chapter counts once."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_b["id"], self.user_b["username"])
+        self.storage.finish_chapter(khetma.khetma_id, 2, self.user_a["id"], self.user_a["username"])
+
+        with self.assertRaises(errors.ChapterNotOwnedError):
+            self.storage.finish_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+        self.storage.finish_chapters(khetma.khetma_id, [1, 2], self.user_a["id"], self.user_a["username"])
+
+        self.assertEqual(self.storage.get_reading_stats(self.chat_id, self.user_a["id"])["chapters_finished"], 1)
+        self.assertEqual(self.storage.get_reading_stats(self.chat_id, self.user_b["id"])["chapters_finished"], 0)
+
+    def test_reading_stats_undo_through_update_chapters(self):
+        """Turning a finished chapter back into an empty one takes it off its reader's count."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.finish_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+
+        chapter = self.storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=1)
+        chapter.mark_empty()
+        self.storage.update_chapters(chapter)
+
+        self.assertEqual(self.storage.get_reading_stats(self.chat_id, self.user_a["id"]), {
+            "user_id": self.user_a["id"], "username": self.user_a["username"],
+            "chapters_finished": 0, "khetmat_participated": 0
+        })
+        self.assertEqual(self.storage.get_reading_leaderboard(self.chat_id), [])
+
+    def test_reading_leaderboard_order_and_archive(self):
+        """Most chapters first, capped by limit; archiving a khetma keeps its readers' counts."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.finish_chapters(khetma.khetma_id, range(1, 21), self.user_b["id"], self.user_b["username"])
+        self.storage.finish_chapters(khetma.khetma_id, range(21, 26), self.user_a["id"], self.user_a["username"])
+        self.storage.finish_chapters(khetma.khetma_id, range(26, 31), self.user_c["id"], self.user_c["username"])
+        khetma.status = Khetma.khetma_status.FINISHED
+        self.storage.update_khetma(khetma)
+        self.storage.archive_finished_khetmat()
+
+        leaderboard = self.storage.get_reading_leaderboard(self.chat_id, limit=2)
+
+        self.assertEqual([(row["user_id"], row["chapters_finished"]) for row in leaderboard],
+                         [(self.user_b["id"], 20), (self.user_a["id"], 5)])
+
+
+    # ==========================================
+    # 18. USERS
+    # ==========================================
+
+    def test_save_user_upserts_names(self):
+        """Saving a user again replaces their names; get_users leaves unknown ids out."""
+        self.storage.save_user(self.user_a["id"], "UserA", "Ahmad")
+        self.storage.save_user(self.user_b["id"], None, "Bilal")
+        self.storage.save_user(self.user_a["id"], "UserA2", "Ahmad")
+
+        users = self.storage.get_users([self.user_a["id"], self.user_b["id"], 999])
+
+        self.assertEqual(set(users), {self.user_a["id"], self.user_b["id"]})
+        self.assertEqual((users[self.user_a["id"]]["username"], users[self.user_a["id"]]["first_name"]), ("UserA2", "Ahmad"))
+        self.assertIsNone(users[self.user_b["id"]]["username"])
+        self.assertIsNotNone(users[self.user_b["id"]]["last_seen"])
+
+    def test_get_users_with_no_ids(self):
+        """An empty id list needs no query and finds nobody."""
+        self.assertEqual(self.storage.get_users([]), {})
+
+
+    # ==========================================
+    # 19. KHETMA VERSIONS
+    # ==========================================
+
+    def _assert_version(self, khetma_id, version):
+        self.assertEqual(self.storage.get_khetma_version(khetma_id), version)
+        self.assertEqual(self.storage.get_khetma(khetma_id=khetma_id).version, version)
+
+    def test_version_moves_once_per_successful_write(self):
+        """Each write that changes chapters is one step, however many chapters; refused writes are none."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self._assert_version(khetma.khetma_id, 0)
+
+        self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+        updated, _ = self.storage.finish_chapters(khetma.khetma_id, [2, 3, 4], self.user_a["id"], self.user_a["username"])
+        self.assertEqual(updated.version, 2)
+        self._assert_version(khetma.khetma_id, 2)
+
+        with self.assertRaises(errors.ChapterAlreadyReservedError):
+            self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_b["id"], self.user_b["username"])
+        unchanged, _ = self.storage.finish_chapters(khetma.khetma_id, [1, 2], self.user_b["id"], self.user_b["username"])
+        self.assertEqual(unchanged.version, 2)
+
+        chapters = [self.storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=num) for num in (5, 6)]
+        for chapter in chapters:
+            chapter.reserve(self.user_c["id"], self.user_c["username"])
+        self.storage.update_chapters(chapters)
+        self.storage.withdraw_all_user_chapters(self.chat_id, self.user_c["id"])
+        self._assert_version(khetma.khetma_id, 4)
+
+    def test_update_khetma_with_stale_version_is_refused(self):
+        """A khetma read before another write can't be written back over it."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        read = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+
+        read.status = Khetma.khetma_status.FINISHED
+        with self.assertRaises(errors.StaleKhetmaError):
+            self.storage.update_khetma(read, expected_version=read.version)
+
+        fresh = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(fresh.status, Khetma.khetma_status.ACTIVE)
+        self.assertTrue(fresh.get_chapter(1).is_reserved)
+        self.assertEqual(self.storage.get_chat_counters(self.chat_id)["finished_khetmat_count"], 0)
+
+        fresh.status = Khetma.khetma_status.FINISHED
+        self.assertTrue(self.storage.update_khetma(fresh, expected_version=fresh.version))
+        self.assertEqual(fresh.version, 2)
+        self.assertEqual(self.storage.get_khetma_version(khetma.khetma_id), 2)
+
+    def test_update_chapters_with_stale_version_is_refused(self):
+        """Conditional chapter writes check the khetma's version, and only make sense for one khetma."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        other = self.storage.create_new_khetma(self.chat_id)
+        chapter = self.storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=7)
+        chapter.reserve(self.user_a["id"], self.user_a["username"])
+        self.storage.finish_chapter(khetma.khetma_id, 8, self.user_b["id"], self.user_b["username"])
+
+        with self.assertRaises(errors.StaleKhetmaError):
+            self.storage.update_chapters(chapter, expected_version=0)
+        self.assertTrue(self.storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=7).is_available)
+
+        other_chapter = self.storage.get_chapter(khetma_id=other.khetma_id, chapter_number=7)
+        with self.assertRaises(ValueError):
+            self.storage.update_chapters([chapter, other_chapter], expected_version=1)
+
+        self.assertTrue(self.storage.update_chapters(chapter, expected_version=1))
+        self._assert_version(khetma.khetma_id, 2)
+
+    def test_khetma_version_of_missing_and_archived_khetmat(self):
+        """Unknown khetmat have no version; archiving keeps it."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self._finish_khetma(khetma)
+        self.storage.archive_finished_khetmat()
+
+        self.assertIsNone(self.storage.get_khetma_version(999999))
+        self._assert_version(khetma.khetma_id, 2)
+
+    def test_concurrent_writes_return_the_versions_they_stored(self):
+        """Writers racing on one khetma each get back a distinct version, and the last one is what's stored."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        versions = []
+        start = threading.Barrier(4) # the test pool has 5 connections
+
+        def reserve(number):
+            start.wait()
+            updated = self.storage.reserve_chapter_returning(khetma.khetma_id, number, 1000 + number, f"@User{number}")
+            versions.append(updated.version)
+
+        threads = [threading.Thread(target=reserve, args=(number,)) for number in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(versions), [1, 2, 3, 4])
+        self._assert_version(khetma.khetma_id, 4)
+
+
+# ==========================================
+# WRITE-THROUGH CACHE TESTS
+# ==========================================
+
+class TestCachedKhetmaStorage(TestGroupKhetma):
+    """Runs the whole storage contract through the cache, plus cache-specific checks."""
+
+    def setUp(self):
+        super().setUp()
+        self.storage = CachedKhetmaStorage(self.storage)
+
+    def test_cache_serves_reads_after_mutation(self):
+        """A read right after a mutation should be a cache hit that reflects the change."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter_returning(
+            khetma.khetma_id, 4, self.user_a["id"], self.user_a["username"]
+        )
+
+        cached = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        fresh = self.storage.storage.get_khetma(khetma_id=khetma.khetma_id)
+
+        self.assertEqual(self.storage.stats()["hits"], 1)
+        self.assertEqual(cached.version, fresh.version)
+        self.assertEqual(
+            [(ch.status, ch.owner_id) for ch in cached.chapters],
+            [(ch.status, ch.owner_id) for ch in fresh.chapters]
+        )
+
+    def test_cache_drops_khetma_after_mutation_without_snapshot(self):
+        """Mutations that don't return the khetma can't know its version, so the copy is dropped."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 4, self.user_a["id"], self.user_a["username"]
+        )
+
+        self.assertEqual(self.storage.stats()["cached_khetmat"], 0)
+        reloaded = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(reloaded.get_chapter(4).owner_id, self.user_a["id"])
+
+    def test_cache_follows_foreign_change_interleaved_with_local_write(self):
+        """A change from another process, then a local write, then its NOTIFY, must leave the cache matching the DB."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+
+        # Another replica reserves 5 (straight to the DB), then we reserve 6 before its NOTIFY arrives
+        self.storage.storage.reserve_chapter_returning(
+            khetma.khetma_id, 5, self.user_b["id"], self.user_b["username"]
+        )
+        self.storage.reserve_chapter(
+            khetma.khetma_id, 6, self.user_a["id"], self.user_a["username"]
+        )
+        foreign_version = self.storage.get_khetma_version(khetma.khetma_id) - 1
+        self.storage.invalidate(khetma.khetma_id, version=foreign_version)
+
+        cached = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        fresh = self.storage.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(cached.version, fresh.version)
+        self.assertEqual(
+            [(ch.status, ch.owner_id) for ch in cached.chapters],
+            [(ch.status, ch.owner_id) for ch in fresh.chapters]
+        )
+        self.assertEqual(cached.get_chapter(5).owner_id, self.user_b["id"])
+
+    def test_cache_active_khetmat_by_chat(self):
+        """get_active_khetmat should only hit the DB the first time for a chat."""
+        self.storage.get_active_khetmat(self.chat_id)
+        self.storage.create_new_khetma(self.chat_id)
+        self.storage.create_new_khetma(self.chat_id)
+
+        khetmat = self.storage.get_active_khetmat(self.chat_id)
+
+        self.assertEqual([k.number for k in khetmat], [1, 2])
+        self.assertEqual(self.storage.stats()["misses"], 1)
+        self.assertEqual(self.storage.stats()["hits"], 1)
+
+    def test_cache_returns_independent_copies(self):
+        """Changing a returned khetma must not change the cached state."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        returned = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        returned.get_chapter(1).reserve(self.user_a["id"], self.user_a["username"])
+
+        again = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertTrue(again.get_chapter(1).is_available)
+
+    def test_cache_drops_finished_khetma(self):
+        """A khetma marked FINISHED should no longer be served from the active cache."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.get_active_khetmat(self.chat_id)
+
+        khetma.status = Khetma.khetma_status.FINISHED
+        self.storage.update_khetma(khetma)
+
+        self.assertEqual(self.storage.get_active_khetmat(self.chat_id), [])
+        self.assertEqual(self.storage.stats()["cached_khetmat"], 0)
+
+    def test_cache_skips_snapshot_that_raced_an_invalidation(self):
+        """A snapshot whose write overlapped an invalidation may be the older state, so it isn't cached."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+
+        with self.storage._write(khetma.khetma_id): # our write in flight
+            self.storage.invalidate(khetma.khetma_id, version=99)
+            self.storage._store_snapshot(khetma)
+
+        self.assertEqual(self.storage.stats()["cached_khetmat"], 0)
+        self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(self.storage.stats()["misses"], 1)
+
+    def test_cache_keeps_newer_copy_over_overlapping_snapshot(self):
+        """A snapshot that lost the race to a newer one must not replace it."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        newer = self.storage.reserve_chapter_returning(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+
+        with self.storage._write(khetma.khetma_id):
+            with self.storage._write(khetma.khetma_id):
+                self.storage._store_snapshot(khetma) # the pre-reservation state
+
+        cached = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(cached.version, newer.version)
+        self.assertEqual(cached.get_chapter(1).owner_id, self.user_a["id"])
+
+    def test_cache_is_bounded(self):
+        """The cache should evict the least recently used khetma past its size limit."""
+        self.storage.max_khetmat = 2
+        for _ in range(3):
+            self.storage.create_new_khetma(self.chat_id)
+
+        self.assertEqual(self.storage.stats()["cached_khetmat"], 2)
+        self.assertEqual(self.storage.stats()["evictions"], 1)
+
+
+# ==========================================
+# BITMAP LAYOUT TESTS
+# ==========================================
+
+class TestBitmapKhetmaStorage(TestGroupKhetma):
+    """Runs the whole storage contract with khetmat read from their bitmap columns."""
+
+    def setUp(self):
+        super().setUp()
+        self.storage = KhetmaStorage(self.db_core, bitmap_reads=True)
+
+    def test_bitmaps_follow_chapter_changes(self):
+        """The masks and owners on the khetmat row should match the chapter rows after any mutation."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+        self.storage.reserve_chapter(khetma.khetma_id, 30, self.user_b["id"], self.user_b["username"])
+        self.storage.finish_chapters(khetma.khetma_id, [2, 30], self.user_a["id"], self.user_a["username"])
+
+        bitmap = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertIsNone(bitmap._chapters) # nothing built yet
+
+        self.assertEqual(bitmap.reserved_mask, (1 << 0) | (1 << 29)) # 30 is user B's, so A can't finish it
+        self.assertEqual(bitmap.finished_mask, 1 << 1)
+        self.assertEqual(bitmap.available_numbers(), list(range(3, 30)))
+
+        rows = KhetmaStorage(self.db_core).get_khetma(khetma_id=khetma.khetma_id)
+        self.assertEqual(
+            [(ch.status, ch.owner_id, ch.owner_username) for ch in bitmap.chapters],
+            [(ch.status, ch.owner_id, ch.owner_username) for ch in rows.chapters]
+        )
+
+    def test_bitmap_khetma_is_finished_without_chapters(self):
+        """is_finished should be a single mask comparison."""
+        khetma = Khetma.from_bitmap(1, 1, Khetma.khetma_status.ACTIVE, 0, Khetma.FULL_MASK, [None] * 30, [None] * 30)
+
+        self.assertTrue(khetma.is_finished)
+        self.assertIsNone(khetma._chapters)
+
+    def test_bitmap_khetma_mutates_through_chapter_api(self):
+        """Mutating a bitmap khetma through the Chapter API should be reflected by its masks."""
+        khetma = Khetma.from_bitmap(1, 1, Khetma.khetma_status.ACTIVE, 0, 0, [None] * 30, [None] * 30)
+        copy = khetma.copy()
+
+        khetma.reserve_chapter(self.user_a["id"], self.user_a["username"], 5)
+
+        self.assertEqual(khetma.reserved_mask, 1 << 4)
+        self.assertEqual(khetma.get_chapter(5).owner_id, self.user_a["id"])
+        self.assertEqual(copy.reserved_mask, 0)
+
+
+# ==========================================
+# SQLITE BACKEND TESTS
+# ==========================================
+
+class TestSQLiteKhetmaStorage(TestGroupKhetma):
+    """Runs the whole storage contract against the embedded SQLite backend."""
+
+    def create_storage(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.db_core = SQLiteStorageManager(os.path.join(self.tmp_dir, "khetma.sqlite3"))
+        return SQLiteKhetmaStorage(self.db_core)
+
+    def tearDown(self):
+        self.db_core.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_migrations_are_applied_once(self):
+        """Opening the same database again should not re-run any migration."""
+        self.storage.create_new_khetma(self.chat_id)
+
+        reopened = SQLiteKhetmaStorage(self.db_core)
+
+        self.assertEqual(reopened.get_chat_counters(self.chat_id)["last_khetma_number"], 1)
+        self.assertEqual(self.db_core.apply_migrations("khetma", []), [])
+
+    def test_reads_do_not_wait_for_the_writer(self):
+        """A reader should see the last committed state while a write transaction is open."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+
+        with self.db_core.write_transaction() as cursor:
+            cursor.execute("UPDATE chapters SET status = 'FINISHED' WHERE khetma_id = ?", (khetma.khetma_id,))
+            during = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+
+        self.assertFalse(during.get_finished_chapters())
+        self.assertTrue(self.storage.get_khetma(khetma_id=khetma.khetma_id).is_finished)
+
+    def test_failed_mutation_rolls_back(self):
+        """A domain error raised inside a write transaction should leave the database untouched."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(khetma.khetma_id, 1, self.user_b["id"], self.user_b["username"])
+
+        with self.assertRaises(errors.ChapterNotOwnedError):
+            self.storage.finish_chapter(khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"])
+
+        chapter = self.storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=1)
+        self.assertTrue(chapter.is_reserved)
+        self.assertEqual(chapter.owner_id, self.user_b["id"])
+
+
+# ==========================================
+# IN-MEMORY BACKEND TESTS
+# ==========================================
+
+class TestInMemoryKhetmaStorage(TestGroupKhetma):
+    """Runs the whole storage contract against the in-memory backend (no database needed)."""
+
+    def create_storage(self):
+        self.db_core = None
+        return InMemoryKhetmaStorage()
+
+    def tearDown(self):
+        pass
+
+    def test_returned_objects_are_copies(self):
+        """Mutating a returned khetma must not change the stored state."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        khetma.reserve_chapter(self.user_a["id"], self.user_a["username"], 1)
+
+        stored = self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertTrue(stored.get_chapter(1).is_available)
+
+    def test_concurrent_reservations_have_one_winner(self):
+        """Many threads racing for one chapter: exactly one reservation succeeds."""
+        khetma = self.storage.create_new_khetma(self.chat_id)
+        outcomes = []
+
+        def reserve(user_id):
+            try:
+                outcomes.append(self.storage.reserve_chapter(khetma.khetma_id, 7, user_id, f"@user{user_id}"))
+            except errors.ChapterAlreadyReservedError:
+                outcomes.append(False)
+
+        threads = [threading.Thread(target=reserve, args=(user_id,)) for user_id in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(outcomes.count(True), 1)
+        self.assertEqual(len(outcomes), 20)
+
+
+# ==========================================
+# ARCHIVER TESTS
+# ==========================================
+
+class TestKhetmaArchiver(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = InMemoryKhetmaStorage()
+        self.chat_id = -100123456
+
+        for _ in range(5):
+            khetma = self.storage.create_new_khetma(self.chat_id)
+            khetma.status = Khetma.khetma_status.FINISHED
+            self.storage.update_khetma(khetma)
+        self.storage.create_new_khetma(self.chat_id)
+
+    def test_run_once_drains_in_batches(self):
+        """One run keeps archiving batches until fewer than batch_size are left."""
+        archiver = KhetmaArchiver(self.storage, batch_size=2)
+
+        self.assertEqual(archiver.run_once(), 5)
+        self.assertEqual(archiver.run_once(), 0)
+        self.assertEqual(archiver.archived, 5)
+        self.assertEqual(len(self.storage.get_active_khetmat(self.chat_id)), 1)
+
+    def test_background_thread_archives(self):
+        """Started, the archiver runs right away and stops cleanly."""
+        archiver = KhetmaArchiver(self.storage, interval=60)
+        archiver.start()
+        try:
+            for _ in range(50):
+                if archiver.runs:
+                    break
+                time.sleep(0.01)
+        finally:
+            archiver.stop()
+
+        self.assertEqual(archiver.archived, 5)
+
+
+# ==========================================
+# EXPORT / IMPORT TESTS
+# ==========================================
+
+class TestKhetmaTransfer(unittest.TestCase):
+
+    def setUp(self):
+        self.db_core = TestStorageManager()
+        self.storage = KhetmaStorage(self.db_core)
+        self.transfer = KhetmaTransfer(self.db_core)
+        self.chat_id = -100123456
+        self.chat_id_b = -100999999
+
+        # Chat A: khetma 1 finished and archived, khetma 2 active with a reserved chapter
+        finished = self.storage.create_new_khetma(self.chat_id)
+        self.storage.finish_chapters(finished.khetma_id, range(1, 31), 222, "@UserA")
+        finished.status = Khetma.khetma_status.FINISHED
+        self.storage.update_khetma(finished)
+        self.storage.archive_finished_khetmat()
+        active = self.storage.create_new_khetma(self.chat_id)
+        self.storage.reserve_chapter(active.khetma_id, 5, 333, "@User\tB") # a name COPY has to escape
+        self.storage.create_new_khetma(self.chat_id_b)
+
+    def tearDown(self):
+        self.db_core.pool.closeall()
+
+    def _snapshot(self, chat_id):
+        khetmat = [self.storage.get_khetma(khetma_number=number, chat_id=chat_id) for number in (1, 2)]
+        return (
+            self.storage.get_chat_counters(chat_id),
+            [(k.number, k.status, [(ch.status, ch.owner_id, ch.owner_username) for ch in k.chapters]) for k in khetmat],
+            self.storage.get_reading_leaderboard(chat_id),
+        )
+
+    def _delete_chat(self, chat_id):
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute("DELETE FROM chats WHERE chat_id = %s", (chat_id,))
+
+    def test_export_then_import_round_trips_a_chat(self):
+        """A chat exported, deleted and imported again reads back the same, archive included."""
+        before = self._snapshot(self.chat_id)
+        dump = io.StringIO()
+        counts = self.transfer.export_chats(dump, chat_id=self.chat_id)
+
+        self.assertEqual(counts, {"chats": 1, "khetmat": 1, "chapters": 30, "khetmat_archive": 1, "chapters_archive": 30, "reading_stats": 1})
+
+        self._delete_chat(self.chat_id)
+        dump.seek(0)
+        totals = self.transfer.import_chats(dump)
+
+        self.assertEqual(totals, {"chats": 1, "khetmat": 2, "skipped_chats": 0})
+        self.assertEqual(self._snapshot(self.chat_id), before)
+        self.assertEqual(len(self.storage.get_active_khetmat(self.chat_id_b)), 1)
+
+    def test_import_skips_chats_that_have_khetmat(self):
+        """Re-importing is harmless: chats that already have khetmat are left alone."""
+        dump = io.StringIO()
+        self.transfer.export_chats(dump)
+        self._delete_chat(self.chat_id_b)
+        dump.seek(0)
+
+        totals = self.transfer.import_chats(dump, batch_size=1)
+
+        self.assertEqual(totals, {"chats": 1, "khetmat": 1, "skipped_chats": 1})
+        self.assertEqual(self.storage.get_active_khetmat(self.chat_id_b)[0].number, 1)
+
+    def test_import_rejects_other_files(self):
+        """Anything without the export header is refused before touching the database."""
+        with self.assertRaises(ValueError):
+            self.transfer.import_chats(io.StringIO("chat_id\n1\n"))
+
+
+# ==========================================
+# CROSS-REPLICA INVALIDATION TESTS
+# ==========================================
+
+class TestKhetmaChangeListener(unittest.TestCase):
+    """One cached "replica" listening while another writes straight to the DB."""
+
+    def setUp(self):
+        self.db_core = TestStorageManager()
+        self.other_replica = KhetmaStorage(self.db_core)
+        self.cache = CachedKhetmaStorage(KhetmaStorage(self.db_core))
+        self.listener = KhetmaChangeListener(self.db_core.dsn, self.cache, origin="replica-a", poll_interval=0.1)
+
+        self.chat_id = -100123456
+        self.user_a = {"id": 222, "username": "@UserA"}
+
+    def tearDown(self):
+        self.listener.stop()
+        self.db_core.pool.closeall()
+
+    def _wait_for(self, condition, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the change notification")
+            time.sleep(0.05)
+
+    def test_foreign_chapter_write_invalidates_cached_khetma(self):
+        """A reservation made by another replica should evict the stale cached khetma."""
+        khetma = self.cache.create_new_khetma(self.chat_id)
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_listening(5))
+        self.cache.get_khetma(khetma_id=khetma.khetma_id)
+
+        self.other_replica.reserve_chapter(khetma.khetma_id, 7, self.user_a["id"], self.user_a["username"])
+        self._wait_for(lambda: self.cache.stats()["cached_khetmat"] == 0)
+
+        refreshed = self.cache.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertTrue(refreshed.get_chapter(7).is_reserved)
+
+    def test_foreign_khetma_creation_invalidates_chat_list(self):
+        """A khetma created by another replica should show up in the chat's active khetmat."""
+        self.cache.create_new_khetma(self.chat_id)
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_listening(5))
+        self.cache.get_active_khetmat(self.chat_id)
+
+        self.other_replica.create_new_khetma(self.chat_id)
+        self._wait_for(lambda: self.cache.stats()["cached_chats"] == 0)
+
+        self.assertEqual([k.number for k in self.cache.get_active_khetmat(self.chat_id)], [1, 2])
+
+    def test_own_writes_are_not_invalidated(self):
+        """Notifications carrying our own origin are already applied by the write-through cache."""
+        khetma = self.cache.create_new_khetma(self.chat_id)
+
+        self.listener.handle_payload(json.dumps({"khetma_id": khetma.khetma_id, "origin": "replica-a"}))
+        self.listener.handle_payload("not json")
+        self.listener.handle_payload("[1, 2]")
+
+        self.assertEqual(self.cache.stats()["cached_khetmat"], 1)
+        self.assertEqual((self.listener.received, self.listener.applied), (3, 0))
+
+    def test_listener_survives_a_failing_invalidation(self):
+        """An error while applying a notification clears the cache and reconnects, instead of ending the thread."""
+        khetma = self.cache.create_new_khetma(self.chat_id)
+        self.listener.reconnect_delay = 0.1
+        self.listener.start()
+        self.assertTrue(self.listener.wait_until_listening(5))
+
+        invalidate = self.cache.invalidate
+        def failing_invalidate(khetma_id, version=None):
+            self.cache.invalidate = invalidate
+            raise RuntimeError("invalidation failed")
+        self.cache.invalidate = failing_invalidate
+
+        with self.assertLogs("features.group_khetma.khetma_notifications", level="ERROR"):
+            self.other_replica.reserve_chapter(khetma.khetma_id, 7, self.user_a["id"], self.user_a["username"])
+            self._wait_for(lambda: self.cache.stats()["cached_khetmat"] == 0) # cleared after logging
+
+        # Still running: reconnects and keeps evicting what other replicas write
+        self.assertTrue(self.listener._thread.is_alive())
+        self.cache.get_khetma(khetma_id=khetma.khetma_id)
+        self.other_replica.reserve_chapter(khetma.khetma_id, 8, self.user_a["id"], self.user_a["username"])
+        self._wait_for(lambda: self.cache.stats()["cached_khetmat"] == 0)
+
+    def test_notifications_carry_the_khetma_version(self):
+        """Payloads hold the version the write stored, and a cached copy that has it is kept."""
+        khetma = self.cache.create_new_khetma(self.chat_id)
+        listening = psycopg2.connect(self.db_core.dsn)
+        listening.autocommit = True
+        with listening.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANGES_CHANNEL}")
+
+        self.other_replica.reserve_chapter(khetma.khetma_id, 7, self.user_a["id"], self.user_a["username"])
+        listening.poll()
+        versions = {json.loads(notify.payload)["version"] for notify in listening.notifies}
+        listening.close()
+        self.assertEqual(versions, {self.other_replica.get_khetma_version(khetma.khetma_id)})
+
+        cached = self.cache.get_khetma(khetma_id=khetma.khetma_id)
+        self.listener.handle_payload(json.dumps({"khetma_id": khetma.khetma_id, "version": cached.version, "origin": "replica-b"}))
+        self.assertEqual(self.cache.stats()["cached_khetmat"], 1)
+        self.listener.handle_payload(json.dumps({"khetma_id": khetma.khetma_id, "version": cached.version + 1, "origin": "replica-b"}))
+        self.assertEqual(self.cache.stats()["cached_khetmat"], 0)
+
+
+# ==========================================
+# ASYNC STORAGE ENGINE TESTS
+# ==========================================
+
+class TestAsyncKhetmaStorage(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.db_core = TestStorageManager()
+        self.storage = AsyncKhetmaStorage(KhetmaStorage(self.db_core))
+
+        self.chat_id = -100123456
+        self.user_a = {"id": 222, "username": "@UserA"}
+        self.user_b = {"id": 333, "username": "@UserB"}
+
+    def tearDown(self):
+        self.storage.close()
+        self.db_core.pool.closeall()
+
+    async def test_async_reserve_and_read_back(self):
+        """The async engine should expose the same results as the sync storage."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+        result = await self.storage.reserve_chapter(
+            khetma.khetma_id, 3, self.user_a["id"], self.user_a["username"]
+        )
+        self.assertTrue(result)
+
+        refreshed = await self.storage.get_khetma(khetma_id=khetma.khetma_id)
+        self.assertTrue(refreshed.get_chapter(3).is_reserved)
+
+    async def test_async_domain_errors_propagate(self):
+        """Domain errors raised in the worker thread should reach the awaiting handler."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+        await self.storage.reserve_chapter(
+            khetma.khetma_id, 1, self.user_a["id"], self.user_a["username"]
+        )
+
+        with self.assertRaises(errors.ChapterAlreadyReservedError):
+            await self.storage.reserve_chapter(
+                khetma.khetma_id, 1, self.user_b["id"], self.user_b["username"]
+            )
+
+    async def test_async_concurrent_reservations_have_one_winner(self):
+        """Concurrent clicks on the same chapter should only let one user reserve it."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+        users = [(user_id, f"@User{user_id}") for user_id in range(1000, 1010)]
+
+        results = await asyncio.gather(
+            *(self.storage.reserve_chapter(khetma.khetma_id, 7, user_id, username) for user_id, username in users),
+            return_exceptions=True
+        )
+
+        self.assertEqual(sum(1 for result in results if result is True), 1)
+        self.assertTrue(all(
+            isinstance(result, errors.ChapterAlreadyReservedError)
+            for result in results if result is not True
+        ))
+
+
+    async def test_async_concurrent_creations_get_distinct_numbers(self):
+        """Admins creating khetmat at the same moment should never get the same number."""
+        khetmat = await asyncio.gather(*(self.storage.create_new_khetma(self.chat_id) for _ in range(8)))
+
+        self.assertEqual(sorted(khetma.number for khetma in khetmat), list(range(1, 9)))
+
+    async def test_exhausted_pool_reaches_the_user(self):
+        """With every connection busy, a handler fails with DatabaseConnectionError and the user is told to retry."""
+        self.db_core.pool.closeall()
+        self.db_core.pool = BoundedConnectionPool(minconn=0, maxconn=1, acquire_timeout=0.1, dsn=self.db_core.dsn)
+        held = self.db_core.pool.getconn()
+
+        replies, answers = [], []
+
+        async def reply_text(text):
+            replies.append(text)
+
+        async def answer(text, show_alert=False):
+            answers.append(text)
+
+        message = SimpleNamespace(text="أجزائي", reply_text=reply_text)
+        context = SimpleNamespace(bot_data={"khetma_storage": self.storage})
+
+        message_update = SimpleNamespace(
+            message=message, effective_message=message, callback_query=None,
+            effective_chat=SimpleNamespace(id=self.chat_id), effective_user=SimpleNamespace(id=222)
+        )
+        with self.assertRaises(errors.DatabaseConnectionError) as caught:
+            await khetma_handlers.my_chapters_handler(message_update, context)
+        await khetma_handlers.reply_database_error(message_update, caught.exception)
+
+        button_update = SimpleNamespace(
+            callback_query=SimpleNamespace(data="reserve_1_3", from_user=SimpleNamespace(id=222), answer=answer),
+            effective_chat=SimpleNamespace(id=self.chat_id), effective_message=None
+        )
+        context.bot_data["user_directory"] = UserDirectory(self.storage)
+        with self.assertRaises(errors.DatabaseConnectionError) as caught:
+            await khetma_handlers.handle_khetma_buttons(button_update, context)
+        await khetma_handlers.reply_database_error(button_update, caught.exception)
+
+        self.assertEqual(replies, [errors.DatabaseConnectionError().message])
+        self.assertEqual(answers, [errors.DatabaseConnectionError().message])
+        self.db_core.pool.putconn(held)
+
+    async def test_completion_returns_the_reread_khetma(self):
+        """When the read copy went stale, the khetma that gets finished (and rendered) is the re-read one."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+        read, _ = await self.storage.finish_chapters(
+            khetma.khetma_id, list(range(1, 31)), self.user_a["id"], self.user_a["username"]
+        )
+        # Someone else writes the khetma after our read (without finishing it)
+        await self.storage.update_khetma(await self.storage.get_khetma(khetma_id=khetma.khetma_id))
+
+        completed = await khetma_handlers._complete_khetma(self.storage, read)
+
+        self.assertIsNot(completed, read)
+        self.assertEqual(completed.status, Khetma.khetma_status.FINISHED)
+        self.assertEqual(completed.version, await self.storage.get_khetma_version(khetma.khetma_id))
+        self.assertIsNone(await khetma_handlers._complete_khetma(self.storage, completed))
+
+    async def test_replies_to_archived_khetma_are_answered(self):
+        """Finishing or withdrawing in reply to an archived khetma should tell the user it's completed."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+        finished, _ = await self.storage.finish_chapters(
+            khetma.khetma_id, list(range(1, 31)), self.user_a["id"], self.user_a["username"]
+        )
+        await khetma_handlers._complete_khetma(self.storage, finished)
+        self.assertEqual(await self.storage.archive_finished_khetmat(chat_id=self.chat_id), 1)
+
+        replies = []
+
+        async def reply_text(text):
+            replies.append(text)
+
+        async def get_chat_administrators(chat_id):
+            return [SimpleNamespace(user=SimpleNamespace(id=self.user_a["id"]))]
+
+        context = SimpleNamespace(
+            bot=SimpleNamespace(get_chat_administrators=get_chat_administrators),
+            bot_data={"khetma_storage": self.storage, "admin_cache": AdminCache()}
+        )
+        for handler, text in ((khetma_handlers.finish_message_handler, "تم 5"),
+                              (khetma_handlers.admin_withdraw_handler, "سحب 5")):
+            message = SimpleNamespace(
+                text=text, reply_text=reply_text,
+                reply_to_message=SimpleNamespace(text=f"الختمة رقم {finished.number}")
+            )
+            update = SimpleNamespace(
+                message=message, effective_message=message, effective_chat=SimpleNamespace(id=self.chat_id),
+                effective_user=SimpleNamespace(id=self.user_a["id"], username="UserA", first_name="A")
+            )
+            await handler(update, context)
+
+        self.assertEqual(replies, [errors.KhetmaCompletedError().message] * 2)
+
+    async def test_user_recording_never_replies_when_pool_is_exhausted(self):
+        """Recording names is best effort: with every connection busy it's skipped, without raising."""
+        self.db_core.pool.closeall()
+        self.db_core.pool = BoundedConnectionPool(minconn=0, maxconn=1, acquire_timeout=0.1, dsn=self.db_core.dsn)
+        held = self.db_core.pool.getconn()
+
+        users = UserDirectory(self.storage)
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=222, username="UserA", first_name="A"))
+        with self.assertLogs("features.group_khetma.khetma_handlers", level="WARNING"):
+            await khetma_handlers.record_user_handler(update, SimpleNamespace(bot_data={"user_directory": users}))
+
+        self.assertEqual(users.stats()["writes"], 0)
+        self.db_core.pool.putconn(held)
+
+    async def test_async_concurrent_finishes_report_finished(self):
+        """When two users finish the same free chapter at once, the loser should see it as finished."""
+        khetma = await self.storage.create_new_khetma(self.chat_id)
+
+        results = await asyncio.gather(
+            self.storage.finish_chapter(khetma.khetma_id, 9, self.user_a["id"], self.user_a["username"]),
+            self.storage.finish_chapter(khetma.khetma_id, 9, self.user_b["id"], self.user_b["username"]),
+            return_exceptions=True
+        )
+
+        self.assertEqual(results.count(True), 1)
+        self.assertTrue(any(isinstance(result, errors.ChapterFinishedError) for result in results))
+
+
+# ==========================================
+# USER DIRECTORY TESTS
+# ==========================================
+
+class TestUserDirectory(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.backend = InMemoryKhetmaStorage()
+        self.storage = AsyncKhetmaStorage(self.backend)
+        self.users = UserDirectory(self.storage, max_users=2)
+
+    def tearDown(self):
+        self.storage.close()
+
+    async def test_record_writes_only_changes(self):
+        """Repeated updates from the same user cost one write until their name changes."""
+        ahmad = SimpleNamespace(id=222, username="UserA", first_name="Ahmad")
+
+        for _ in range(3):
+            self.assertEqual(await self.users.record(ahmad), "@UserA")
+        self.assertEqual(self.users.writes, 1)
+
+        renamed = SimpleNamespace(id=222, username=None, first_name="Ahmad")
+        self.assertEqual(await self.users.record(renamed), "Ahmad")
+        self.assertEqual(self.users.writes, 2)
+        self.assertIsNone(self.backend.get_users([222])[222]["username"])
+
+    async def test_display_names_fetch_misses_in_one_query(self):
+        """Unknown ids are loaded together, cached in LRU order, and never-seen ids are left out."""
+        self.backend.save_user(222, "UserA", "Ahmad")
+        self.backend.save_user(333, None, "Bilal")
+        queries = []
+        get_users = self.backend.get_users
+        self.backend.get_users = lambda user_ids: queries.append(list(user_ids)) or get_users(user_ids)
+
+        names = await self.users.display_names([222, 333, 222, 444])
+        self.assertEqual(names, {222: "@UserA", 333: "Bilal"})
+        self.assertEqual(queries, [[222, 333, 444]])
+
+        self.assertEqual(await self.users.display_names([333]), {333: "Bilal"})
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(self.users.stats()["hits"], 1)
+
+    async def test_display_names_expire_and_remember_unknown_ids(self):
+        """Ids with no users row aren't queried again, and names past their TTL are reloaded."""
+        self.backend.save_user(222, "UserA", "Ahmad")
+        queries = []
+        get_users = self.backend.get_users
+        self.backend.get_users = lambda user_ids: queries.append(list(user_ids)) or get_users(user_ids)
+
+        self.assertEqual(await self.users.display_names([222, 444]), {222: "@UserA"})
+        self.assertEqual(await self.users.display_names([222, 444]), {222: "@UserA"})
+        self.assertEqual(queries, [[222, 444]])
+
+        # Renamed through another replica: seen here once the cached name expires
+        self.backend.save_user(222, "UserA2", "Ahmad")
+        self.users.ttl = 0
+        self.assertEqual(await self.users.display_names([222]), {222: "@UserA2"})
+        self.assertEqual(queries[-1], [222])
+        self.assertEqual(self.users.stats()["expired"], 1)
+
+    async def test_resolve_asks_telegram_only_for_unknown_ids(self):
+        """Ids missing from the users table are fetched concurrently, within the limit, and recorded."""
+        self.backend.save_user(222, "UserA", "Ahmad")
+        self.users.max_users = 100
+        self.users.resolve_concurrency = 2
+        requested, in_flight, peak = [], 0, 0
+
+        async def get_chat_member(chat_id, user_id):
+            nonlocal in_flight, peak
+            requested.append(user_id)
+            in_flight += 1
+            peak = max(peak, in_flight)
+            await asyncio.sleep(0.01)
+            in_flight -= 1
+            if user_id == 999:
+                raise TelegramError.BadRequest("User not found")
+            return SimpleNamespace(user=SimpleNamespace(id=user_id, username=None, first_name=f"Member{user_id}"))
+
+        bot = SimpleNamespace(get_chat_member=get_chat_member)
+        names = await self.users.resolve(bot, -100123456, [222, 333, 444, 555, 999, 333])
+
+        self.assertEqual(names, {222: "@UserA", 333: "Member333", 444: "Member444", 555: "Member555"})
+        self.assertEqual(sorted(requested), [333, 444, 555, 999])
+        self.assertEqual(peak, 2)
+        self.assertEqual(self.backend.get_users([444])[444]["first_name"], "Member444")
+
+
+class TestIntentRouter(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.calls = []
+        handler = lambda name: (lambda update, context: self._record(name))
+        self.router = IntentRouter([
+            Intent("finish", handler("finish"), words=["تم", "تمت"], replies_only=True),
+            Intent("my_chapters", handler("my_chapters"), words=["أجزائي"]),
+            Intent("available_chapters", handler("available_chapters"), fragments=["أجزاء", "في"]),
+            Intent("remind", handler("remind"), words=["تذكير"]),
+        ])
+
+    async def _record(self, name):
+        self.calls.append(name)
+
+    def _update(self, text, is_reply=False):
+        return SimpleNamespace(message=SimpleNamespace(text=text, reply_to_message=object() if is_reply else None))
+
+    def test_match_triggers(self):
+        """Whole words, normalized spellings and fragments all resolve to the right intent."""
+        match = lambda text, is_reply=False: getattr(self.router.match(text, is_reply), "name", None)
+
+        self.assertEqual(match("تمت 5 و 6", is_reply=True), "finish")
+        self.assertEqual(match("اجزائي"), "my_chapters")
+        self.assertEqual(match("ما هي الأجزاء المتاحة في الختمة"), "available_chapters")
+        self.assertEqual(match("تذكير للجميع"), "remind")
+        self.assertIsNone(match("تمام جزاك الله خيرا"))
+        self.assertIsNone(match("الأجزاء"))
+        # "تم" only counts on a reply; without one the next matching intent gets the message
+        self.assertEqual(match("تم أجزائي", is_reply=True), "finish")
+        self.assertEqual(match("تم أجزائي"), "my_chapters")
+
+    async def test_handle_dispatches_once_and_counts(self):
+        """A message reaches at most one handler, and every message is counted."""
+        await self.router.handle(self._update("تم 3 تذكير", is_reply=True), None)
+        await self.router.handle(self._update("السلام عليكم"), None)
+        await self.router.handle(self._update("تذكير"), None)
+
+        self.assertEqual(self.calls, ["finish", "remind"])
+        self.assertEqual(self.router.stats(), {
+            "finish": 1, "my_chapters": 0, "available_chapters": 0, "remind": 1, "unmatched": 1
+        })
+
+
+class TestAdminCache(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.chat_id = -100123456
+        self.calls = []
+        self.admins = AdminCache(ttl=600.0)
+        self.bot = SimpleNamespace(get_chat_administrators=self._get_chat_administrators)
+
+    async def _get_chat_administrators(self, chat_id):
+        self.calls.append(chat_id)
+        return [SimpleNamespace(user=SimpleNamespace(id=111))]
+
+    def _member_updated(self, user_id, status):
+        return SimpleNamespace(
+            chat=SimpleNamespace(id=self.chat_id),
+            new_chat_member=SimpleNamespace(user=SimpleNamespace(id=user_id), status=status)
+        )
+
+    async def test_admins_loaded_once_and_expire(self):
+        """One get_chat_administrators call answers every check until the list expires."""
+        self.assertTrue(await self.admins.is_admin(self.bot, self.chat_id, 111))
+        self.assertFalse(await self.admins.is_admin(self.bot, self.chat_id, 222))
+        self.assertEqual(self.calls, [self.chat_id])
+
+        self.admins.ttl = 0
+        self.assertTrue(await self.admins.is_admin(self.bot, self.chat_id, 111))
+        self.assertEqual(len(self.calls), 2)
+
+        stats = self.admins.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["expired"]), (1, 2, 1))
+
+    async def test_concurrent_misses_share_one_call(self):
+        """Checks that miss together wait for one get_chat_administrators call."""
+        async def slow_get_chat_administrators(chat_id):
+            await asyncio.sleep(0.05)
+            return await self._get_chat_administrators(chat_id)
+        self.bot.get_chat_administrators = slow_get_chat_administrators
+
+        results = await asyncio.gather(
+            *(self.admins.is_admin(self.bot, self.chat_id, user_id) for user_id in (111, 222, 111, 333))
+        )
+
+        self.assertEqual(results, [True, False, True, False])
+        self.assertEqual(self.calls, [self.chat_id])
+        self.assertEqual(self.admins.stats()["joined"], 3)
+
+    async def test_member_updates_change_cached_admins(self):
+        """Promotions and demotions apply to the cached list without calling Telegram."""
+        await self.admins.is_admin(self.bot, self.chat_id, 111)
+
+        self.admins.member_updated(self._member_updated(222, ChatMemberStatus.ADMINISTRATOR))
+        self.admins.member_updated(self._member_updated(111, ChatMemberStatus.MEMBER))
+        self.assertTrue(await self.admins.is_admin(self.bot, self.chat_id, 222))
+        self.assertFalse(await self.admins.is_admin(self.bot, self.chat_id, 111))
+        self.assertEqual(len(self.calls), 1)
+
+        # The bot leaving the group forgets it
+        self.admins.member_updated(self._member_updated(999, ChatMemberStatus.LEFT), bot_id=999)
+        self.assertEqual(self.admins.stats()["cached_chats"], 0)
+
+
+class TestEditCoalescer(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self):
+        self.chat_id = -100123456
+        self.edits = []
+        self.flood_limits = []
+        self.editor = EditCoalescer(window=0.01)
+        self.bot = SimpleNamespace(edit_message_text=self._edit_message_text)
+
+    async def _edit_message_text(self, chat_id, message_id, text, reply_markup=None, parse_mode=None):
+        if self.flood_limits:
+            raise TelegramError.RetryAfter(self.flood_limits.pop())
+        self.edits.append((message_id, text))
+
+    async def test_burst_collapses_into_latest_state(self):
+        """Edits scheduled within the window become one edit per message, with the newest version."""
+        for version in range(1, 21):
+            self.editor.schedule_edit(self.bot, self.chat_id, 10, f"v{version}", version=version)
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v5", version=5)
+        self.editor.schedule_edit(self.bot, self.chat_id, 11, "other")
+        await self.editor.flush()
+
+        self.assertEqual(sorted(self.edits), [(10, "v20"), (11, "other")])
+        stats = self.editor.stats()
+        self.assertEqual((stats["sent"], stats["coalesced"], stats["stale"]), (2, 19, 1))
+        self.assertEqual(stats["active_messages"], 0)
+
+    async def test_retry_after_backs_off_and_sends_latest(self):
+        """A flood limit delays the edit, and what was scheduled meanwhile is what gets sent."""
+        self.flood_limits.append(1)
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v1", version=1)
+        await asyncio.sleep(0.1)
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v2", version=2)
+        await self.editor.flush()
+
+        self.assertEqual(self.edits, [(10, "v2")])
+        self.assertEqual(self.editor.stats()["rate_limited"], 1)
+
+    async def test_late_older_version_refused_after_worker_exits(self):
+        """An older state arriving after the newer one was sent must not overwrite it."""
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v2", version=2)
+        await self.editor.flush()
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v1", version=1)
+        await self.editor.flush()
+
+        self.assertEqual(self.edits, [(10, "v2")])
+        self.assertEqual(self.editor.stats()["stale"], 1)
+
+    async def test_tracked_versions_are_bounded(self):
+        """Versions of done messages are forgotten past max_messages, oldest first."""
+        self.editor.max_messages = 2
+        for message_id in (10, 11, 12):
+            self.editor.schedule_edit(self.bot, self.chat_id, message_id, "v1", version=1)
+            await self.editor.flush()
+
+        self.assertEqual(self.editor.stats()["tracked_versions"], 2)
+        self.editor.schedule_edit(self.bot, self.chat_id, 10, "v0", version=0)
+        await self.editor.flush()
+        self.assertEqual(self.edits[-1], (10, "v0")) # forgotten, so taken as new
+
+
 if __name__ == '__main__':
     unittest.main(verbosity=2)
\ No newline at end of file
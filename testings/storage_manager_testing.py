@@ -0,0 +1,328 @@
+import unittest
+import threading
+import time
+from decouple import config
+import psycopg2
+from psycopg2 import pool
+from psycopg2.extras import RealDictCursor
+
+# Local imports
+from prepared_statements import PreparedStatementRegistry
+from storage_manager import StorageManager, Migration
+from connection_pool import BoundedConnectionPool, PoolTimeoutError
+from features.group_khetma.khetma_storage import KhetmaStorage
+from features.group_khetma.khetma_migrations import MIGRATIONS
+
+# python -m unittest -v testings.storage_manager_testing
+
+# ==========================================
+# TEST DATABASE SETUP
+# Requires TEST_DATABASE_URL in your .env (same database as the khetma tests)
+# ==========================================
+
+class TestStorageManager(StorageManager):
+    """A StorageManager connected to the TEST database, wiped before each test."""
+    def __init__(self):
+        self.dsn = config("TEST_DATABASE_URL")
+        self.pool = pool.ThreadedConnectionPool(
+            minconn=1,
+            maxconn=3,
+            dsn=self.dsn,
+            cursor_factory=RealDictCursor
+        )
+        self.statements = PreparedStatementRegistry()
+        self._drop_all_tables()
+        self._init_chats_table()
+
+    def _drop_all_tables(self):
+        with self.managed_connection() as cursor:
+            cursor.execute("DROP TABLE IF EXISTS migration_probe CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS chapters_archive CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS khetmat_archive CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS chapters CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS khetmat CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS reading_stats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS users CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS chats CASCADE;")
+            cursor.execute("DROP TABLE IF EXISTS schema_version CASCADE;")
+
+
+# ==========================================
+# MIGRATION RUNNER TESTS
+# ==========================================
+
+class TestMigrations(unittest.TestCase):
+
+    def setUp(self):
+        self.db_core = TestStorageManager()
+        self.migrations = [
+            Migration(2, "add probe column", "ALTER TABLE migration_probe ADD COLUMN IF NOT EXISTS label TEXT"),
+            Migration(1, "create probe table", "CREATE TABLE IF NOT EXISTS migration_probe (id INTEGER)"),
+            Migration(3, "index probe table", [
+                "CREATE INDEX CONCURRENTLY IF NOT EXISTS migration_probe_label_idx ON migration_probe (label)"
+            ], concurrent=True),
+        ]
+
+    def tearDown(self):
+        self.db_core.pool.closeall()
+
+    def _recorded_versions(self, component):
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute("SELECT version FROM schema_version WHERE component = %s ORDER BY version", (component,))
+            return [row["version"] for row in cursor.fetchall()]
+
+    def test_migrations_apply_in_version_order(self):
+        """Pending migrations should run sorted by version and be recorded."""
+        applied = self.db_core.apply_migrations("probe", self.migrations)
+
+        self.assertEqual(applied, [1, 2, 3])
+        self.assertEqual(self._recorded_versions("probe"), [1, 2, 3])
+
+    def test_migrations_run_only_once(self):
+        """A second run should find nothing pending."""
+        self.db_core.apply_migrations("probe", self.migrations)
+        self.assertEqual(self.db_core.apply_migrations("probe", self.migrations), [])
+
+    def test_new_migration_is_picked_up(self):
+        """Appending a step later should only apply that step."""
+        self.db_core.apply_migrations("probe", self.migrations)
+        self.migrations.append(Migration(4, "add probe flag", "ALTER TABLE migration_probe ADD COLUMN flag BOOLEAN"))
+
+        self.assertEqual(self.db_core.apply_migrations("probe", self.migrations), [4])
+
+    def test_failed_migration_is_rolled_back_and_not_recorded(self):
+        """A failing step should leave no partial changes and stay pending."""
+        self.db_core.apply_migrations("probe", self.migrations)
+        broken = Migration(4, "broken step", [
+            "ALTER TABLE migration_probe ADD COLUMN half_done TEXT",
+            "SELECT * FROM table_that_does_not_exist",
+        ])
+
+        with self.assertRaises(Exception):
+            self.db_core.apply_migrations("probe", self.migrations + [broken])
+
+        self.assertEqual(self._recorded_versions("probe"), [1, 2, 3])
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM information_schema.columns WHERE table_name = 'migration_probe' AND column_name = 'half_done'"
+            )
+            self.assertIsNone(cursor.fetchone())
+
+    def test_components_are_versioned_independently(self):
+        """Two components can both have a version 1."""
+        self.db_core.apply_migrations("probe", self.migrations)
+        applied = self.db_core.apply_migrations("other", [Migration(1, "noop", "SELECT 1")])
+
+        self.assertEqual(applied, [1])
+
+    def test_khetma_schema_has_hot_path_indexes(self):
+        """The khetma migrations should create the lookup indexes and unique constraints."""
+        KhetmaStorage(self.db_core)
+
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute("SELECT indexname FROM pg_indexes WHERE tablename IN ('chapters', 'khetmat')")
+            indexes = {row["indexname"] for row in cursor.fetchall()}
+            cursor.execute("SELECT conname FROM pg_constraint WHERE contype = 'u'")
+            constraints = {row["conname"] for row in cursor.fetchall()}
+
+        self.assertTrue({
+            "chapters_khetma_id_number_key",
+            "chapters_reserved_owner_idx",
+            "khetmat_chat_id_number_key",
+            "khetmat_chat_id_status_idx",
+        } <= indexes)
+        self.assertTrue({"chapters_khetma_id_number_key", "khetmat_chat_id_number_key"} <= constraints)
+
+
+    def test_khetma_unique_indexes_build_over_duplicates(self):
+        """A database holding duplicate khetma and chapter numbers should still migrate, keeping the furthest copy."""
+        self.db_core.apply_migrations("khetma", MIGRATIONS[:2])
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute("INSERT INTO chats (chat_id) VALUES (-100)")
+            cursor.execute("INSERT INTO khetmat (chat_id, number) VALUES (-100, 1), (-100, 1), (-100, 2) RETURNING khetma_id")
+            first_id = cursor.fetchall()[0]["khetma_id"]
+            cursor.execute(
+                "INSERT INTO chapters (khetma_id, number, status, owner_id) VALUES (%s, 7, 'EMPTY', NULL), (%s, 7, 'FINISHED', 222)",
+                (first_id, first_id)
+            )
+
+        KhetmaStorage(self.db_core)
+
+        with self.db_core.managed_connection() as cursor:
+            cursor.execute("SELECT number FROM khetmat WHERE chat_id = -100 ORDER BY khetma_id")
+            self.assertEqual([row["number"] for row in cursor.fetchall()], [1, 3, 2])
+            cursor.execute("SELECT status, owner_id FROM chapters WHERE khetma_id = %s AND number = 7", (first_id,))
+            self.assertEqual(cursor.fetchall(), [{"status": "FINISHED", "owner_id": 222}])
+
+
+# ==========================================
+# CONNECTION POOL TESTS
+# ==========================================
+
+class TestBoundedConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = BoundedConnectionPool(minconn=1, maxconn=2, acquire_timeout=0.3, dsn=config("TEST_DATABASE_URL"))
+
+    def tearDown(self):
+        self.pool.closeall()
+
+    def test_exhausted_pool_times_out(self):
+        """With every connection busy, getconn should wait for the timeout and then fail."""
+        held = [self.pool.getconn(), self.pool.getconn()]
+
+        started = time.monotonic()
+        with self.assertRaises(PoolTimeoutError):
+            self.pool.getconn()
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.3)
+        self.assertEqual(self.pool.stats()["timeouts"], 1)
+        for conn in held:
+            self.pool.putconn(conn)
+
+    def test_waiting_caller_gets_returned_connection(self):
+        """A caller queued on a full pool should get the next connection that is put back."""
+        held = [self.pool.getconn(), self.pool.getconn()]
+        released = threading.Timer(0.1, self.pool.putconn, args=(held[0],))
+        released.start()
+
+        conn = self.pool.getconn(timeout=2)
+
+        self.assertIs(conn, held[0])
+        self.assertEqual(self.pool.stats()["in_use"], 2)
+        self.assertGreater(self.pool.stats()["max_wait"], 0)
+        self.pool.putconn(conn)
+        self.pool.putconn(held[1])
+
+    def test_dead_connection_is_replaced_on_checkout(self):
+        """A connection killed while idle should be swapped for a fresh one before it is handed out."""
+        self.pool.validate_after = 0
+        victim, killer = self.pool.getconn(), self.pool.getconn()
+        with victim.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        victim.rollback()
+        self.pool.putconn(victim)
+
+        with killer.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", (pid,))
+        killer.commit()
+        self.pool.putconn(killer)
+
+        # killer was returned last, so it is handed out first
+        first, second = self.pool.getconn(), self.pool.getconn()
+        for conn in (first, second):
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+        self.assertEqual(self.pool.stats()["failed_validations"], 1)
+        self.pool.putconn(first)
+        self.pool.putconn(second)
+
+    def test_recently_used_dead_connection_is_replaced(self):
+        """A connection killed seconds after use (a restart/failover) should be caught without waiting for validate_after."""
+        self.pool.validate_after = 3600
+        victim = self.pool.getconn()
+        with victim.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            pid = cursor.fetchone()[0]
+        victim.rollback()
+        self.pool.putconn(victim)
+
+        killer = psycopg2.connect(config("TEST_DATABASE_URL"))
+        with killer.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", (pid,))
+        killer.close()
+        time.sleep(0.1) # let the server's goodbye reach the socket
+
+        conn = self.pool.getconn()
+        self.assertIsNot(conn, victim)
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.assertEqual(self.pool.stats()["failed_validations"], 1)
+        self.pool.putconn(conn)
+
+    def test_old_connections_are_recycled(self):
+        """A connection past its max lifetime should be closed instead of reused."""
+        conn = self.pool.getconn()
+        self.pool.max_lifetime = 0
+        self.pool.putconn(conn)
+
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.pool.stats()["recycled"], 1)
+        self.assertEqual(self.pool.stats()["size"], 0)
+
+    def test_open_transaction_is_rolled_back_on_return(self):
+        """A connection returned mid-transaction should come back clean."""
+        conn = self.pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        self.pool.putconn(conn)
+
+        again = self.pool.getconn()
+        self.assertEqual(again.info.transaction_status, 0) # TRANSACTION_STATUS_IDLE
+        self.pool.putconn(again)
+
+
+# ==========================================
+# PREPARED STATEMENT REGISTRY TESTS
+# ==========================================
+
+class TestPreparedStatements(unittest.TestCase):
+
+    def setUp(self):
+        self.db_core = TestStorageManager()
+        self.registry = self.db_core.statements
+        self.sql = "SELECT %(a)s::INTEGER + %(b)s::INTEGER + %(a)s::INTEGER AS total"
+
+    def tearDown(self):
+        self.db_core.pool.closeall()
+
+    def _run(self, params):
+        with self.db_core.managed_connection() as cursor:
+            self.registry.execute(cursor, "probe_sum", self.sql, params)
+            return cursor.fetchone()["total"]
+
+    def test_statement_is_prepared_once_per_connection(self):
+        """Repeated runs on the same connection should only PREPARE the first time."""
+        with self.db_core.managed_connection() as cursor:
+            for _ in range(3):
+                self.registry.execute(cursor, "probe_sum", self.sql, {"a": 1, "b": 2})
+            self.assertEqual(cursor.fetchone()["total"], 4) # a is bound once, used twice
+
+        stats = self.registry.stats()["probe_sum"]
+        self.assertEqual((stats["prepares"], stats["executions"]), (1, 3))
+
+    def test_lost_statement_is_prepared_again(self):
+        """If the server forgets the statement, the next use on that connection should re-prepare it."""
+        self.assertEqual(self._run({"a": 1, "b": 1}), 3)
+        conn = self.db_core.pool.getconn()
+        with conn.cursor() as cursor:
+            cursor.execute("DEALLOCATE ALL")
+        conn.commit()
+        self.db_core.pool.putconn(conn)
+
+        with self.assertRaises(Exception):
+            self._run({"a": 1, "b": 1})
+        self.assertEqual(self._run({"a": 2, "b": 3}), 7)
+
+    def test_name_cannot_be_reused_for_other_sql(self):
+        """Registering a different statement under a taken name is a programming error."""
+        self._run({"a": 1, "b": 1})
+        with self.db_core.managed_connection() as cursor:
+            with self.assertRaises(ValueError):
+                self.registry.execute(cursor, "probe_sum", "SELECT 1", {})
+
+    def test_hot_khetma_statements_run_prepared(self):
+        """Chapter clicks should go through the registry."""
+        storage = KhetmaStorage(self.db_core)
+        khetma = storage.create_new_khetma(-100123456)
+        storage.reserve_chapter_returning(khetma.khetma_id, 1, 222, "@UserA")
+        storage.get_chapter(khetma_id=khetma.khetma_id, chapter_number=1)
+
+        stats = self.registry.stats()
+        self.assertEqual(stats["reserve_chapter_returning"]["executions"], 1)
+        self.assertEqual(stats["chapter_by_number"]["executions"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
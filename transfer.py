@@ -0,0 +1,48 @@
+import argparse
+import gzip
+import logging
+
+# Local modules
+from storage_manager import StorageManager
+from features.group_khetma import khetma_migrations
+from features.group_khetma.khetma_transfer import KhetmaTransfer
+
+# Exports / imports khetma data (chats, khetmat, chapters and their archive) as a COPY stream:
+# python transfer.py export backup.khetma.gz [--chat-id -100123456]
+# python transfer.py import backup.khetma.gz [--batch-size 100]
+#
+# Files ending in .gz are compressed. Both directions stream, so memory use stays flat
+# however big the groups are. Importing a chat that already has khetmat here skips it.
+
+def open_dump(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8", newline="\n")
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Export or import khetma data through COPY.")
+    parser.add_argument("direction", choices=["export", "import"])
+    parser.add_argument("path")
+    parser.add_argument("--chat-id", type=int, help="export only this chat")
+    parser.add_argument("--batch-size", type=int, default=100, help="chats per import transaction")
+    args = parser.parse_args()
+
+    db_core = StorageManager()
+    db_core.apply_migrations(khetma_migrations.COMPONENT, khetma_migrations.MIGRATIONS)
+    transfer = KhetmaTransfer(db_core)
+
+    if args.direction == "export":
+        with open_dump(args.path, "w") as out:
+            counts = transfer.export_chats(out, chat_id=args.chat_id)
+        logging.info(f"Exported {counts} to {args.path}")
+    else:
+        with open_dump(args.path, "r") as source:
+            totals = transfer.import_chats(source, batch_size=args.batch_size)
+        logging.info(f"Imported {totals} from {args.path}")
+
+    db_core.pool.closeall()
+
+if __name__ == "__main__":
+    main()